@@ -0,0 +1,85 @@
+# module bench_ann
+"""Approximate index types vs. the flat index: recall@k, p50/p99 query latency, build time and memory per vector
+
+    $ python benchmarks/bench_ann.py --chunks 100000 --dim 1024 --nprobe 8 16 32 --ef_search 32 64 128
+"""
+
+# system
+import time
+import argparse
+
+# vector
+import faiss
+import numpy as np
+
+# local
+from common import BenchTimer, bench_percentile, bench_print_table, bench_write_json
+from vectorstore import VECTORSTORE_INDEX_TYPES, vectorstore_make_index, vectorstore_tune_index
+
+
+def bench_make_vectors(n: int, dim: int, clusters: int = 256, seed: int = 0) -> np.ndarray:
+    """Clustered unit vectors, closer to real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.standard_normal((n, dim), dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def bench_queries(index: faiss.Index, queries: np.ndarray, k: int) -> tuple[np.ndarray, list[float]]:
+    results = np.zeros((len(queries), k), dtype=np.int64)
+    latencies = []
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, results[i] = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chunks', help='number of vectors', default=100000, type=int)
+    parser.add_argument('--dim', help='vector dimension', default=1024, type=int)
+    parser.add_argument('--queries', help='number of queries', default=200, type=int)
+    parser.add_argument('--k', help='neighbours per query', default=5, type=int)
+    parser.add_argument('--types', help='index types', default=VECTORSTORE_INDEX_TYPES, choices=VECTORSTORE_INDEX_TYPES, nargs='+')
+    parser.add_argument('--nprobe', help='nprobe values for IVF types', default=[8, 16, 32], type=int, nargs='+')
+    parser.add_argument('--ef_search', help='efSearch values for HNSW', default=[32, 64, 128], type=int, nargs='+')
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    vectors = bench_make_vectors(args.chunks, args.dim)
+    queries = bench_make_vectors(args.queries, args.dim, seed=1)
+    
+    # exact neighbours
+    flat = faiss.IndexFlatL2(args.dim)
+    flat.add(vectors)
+    truth, _ = bench_queries(flat, queries, args.k)
+    
+    results = []
+    for index_type in args.types:
+        with BenchTimer() as t:
+            index = vectorstore_make_index(index_type, args.dim, args.chunks)
+            if not index.is_trained: index.train(vectors[np.random.default_rng(0).permutation(args.chunks)[:256 * faiss.extract_index_ivf(index).nlist]])
+            index.add(vectors)
+        bytes_per_vector = len(faiss.serialize_index(index)) / args.chunks
+        
+        settings = [('-', None, None)]
+        if index_type in ('ivf', 'ivfpq', 'sq8'): settings = [(f'nprobe={n}', n, None) for n in args.nprobe]
+        elif index_type == 'hnsw': settings = [(f'efSearch={ef}', None, ef) for ef in args.ef_search]
+        for name, nprobe, ef_search in settings:
+            vectorstore_tune_index(index, nprobe or 1, ef_search or 16)
+            found, latencies = bench_queries(index, queries, args.k)
+            recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+            results.append({
+                'index': index_type,
+                'params': name,
+                'build_s': t.elapsed,
+                f'recall@{args.k}': float(recall),
+                'p50_ms': bench_percentile(latencies, 50),
+                'p99_ms': bench_percentile(latencies, 99),
+                'bytes_per_vector': bytes_per_vector,
+            })
+    
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'ann', results, vars(args))
@@ -0,0 +1,97 @@
+# module bench_answercache
+"""Answer cache on a repeated-question workload: hit ratio and answer latency of hits and misses
+
+    $ python benchmarks/bench_answercache.py --questions 50 --asks 500 --thresholds 1.0 0.95 0.9
+
+Questions are drawn with Zipf-like popularity and asked in paraphrased forms (word order, case, filler words).
+Retrieval runs the hybrid search of bench_retrieval's corpus, answers are generated by the fake Ollama server.
+"""
+
+# system
+import time
+import random
+import argparse
+
+# vector
+import numpy as np
+
+# ollama
+from ollama import Client as OllamaClient
+
+# local
+from common import bench_percentile, bench_print_table, bench_write_json
+from fakes import FakeOllamaServer
+from bench_retrieval import bench_bow_embedding, bench_make_corpus, bench_make_vectorstore
+from llm import llm_model_chat_stream
+from answercache import AnswerCache, ANSWERCACHE_TTL
+from vectorstore import vectorstore_search
+
+# constants
+BENCH_FILLERS = ['please', 'exactly', 'again', 'now']
+
+
+def bench_paraphrase(question: str, rng: random.Random) -> str:
+    """Rewords question: shuffled words, random case, sometimes a filler word"""
+    words = question.split()
+    rng.shuffle(words)
+    if rng.random() < 0.3: words.insert(rng.randrange(len(words) + 1), rng.choice(BENCH_FILLERS))
+    return ' '.join(w.upper() if rng.random() < 0.1 else w for w in words)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chunks', help='number of chunks', default=5000, type=int)
+    parser.add_argument('--dim', help='embedding dimension', default=256, type=int)
+    parser.add_argument('--questions', help='distinct questions', default=50, type=int)
+    parser.add_argument('--asks', help='questions asked', default=500, type=int)
+    parser.add_argument('--thresholds', help='similarity thresholds', default=[1.0, 0.95, 0.9], type=float, nargs='+')
+    parser.add_argument('--cache_size', help='answers kept', default=1024, type=int)
+    parser.add_argument('--token_latency', help='seconds per generated token', default=0.002, type=float)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    texts, codes, _ = bench_make_corpus(args.chunks, 50)
+    vectors = [bench_bow_embedding(text, args.dim) for text in texts]
+    vectorStore = bench_make_vectorstore(texts, np.stack(vectors))
+
+    rng = random.Random(0)
+    pool = []
+    for i in rng.sample(range(args.chunks), args.questions):
+        words = texts[i].split()
+        pool.append(f'what does {codes[i]} say about {words[0]} and {words[1]}')
+    weights = [1 / (rank + 1) for rank in range(len(pool))]
+    asks = [bench_paraphrase(rng.choices(pool, weights)[0], rng) for _ in range(args.asks)]
+
+    server = FakeOllamaServer(token_latency=args.token_latency).start()
+    client = OllamaClient(server.base_url)
+    results = []
+    for threshold in args.thresholds:
+        cache = AnswerCache(args.cache_size, ANSWERCACHE_TTL, threshold)
+        hits, misses = [], []
+        start_all = time.perf_counter()
+        for question in asks:
+            start = time.perf_counter()
+            vector = bench_bow_embedding(question, args.dim).tolist()
+            documents = [doc for doc, _ in vectorstore_search(vectorStore, question, vector, 5)]
+            answer = cache.get('llama3', question, vector, documents)
+            if answer is not None:
+                hits.append((time.perf_counter() - start) * 1000)
+                continue
+            prompt = '\n\n---\n\n'.join(doc.page_content for doc in documents) + '\n\n' + question
+            answer = ''.join(llm_model_chat_stream(prompt, client))
+            cache.put('llama3', question, vector, documents, answer)
+            misses.append((time.perf_counter() - start) * 1000)
+        stats = cache.stats()
+        results.append({
+            'threshold': threshold,
+            'hit_ratio': stats['hit_ratio'],
+            'entries': stats['entries'],
+            'hit_p50_ms': bench_percentile(hits, 50),
+            'hit_p95_ms': bench_percentile(hits, 95),
+            'miss_p50_ms': bench_percentile(misses, 50),
+            'total_s': time.perf_counter() - start_all,
+        })
+    server.stop()
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'answercache', results, vars(args))
@@ -0,0 +1,170 @@
+# module bench_codecs
+"""Vector codecs and dimension reduction vs. float32: index bytes per vector, disk use, recall@k with and without
+exact re-scoring and p50 query latency
+
+    $ python benchmarks/bench_codecs.py --chunks 100000 --dim 1024 --reduced_dim 256 --rescore 4
+
+A float32 library of --rebuild_chunks is also saved in shards and loaded by a service with every codec, as the app
+does after the codec is changed. Exits with 1 if exact search misses a neighbour, re-scoring lowers recall, or if the
+rebuilt shards, and a shard saved again after a file is deleted, are not stored with the codec or lose chunks.
+"""
+
+# system
+import os
+import time
+import argparse
+import tempfile
+
+# vector
+import faiss
+import numpy as np
+
+# langchain
+from langchain_community.vectorstores import FAISS
+from langchain.schema import Document
+
+# local
+from common import BenchTimer, bench_check, bench_percentile, bench_print_table, bench_write_json
+from llm import LLMBatchEmbeddings
+from vectorstore import *
+
+
+def bench_make_vectors(n: int, dim: int, decay: float, seed: int = 0) -> np.ndarray:
+    """Unit vectors whose variance falls off with the dimension index like the spectrum of real embeddings, leading
+    dimensions carry the most information as in Matryoshka embeddings
+    """
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((n, dim), dtype=np.float32) * (np.arange(1, dim + 1, dtype=np.float32) ** -decay)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def bench_make_store(vectors: np.ndarray) -> FAISS:
+    documents = [Document(page_content=f'chunk {i}', metadata={'source': f'file{i // 100}.pdf', 'page': i // 10, 'id': f'file{i // 100}.pdf:{i // 10}:{i % 10}'}) for i in range(len(vectors))]
+    return FAISS.from_embeddings(
+        [(d.page_content, v) for d, v in zip(documents, vectors)],
+        LLMBatchEmbeddings(),
+        metadatas=[d.metadata for d in documents],
+        ids=[d.metadata['id'] for d in documents],
+    )
+
+
+def bench_disk_bytes(path: str) -> dict:
+    """Sizes of the index and the exact vector sidecar of the current generation"""
+    gen = os.path.join(path, f'gen-{vectorstore_read_current(path)["generation"]:06d}')
+    size = lambda name: os.path.getsize(os.path.join(gen, name)) if os.path.exists(os.path.join(gen, name)) else 0
+    return {'index': size('index.faiss'), 'vectors': size('vectors.npy')}
+
+
+def bench_rebuild(vectors: np.ndarray, index_type: str, codec: str, reduced_dim: int, reduction: str) -> tuple[float, dict[str, bool]]:
+    """Saves vectors in float32 shards in the current directory, then loads them with the codec and deletes a file
+
+    Returns:
+        tuple[float, dict[str, bool]]: seconds to load and rebuild, checks
+    """
+    store = bench_make_store(vectors)
+    ids = sorted(store.index_to_docstore_id.values())
+    shards = vectorstore_split(store)
+    vectorstore_commit_shards(shards, list(shards))
+    index_params = {'index_type': index_type, 'codec': codec, 'reduced_dim': reduced_dim, 'reduction': reduction}
+    with BenchTimer() as t:
+        service = VectorStoreService(embedding=store.embedding_function, **index_params)
+    deleted = vectorstore_source_of(ids[0])
+    service.update([], [id for id in ids if vectorstore_source_of(id) == deleted])
+
+    # the shards as saved, loaded by a reader
+    reader = VectorStoreService(embedding=store.embedding_function, writable=False, **index_params)
+    stored = lambda shard: vectorstore_get_codec(shard.index) == vectorstore_target_format(shard.index, index_type, codec, reduced_dim, reduction)[1]
+    name = f'{codec}-{reduced_dim}-{reduction}' if reduced_dim else codec
+    return t.elapsed, {
+        f'rebuilt shards are stored as {name}': all(stored(shard) for shard in reader.shards.values()),
+        f'a shard saved after a delete is stored as {name}': stored(reader.shards[vectorstore_shard_of(deleted)]),
+        f'rebuilt shards keep their chunks ({name})': sorted(id for shard in reader.shards.values() for id in shard.index_to_docstore_id.values()) == [id for id in ids if vectorstore_source_of(id) != deleted],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chunks', help='number of vectors', default=100000, type=int)
+    parser.add_argument('--dim', help='vector dimension', default=1024, type=int)
+    parser.add_argument('--queries', help='number of queries', default=200, type=int)
+    parser.add_argument('--k', help='neighbours per query', default=5, type=int)
+    parser.add_argument('--index_type', help='index type', default='flat', choices=VECTORSTORE_INDEX_TYPES, type=str)
+    parser.add_argument('--codecs', help='codecs', default=VECTORSTORE_CODECS, choices=VECTORSTORE_CODECS, nargs='+')
+    parser.add_argument('--reduced_dim', help='reduced dimension (0 to skip)', default=256, type=int)
+    parser.add_argument('--reductions', help='reductions', default=VECTORSTORE_REDUCTIONS, choices=VECTORSTORE_REDUCTIONS, nargs='+')
+    parser.add_argument('--rescore', help='candidates per result re-ranked by exact vectors', default=4, type=int)
+    parser.add_argument('--rebuild_chunks', help='vectors saved as float32 shards and rebuilt with every codec (trained codecs need 1000 per shard)', default=32000, type=int)
+    parser.add_argument('--decay', help='variance of dimension i falls off as i^-decay', default=0.75, type=float)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    vectors = bench_make_vectors(args.chunks, args.dim, args.decay)
+    queries = bench_make_vectors(args.queries, args.dim, args.decay, seed=1)
+
+    # exact neighbours
+    flat = faiss.IndexFlatL2(args.dim)
+    flat.add(vectors)
+    _, truth = flat.search(queries, args.k)
+
+    configs = [(codec, 0, None) for codec in args.codecs]
+    if args.reduced_dim: configs += [(codec, args.reduced_dim, reduction) for reduction in args.reductions for codec in args.codecs]
+
+    results, checks = [], {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for codec, reduced_dim, reduction in configs:
+                compressed = codec != 'float32' or reduced_dim
+                path = f'{codec}-{reduced_dim}-{reduction}'
+                with BenchTimer() as t_build:
+                    vectorstore_commit(
+                        bench_make_store(vectors),
+                        args.index_type,
+                        path=path,
+                        codec=codec,
+                        reduced_dim=reduced_dim,
+                        reduction=reduction or 'pca',
+                        rescore=args.rescore,
+                    )
+                # the rebuild works in the vectorstore directory of the app
+                os.makedirs(os.path.join(path, 'rebuild'))
+                os.chdir(os.path.join(path, 'rebuild'))
+                try: rebuild_s, rebuild_checks = bench_rebuild(vectors[:args.rebuild_chunks], args.index_type, codec, reduced_dim, reduction or 'pca')
+                finally: os.chdir(tmp)
+                checks.update(rebuild_checks)
+
+                store = vectorstore_read(path)
+                positions = {id: i for i, id in store.index_to_docstore_id.items()}
+                disk = bench_disk_bytes(path)
+                for rescore in sorted({0, args.rescore if compressed else 0}):
+                    latencies, recall = [], []
+                    for query, expected in zip(queries, truth):
+                        start = time.perf_counter()
+                        found = vectorstore_search(store, '', query.tolist(), args.k, 'vector', rescore=rescore)
+                        latencies.append((time.perf_counter() - start) * 1000)
+                        recall.append(len({positions[d.metadata['id']] for d, _ in found} & set(expected)) / args.k)
+                    results.append({
+                        'codec': codec,
+                        'dim': reduced_dim or args.dim,
+                        'reduction': reduction or '-',
+                        'rescore': rescore,
+                        'index_bytes_per_vector': disk['index'] / args.chunks,
+                        'index_mb': disk['index'] / 2**20,
+                        'disk_mb': (disk['index'] + disk['vectors']) / 2**20,
+                        f'recall@{args.k}': float(np.mean(recall)),
+                        'p50_ms': bench_percentile(latencies, 50),
+                        'build_s': t_build.elapsed,
+                        'rebuild_s': rebuild_s,
+                    })
+        finally: os.chdir(cwd)
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'codecs', results, vars(args))
+
+    # re-scoring re-ranks a superset of the candidates found without it by exact distance
+    recall = {(row['codec'], row['dim'], row['reduction'], row['rescore']): row[f'recall@{args.k}'] for row in results}
+    if args.index_type == 'flat' and 'float32' in args.codecs: checks['exact search finds all neighbours'] = recall[('float32', args.dim, '-', 0)] == 1.0
+    checks['re-scoring does not lower recall'] = all(value >= recall[(*config, 0)] for (*config, rescore), value in recall.items() if rescore)
+    bench_check(checks)
@@ -0,0 +1,74 @@
+# module bench_compare
+"""Compares two benchmark JSON files (written with --json) row by row, exits with 1 if a metric regressed
+
+    $ python benchmarks/bench_compare.py baseline.json current.json --tolerance 0.1
+"""
+
+# system
+import sys
+import json
+import argparse
+
+# local
+from common import bench_print_table
+
+# metric name endings where a larger value is better, smaller is better for everything else (seconds, ms, mb)
+BENCH_HIGHER_IS_BETTER = ('per_s', 'ratio', 'speedup', 'recall', 'hit')
+
+
+def bench_higher_is_better(metric: str) -> bool:
+    return any(part in metric for part in BENCH_HIGHER_IS_BETTER)
+
+
+def bench_row_key(row: dict) -> tuple:
+    """Identifies a row by its non-float fields (stage, case, scale...)"""
+    return tuple((k, v) for k, v in row.items() if not isinstance(v, float))
+
+
+def bench_compare(baseline: dict, current: dict, tolerance: float) -> list[dict]:
+    """Relative change of every metric found in both runs
+
+    Args:
+        baseline (dict): baseline run
+        current (dict): current run
+        tolerance (float): relative change counted as a regression
+
+    Returns:
+        list[dict]: {'row', 'metric', 'baseline', 'current', 'change', 'verdict'}
+    """
+    rows = {bench_row_key(row): row for row in baseline['results']}
+    comparison = []
+    for row in current['results']:
+        key = bench_row_key(row)
+        if key not in rows: continue
+        for metric, value in row.items():
+            before = rows[key].get(metric)
+            if not isinstance(value, float) or not isinstance(before, float): continue
+            change = (value - before) / before if before else 0.0
+            worse = -change if bench_higher_is_better(metric) else change
+            comparison.append({
+                'row': ' '.join(str(v) for _, v in key),
+                'metric': metric,
+                'baseline': before,
+                'current': value,
+                'change': f'{change:+.1%}',
+                'verdict': 'REGRESSION' if worse > tolerance else 'improved' if worse < -tolerance else 'ok',
+            })
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('baseline', help='baseline results', type=str)
+    parser.add_argument('current', help='current results', type=str)
+    parser.add_argument('--tolerance', help='relative change counted as a regression or improvement', default=0.1, type=float)
+    args = parser.parse_args()
+
+    with open(args.baseline, 'r') as f: baseline = json.load(f)
+    with open(args.current, 'r') as f: current = json.load(f)
+    if baseline['benchmark'] != current['benchmark']: sys.exit(f'different benchmarks: {baseline["benchmark"]} vs {current["benchmark"]}')
+
+    print(f'{baseline["benchmark"]}: {baseline["commit"] or "?"} ({baseline["time"]}) => {current["commit"] or "?"} ({current["time"]})')
+    comparison = bench_compare(baseline, current, args.tolerance)
+    bench_print_table(comparison)
+    sys.exit(1 if any(row['verdict'] == 'REGRESSION' for row in comparison) else 0)
@@ -0,0 +1,42 @@
+# module bench_embedding
+"""Embedding throughput (chunks/s) vs. batch size and concurrency against a local fake Ollama server
+
+    $ python benchmarks/bench_embedding.py --chunks 2000 --batch_sizes 1 8 32 128 --workers 1 2 4 8
+"""
+
+# system
+import argparse
+
+# local
+from common import BenchTimer, bench_print_table, bench_write_json
+from fakes import FakeOllamaServer
+from llm import LLMBatchEmbeddings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chunks', help='number of chunks to embed', default=2000, type=int)
+    parser.add_argument('--batch_sizes', help='batch sizes to test', default=[1, 8, 32, 128], type=int, nargs='+')
+    parser.add_argument('--workers', help='concurrency levels to test', default=[1, 2, 4, 8], type=int, nargs='+')
+    parser.add_argument('--dim', help='embedding dimension', default=256, type=int)
+    parser.add_argument('--latency', help='fake server latency per request (s)', default=0.005, type=float)
+    parser.add_argument('--item_latency', help='fake server latency per text (s)', default=0.001, type=float)
+    parser.add_argument('--server_parallel', help='requests the fake server handles at once', default=4, type=int)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(dim=args.dim, latency=args.latency, item_latency=args.item_latency, parallel=args.server_parallel).start()
+    texts = [f'chunk number {i} ' * 20 for i in range(args.chunks)]
+    
+    results = []
+    for batch_size in args.batch_sizes:
+        for workers in args.workers:
+            embedding = LLMBatchEmbeddings(base_url=server.base_url, batch_size=batch_size, max_workers=workers)
+            with BenchTimer() as t:
+                vectors = embedding.embed_documents(texts)
+            assert len(vectors) == len(texts)
+            results.append({'batch_size': batch_size, 'workers': workers, 'seconds': t.elapsed, 'chunks_per_s': len(texts) / t.elapsed})
+    server.stop()
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'embedding', results, vars(args))
@@ -0,0 +1,113 @@
+# module bench_gateway
+"""Many sessions asking at once: a client per session (every question goes straight to the server) vs. the shared
+LLM gateway (bounded concurrency, sessions served in turns, identical questions in flight generated once)
+
+    $ python benchmarks/bench_gateway.py --sessions 32 --questions 4 --parallel 4 --max_queue 16 --heavy 16
+
+Sessions start at the same time and ask popular questions more often (Zipf-like), so identical questions overlap.
+One more session sends --heavy questions at once. The fake Ollama server generates --parallel answers at a time and
+refuses chat requests beyond --max_queue waiting ones with 503, like Ollama under a burst.
+"""
+
+# system
+import time
+import random
+import argparse
+import threading
+
+# ollama
+from ollama import Client as OllamaClient
+
+# local
+from common import bench_percentile, bench_print_table, bench_write_json
+from fakes import FakeOllamaServer
+from llm import llm_model_chat_stream
+from llmgateway import LLMGateway
+
+
+def bench_run(ask, sessions: list[list[str]], heavy: list[str]) -> dict:
+    """Runs every session in its own thread (questions one after another) and every heavy question in its own thread
+
+    Args:
+        ask (Callable[[str, str, dict], None]): asks a question (prompt, session, stats)
+        sessions (list[list[str]]): questions of each session
+        heavy (list[str]): questions sent at once by the heavy session
+
+    Returns:
+        dict: latencies in ms of light and heavy questions, time to first token in ms, errors and total seconds
+    """
+    light_ms, heavy_ms, ttft_ms, errors = [], [], [], []
+
+    def run(prompts: list[str], session: str, latencies: list[float]):
+        for prompt in prompts:
+            stats = {}
+            start = time.perf_counter()
+            try: ask(prompt, session, stats)
+            except Exception as e:
+                errors.append(type(e).__name__)
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+            ttft_ms.append(stats['ttft'] * 1000)
+
+    threads = [threading.Thread(target=run, args=(prompts, f'session{i}', light_ms)) for i, prompts in enumerate(sessions)]
+    threads += [threading.Thread(target=run, args=([prompt], 'heavy', heavy_ms)) for prompt in heavy]
+    start = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return {'light_ms': light_ms, 'heavy_ms': heavy_ms, 'ttft_ms': ttft_ms, 'errors': errors, 'total_s': time.perf_counter() - start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sessions', help='sessions asking at the same time', default=32, type=int)
+    parser.add_argument('--questions', help='questions per session', default=4, type=int)
+    parser.add_argument('--distinct', help='distinct questions', default=20, type=int)
+    parser.add_argument('--heavy', help='questions sent at once by one more session (0 for none)', default=16, type=int)
+    parser.add_argument('--parallel', help='answers the server generates at once (gateway concurrency)', default=4, type=int)
+    parser.add_argument('--max_queue', help='chat requests the server keeps waiting before it refuses more', default=16, type=int)
+    parser.add_argument('--token_latency', help='seconds per generated token', default=0.002, type=float)
+    parser.add_argument('--prompt_latency', help='seconds per prompt character before the first token', default=0.0001, type=float)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    pool = [f'question {i}: ' + ' '.join(rng.choices(['pump', 'valve', 'pressure', 'clause', 'warranty', 'payment'], k=200)) for i in range(args.distinct)]
+    weights = [1 / (rank + 1) for rank in range(len(pool))]
+    sessions = [rng.choices(pool, weights, k=args.questions) for _ in range(args.sessions)]
+    heavy = [f'heavy {i}: {pool[i % len(pool)]}' for i in range(args.heavy)]
+
+    results = []
+    for mode in ['clients', 'gateway']:
+        server = FakeOllamaServer(parallel=args.parallel, max_queue=args.max_queue, token_latency=args.token_latency, prompt_latency=args.prompt_latency).start()
+        if mode == 'clients':
+            # a client per session like st.session_state before the gateway
+            clients = {}
+            def ask(prompt: str, session: str, stats: dict):
+                client = clients.setdefault(session, OllamaClient(server.base_url))
+                ''.join(llm_model_chat_stream(prompt, client, stats=stats))
+        else:
+            gateway = LLMGateway(server.base_url, max_concurrency=args.parallel, queue_timeout=0)
+            def ask(prompt: str, session: str, stats: dict):
+                ''.join(gateway.chat_stream(prompt, session=session, stats=stats))
+        run = bench_run(ask, sessions, heavy)
+        if mode == 'gateway': gateway.close()
+        server.stop()
+
+        answered = len(run['light_ms']) + len(run['heavy_ms'])
+        results.append({
+            'mode': mode,
+            'answered': answered,
+            'errors': len(run['errors']),
+            'server_requests': server.requests,
+            'refused': server.refused,
+            'connections': server.connections,
+            'peak_at_server': server.peak_chats,
+            'light_p50_ms': bench_percentile(run['light_ms'], 50),
+            'light_p95_ms': bench_percentile(run['light_ms'], 95),
+            'heavy_p95_ms': bench_percentile(run['heavy_ms'], 95),
+            'ttft_p95_ms': bench_percentile(run['ttft_ms'], 95),
+            'answers_per_s': answered / run['total_s'],
+        })
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'gateway', results, vars(args))
@@ -0,0 +1,206 @@
+# module bench_ingest
+"""Incremental re-ingest: the first run over a set of files vs. the same files again vs. one file with a page added,
+and an ingest job interrupted after a checkpoint and resumed vs. the same job run at once
+
+    $ python benchmarks/bench_ingest.py --files 8 --pages 10 --words_per_page 400 --job_files 20 --job_pages 100
+
+Only changed files may be parsed and only their new and changed chunks embedded and stored again. Exits with 1 if 
+unchanged files are parsed, add or embed anything,
+if a page added to a file costs more than its own chunks, if the resumed job embeds files saved before the interruption
+or ends with another library than the job run at once, or if the database and the index hold different chunks.
+The job is interrupted once a checkpoint is saved (every STORAGE_CHECKPOINT_SIZE chunks), so it needs more chunks than that.
+"""
+
+# system
+import os
+import argparse
+import tempfile
+
+# local
+from common import BenchTimer, bench_check, bench_print_table, bench_write_json
+from fakes import FakeOllamaServer
+from fixtures import fixture_text, fixture_write_pdf
+import storage
+import ingest
+from llm import LLMBatchEmbeddings
+from jobs import jobs_submit, jobs_claim, jobs_get_collection
+from vectorstore import VectorStoreService
+
+
+class BenchCrash(BaseException):
+    """Stops a job like a killed worker: not caught by the job, nothing after the last checkpoint is saved"""
+
+
+class BenchEmbeddings(LLMBatchEmbeddings):
+    """Embedding function counting the texts it embeds"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.embedded = 0
+
+    def embed_batches(self, texts: list[str]):
+        self.embedded += len(texts)
+        return super().embed_batches(texts)
+
+
+def bench_make_files(dirpath: str, files: int, pages: int, words_per_page: int, added_pages: dict[int, int] = None) -> list[str]:
+    """Writes PDFs whose page texts depend only on (file, page), so a file written again with more pages keeps its first pages"""
+    os.makedirs(dirpath, exist_ok=True)
+    paths = []
+    for i in range(files):
+        path = os.path.join(dirpath, f'doc{i:05d}.pdf')
+        fixture_write_pdf(path, [fixture_text(words_per_page, seed=i * 1009 + p) for p in range(pages + (added_pages or {}).get(i, 0))])
+        paths.append(path)
+    return paths
+
+
+def bench_library(vectorService: VectorStoreService, repository: storage.StorageRepository) -> dict:
+    """Chunk ids of the database (duplicates included) and of the index"""
+    stored = [d['metadata']['id'] for d in repository.documents.find({}, {'_id': 0, 'metadata.id': 1})]
+    indexed = [id for shard in vectorService.shards.values() for id in shard.index_to_docstore_id.values()]
+    return {'stored': stored, 'indexed': indexed}
+
+
+def bench_incremental(dirpath: str, mongo: dict, base_url: str, files: int, pages: int, words_per_page: int) -> tuple[list[dict], dict[str, bool]]:
+    """Ingests the same files three times, the last time with a page added to the first file
+
+    Returns:
+        tuple[list[dict], dict[str, bool]]: result rows, checks
+    """
+    repository = storage.StorageRepository(**mongo)
+    embedding = BenchEmbeddings(base_url=base_url)
+    vectorService = VectorStoreService(**mongo, embedding=embedding)
+    results, libraries = [], {}
+
+    # files handed to the parser
+    parse, parsed = ingest.fu_iter_content_parallel, []
+    def count_parsed(files, *args, **kwargs):
+        parsed.extend(files)
+        return parse(files, *args, **kwargs)
+
+    for case, added_pages in [('first', {}), ('unchanged', {}), ('page added', {0: 1})]:
+        paths = bench_make_files(os.path.join(dirpath, 'files'), files, pages, words_per_page, added_pages)
+        embedded = embedding.embedded
+        parsed.clear()
+        ingest.fu_iter_content_parallel = count_parsed
+        with BenchTimer() as t:
+            try: counts = ingest.ingest_run(paths, vectorService, parse_workers=1, page_cache_dir='', **mongo)
+            finally: ingest.fu_iter_content_parallel = parse
+        library = libraries[case] = bench_library(vectorService, repository)
+        results.append({
+            'case': case,
+            'seconds': t.elapsed,
+            'parsed': len(parsed),
+            'chunks_added': counts['chunks_added'],
+            'chunks_removed': counts['chunks_removed'],
+            'embedded': embedding.embedded - embedded,
+            'stored': len(library['stored']),
+            'indexed': len(library['indexed']),
+            'errors': len(counts['errors']),
+        })
+
+    rows = {row['case']: row for row in results}
+    first_chunks = sum(1 for id in libraries['page added']['stored'] if id.startswith('doc00000.pdf:'))
+    return results, {
+        'no errors': not any(row['errors'] for row in results),
+        'unchanged files are not parsed': rows['unchanged']['parsed'] == 0 and rows['page added']['parsed'] == 1,
+        'unchanged files add nothing': rows['unchanged']['chunks_added'] == rows['unchanged']['chunks_removed'] == rows['unchanged']['embedded'] == 0,
+        'a page added embeds only its chunks': 0 < rows['page added']['embedded'] == rows['page added']['chunks_added'] < first_chunks,
+        'no duplicate chunks': all(len(set(library['stored'])) == len(library['stored']) and len(set(library['indexed'])) == len(library['indexed']) for library in libraries.values()),
+        'database and index agree': all(set(library['stored']) == set(library['indexed']) for library in libraries.values()),
+    }
+
+
+def bench_resume(dirpath: str, mongo: dict, base_url: str, files: int, pages: int, words_per_page: int) -> tuple[list[dict], dict[str, bool]]:
+    """Runs a job at once, then the same job in another library interrupted after its first checkpoint and resumed by a new
+    vectorstore service, as a worker started after one that died
+
+    Returns:
+        tuple[list[dict], dict[str, bool]]: result rows, checks
+    """
+    paths = bench_make_files(os.path.join(dirpath, 'job'), files, pages, words_per_page)
+    results, libraries, checkpointed = [], {}, 0
+
+    def interrupt(progress: dict):
+        nonlocal checkpointed
+        if 0 < progress['files_checkpointed'] < progress['files_total']:
+            checkpointed = progress['files_checkpointed']
+            raise BenchCrash()
+
+    # progress is written after every file and batch, so the job stops right after the checkpoint
+    ingest.INGEST_PROGRESS_INTERVAL = 0
+    for library_name, runs in [('at once', [('at once', None)]), ('interrupted', [('interrupted', interrupt), ('resumed', None)])]:
+        # every library works in its own directory and database
+        os.makedirs(os.path.join(dirpath, library_name), exist_ok=True)
+        os.chdir(os.path.join(dirpath, library_name))
+        mongo_library = {**mongo, 'mongo_dbname': f'{mongo["mongo_dbname"]}_{library_name.replace(" ", "_")}'}
+        job_id = jobs_submit(paths, **mongo_library)
+        for run, on_progress in runs:
+            embedding = BenchEmbeddings(base_url=base_url)
+            vectorService = VectorStoreService(**mongo_library, embedding=embedding)
+            job = jobs_claim('bench', job_id=job_id, **mongo_library)
+            if job is None: break # finished without a checkpoint to resume from, see the checks
+            skipped = job['progress']['files_checkpointed']
+            with BenchTimer() as t:
+                try: ingest.ingest_run_job(job, vectorService, parse_workers=1, page_cache_dir='', on_progress=on_progress, **mongo_library)
+                except BenchCrash: pass
+            job = jobs_get_collection(storage.storage_get_client(mongo['mongo_connect']), mongo_library['mongo_dbname'], mongo_library['mongo_colname']).find_one({'_id': job_id})
+            library = libraries[library_name] = bench_library(vectorService, storage.StorageRepository(**mongo_library))
+            results.append({
+                'job': run,
+                'seconds': t.elapsed,
+                'files_skipped': skipped,
+                'files_checkpointed': job['progress']['files_checkpointed'],
+                'status': job['status'],
+                'embedded': embedding.embedded,
+                'stored': len(library['stored']),
+                'indexed': len(library['indexed']),
+            })
+        storage.storage_get_client(mongo['mongo_connect']).drop_database(mongo_library['mongo_dbname'])
+
+    rows = {row['job']: row for row in results}
+    resumed = rows.get('resumed', {'status': None, 'files_skipped': None, 'embedded': 0})
+    resumed_files = set(f'doc{i:05d}.pdf' for i in range(checkpointed, files))
+    resumed_chunks = sum(1 for id in libraries['at once']['stored'] if id.split(':')[0] in resumed_files)
+    return results, {
+        f'job interrupted after a checkpoint (needs more than {storage.STORAGE_CHECKPOINT_SIZE} chunks)': checkpointed > 0,
+        'resumed job is done': resumed['status'] == 'done' and resumed['files_skipped'] == checkpointed,
+        'resumed job embeds only files after the checkpoint': 0 < resumed['embedded'] <= resumed_chunks,
+        'resumed library is the same as of the job run at once': sorted(libraries['interrupted']['stored']) == sorted(libraries['at once']['stored']) == sorted(libraries['interrupted']['indexed']),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--files', help='number of files', default=8, type=int)
+    parser.add_argument('--pages', help='pages per file', default=10, type=int)
+    parser.add_argument('--words_per_page', help='words per page', default=400, type=int)
+    parser.add_argument('--job_files', help='files of the interrupted job', default=20, type=int)
+    parser.add_argument('--job_pages', help='pages per file of the interrupted job', default=100, type=int)
+    parser.add_argument('--mongo_connect', help="mongo connect url, 'mongomock' for an in-process fake", default='mongomock', type=str)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    if args.mongo_connect == 'mongomock':
+        import mongomock
+        storage.STORAGE_CLIENTS[args.mongo_connect] = mongomock.MongoClient()
+    mongo = {'mongo_connect': args.mongo_connect, 'mongo_dbname': 'filechat_bench', 'mongo_colname': 'documents'}
+    storage.storage_get_client(args.mongo_connect).drop_database(mongo['mongo_dbname'])
+
+    server = FakeOllamaServer(latency=0.001, item_latency=0.0001, dim=64).start()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as dirpath:
+        # the service works in the current directory
+        os.chdir(dirpath)
+        try:
+            incremental, incremental_checks = bench_incremental(dirpath, mongo, server.base_url, args.files, args.pages, args.words_per_page)
+            resume, resume_checks = bench_resume(dirpath, mongo, server.base_url, args.job_files, args.job_pages, args.words_per_page)
+        finally:
+            os.chdir(cwd)
+            storage.storage_get_client(args.mongo_connect).drop_database(mongo['mongo_dbname'])
+    server.stop()
+
+    bench_print_table(incremental)
+    bench_print_table(resume)
+    if args.json: bench_write_json(args.json, 'ingest', incremental + resume, vars(args))
+    bench_check({**incremental_checks, **resume_checks})
@@ -0,0 +1,88 @@
+# module bench_paragraphs
+"""DOCX/ODT chunking: one page per paragraph vs. paragraphs grouped into pages, on fixture documents.
+Reports pages, chunks (= embedding calls and vectors), index size, parse+split time and retrieval of sentences and identifiers.
+
+    $ python benchmarks/bench_paragraphs.py --files 8 --pages 40 --queries 200
+"""
+
+# system
+import os
+import re
+import random
+import argparse
+import tempfile
+import collections
+
+# vector
+import numpy as np
+
+# local
+from common import BenchTimer, bench_print_table, bench_write_json
+from fixtures import fixture_make_corpus
+from bench_retrieval import bench_bow_embedding, bench_make_vectorstore
+from ingest import INGEST_CHUNK_SIZE, INGEST_CHUNK_OVERLAP
+from fileuploader import fu_get_content_docx, fu_get_content_odt, fu_iter_split_documents, FU_PARAGRAPHS_PAGE_SIZE
+from vectorstore import vectorstore_search
+
+
+def bench_chunk(paths: list[str], page_size: int) -> tuple[int, list[str]]:
+    """Parses and splits files
+
+    Returns:
+        tuple[int, list[str]]: pages, chunk texts
+    """
+    pages = 0
+    chunks = []
+    for path in paths:
+        reader = fu_get_content_docx if path.endswith('.docx') else fu_get_content_odt
+        with open(path, 'rb') as f:
+            documents = list(reader(f, os.path.basename(path), page_size))
+        pages += len(documents)
+        chunks.extend(chunk.page_content for chunk in fu_iter_split_documents(documents, INGEST_CHUNK_SIZE, INGEST_CHUNK_OVERLAP))
+    return pages, chunks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--files', help='number of files (docx and odt)', default=8, type=int)
+    parser.add_argument('--pages', help='pages of text per file', default=40, type=int)
+    parser.add_argument('--words_per_page', help='words per page', default=400, type=int)
+    parser.add_argument('--page_sizes', help='characters per page, 0 is one page per paragraph', default=[0, FU_PARAGRAPHS_PAGE_SIZE], type=int, nargs='+')
+    parser.add_argument('--dim', help='embedding dimension', default=1024, type=int)
+    parser.add_argument('--queries', help='queries of each kind', default=200, type=int)
+    parser.add_argument('--k', help='chunks per query', default=5, type=int)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        paths = fixture_make_corpus(dirpath, args.files, args.pages, args.words_per_page, ['docx', 'odt'])
+
+        # the same sentences and identifiers are looked up in every run, a hit is a returned chunk that contains them
+        _, reference = bench_chunk(paths, 0)
+        sentences = sorted({s.strip() + '.' for text in reference for s in text.split('. ') if len(s.split()) >= 8})
+        sentences = random.Random(1).sample(sentences, min(args.queries, len(sentences)))
+        codes = collections.Counter(code for text in reference for code in re.findall(r'\b[A-H][K-T]-\d{4}\b', text))
+        codes = random.Random(2).sample(sorted(code for code, n in codes.items() if n == 1), min(args.queries, len(codes)))
+        queries = {'sentence': [(sentence, sentence.rstrip('.')) for sentence in sentences], 'identifier': [(f'what does {code} refer to', code) for code in codes]}
+
+        results = []
+        for page_size in args.page_sizes:
+            with BenchTimer() as t: pages, chunks = bench_chunk(paths, page_size)
+            vectorStore = bench_make_vectorstore(chunks, np.stack([bench_bow_embedding(text, args.dim) for text in chunks]))
+            hits = {}
+            for kind, items in queries.items():
+                for retrieval in ['vector', 'hybrid']:
+                    found = (vectorstore_search(vectorStore, query, bench_bow_embedding(query, args.dim).tolist(), args.k, retrieval) for query, _ in items)
+                    hits[f'{kind}_{retrieval}_hit@{args.k}'] = sum(any(answer in doc.page_content for doc, _ in docs) for docs, (_, answer) in zip(found, items)) / len(items)
+            results.append({
+                'page_size': page_size,
+                'pages': pages,
+                'chunks': len(chunks),
+                'mean_chunk_chars': float(np.mean([len(c) for c in chunks])),
+                'index_mb': len(chunks) * args.dim * 4 / 2**20,
+                'parse_split_s': t.elapsed,
+                **hits,
+            })
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'paragraphs', results, vars(args))
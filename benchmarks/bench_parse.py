@@ -0,0 +1,49 @@
+# module bench_parse
+"""Document parsing throughput (files/s, pages/s) vs. number of worker processes on a generated corpus
+
+    $ python benchmarks/bench_parse.py --files 40 --pages 20 --workers 1 2 4 8
+"""
+
+# system
+import os
+import argparse
+import tempfile
+
+# local
+from common import BenchTimer, bench_print_table, bench_write_json
+from fixtures import fixture_make_corpus
+from fileuploader import fu_iter_content_parallel, FU_PDF_PAGES_PER_TASK
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--files', help='number of files in the corpus', default=40, type=int)
+    parser.add_argument('--pages', help='pages per file', default=20, type=int)
+    parser.add_argument('--words_per_page', help='words per page', default=400, type=int)
+    parser.add_argument('--formats', help='file formats, assigned round-robin', default=['pdf', 'docx', 'odt', 'txt'], type=str, nargs='+')
+    parser.add_argument('--workers', help='worker process counts to test', default=[1, 2, 4, os.cpu_count()], type=int, nargs='+')
+    parser.add_argument('--pages_per_task', help='PDF pages per task', default=FU_PDF_PAGES_PER_TASK, type=int)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        paths = fixture_make_corpus(dirpath, args.files, args.pages, args.words_per_page, args.formats)
+        
+        results = []
+        for workers in sorted(set(args.workers)):
+            pages = errors = 0
+            with BenchTimer() as t:
+                for fname, documents in fu_iter_content_parallel(paths, max_workers=workers, pages_per_task=args.pages_per_task):
+                    try: pages += sum(1 for _ in documents)
+                    except Exception: errors += 1
+            results.append({
+                'workers': workers, 
+                'seconds': t.elapsed, 
+                'files_per_s': len(paths) / t.elapsed, 
+                'pages_per_s': pages / t.elapsed, 
+                'speedup': results[0]['seconds'] / t.elapsed if results else 1.0,
+                'errors': errors,
+            })
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'parse', results, vars(args))
@@ -0,0 +1,75 @@
+# module bench_pdf
+"""PDF text extraction throughput (pages/s) per backend: cold parse, first read into the page cache and cached re-read
+
+    $ python benchmarks/bench_pdf.py --files 10 --pages 50
+    $ python benchmarks/bench_pdf.py --paths manual.pdf report.pdf --backends pymupdf pdfium pypdf2
+"""
+
+# system
+import os
+import argparse
+import tempfile
+
+# local
+from common import BenchTimer, bench_print_table, bench_write_json
+from fixtures import fixture_text, fixture_write_pdf
+from fileuploader import fu_get_content_pdf
+from pdftext import PDFTEXT_BACKENDS, pdftext_available, pdftext_open_cache
+
+
+def bench_read(paths: list[str], backend: str, cache_dir: str = None) -> tuple[int, int]:
+    """Reads all pages of files
+
+    Returns:
+        tuple[int, int]: pages, characters
+    """
+    pages = chars = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            for document in fu_get_content_pdf(f, os.path.basename(path), backend=backend, cache_dir=cache_dir):
+                pages += 1
+                chars += len(document.page_content)
+    return pages, chars
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--paths', help='sample PDFs (generated if not given)', default=[], type=str, nargs='+')
+    parser.add_argument('--files', help='number of generated files', default=10, type=int)
+    parser.add_argument('--pages', help='pages per generated file', default=50, type=int)
+    parser.add_argument('--words_per_page', help='words per generated page', default=400, type=int)
+    parser.add_argument('--backends', help='backends to test (installed ones by default)', default=[], choices=PDFTEXT_BACKENDS, type=str, nargs='+')
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    backends = [b for b in args.backends or PDFTEXT_BACKENDS if b in pdftext_available()]
+    skipped = sorted(set(args.backends or PDFTEXT_BACKENDS) - set(backends))
+    if skipped: print(f'not installed: {", ".join(skipped)}')
+
+    with tempfile.TemporaryDirectory() as dirpath:
+        paths = args.paths
+        if not paths:
+            for i in range(args.files):
+                paths.append(os.path.join(dirpath, f'sample_{i}.pdf'))
+                fixture_write_pdf(paths[-1], [fixture_text(args.words_per_page, seed=i * args.pages + p) for p in range(args.pages)])
+
+        results = []
+        for backend in backends:
+            cache_dir = os.path.join(dirpath, f'cache-{backend}')
+            bench_read(paths[:1], backend) # imports the backend
+            with BenchTimer() as cold: pages, chars = bench_read(paths, backend)
+            with BenchTimer() as fill: bench_read(paths, backend, cache_dir)
+            with BenchTimer() as cached: bench_read(paths, backend, cache_dir)
+            results.append({
+                'backend': backend,
+                'pages': pages,
+                'chars': chars,
+                'cold_pages_per_s': pages / cold.elapsed,
+                'fill_pages_per_s': pages / fill.elapsed,
+                'cached_pages_per_s': pages / cached.elapsed,
+                'cache_speedup': cold.elapsed / cached.elapsed,
+                'cache_mb': pdftext_open_cache(cache_dir).stats()['bytes'] / 2**20,
+            })
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'pdf', results, vars(args))
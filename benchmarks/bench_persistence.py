@@ -0,0 +1,114 @@
+# module bench_persistence
+"""Cold-start time, RSS and incremental save cost: pickled FAISS object vs. native index + docstore sidecar
+
+    $ python benchmarks/bench_persistence.py --chunks 100000 --dim 1024
+"""
+
+# system
+import os
+import sys
+import json
+import pickle
+import argparse
+import tempfile
+import subprocess
+
+# vector
+import numpy as np
+
+# langchain
+from langchain.schema import Document
+from langchain_community.vectorstores import FAISS
+
+# local
+from common import SRC_DIR, BenchTimer, bench_print_table, bench_write_json
+from llm import LLMBatchEmbeddings
+from vectorstore import vectorstore_read, vectorstore_save
+
+# measured in a fresh interpreter: load time and RSS growth caused by the load
+LOAD_SCRIPT = '''
+import sys, time, json, pickle
+sys.path.insert(0, {src!r})
+from vectorstore import vectorstore_read
+rss = lambda: int(open('/proc/self/statm').read().split()[1]) * 4096 / 2**20
+before = rss()
+start = time.perf_counter()
+if {kind!r} == 'pickle':
+    with open({path!r}, 'rb') as f: vs = pickle.load(f)
+else:
+    vs = vectorstore_read({path!r})
+elapsed = time.perf_counter() - start
+_, found = vs.index.search(vs.index.reconstruct(0).reshape(1, -1), 5)
+docs = [vs.docstore.search(vs.index_to_docstore_id[i]) for i in found[0]]
+print(json.dumps({{'load_s': elapsed, 'rss_mb': rss() - before}}))
+'''
+
+
+def bench_make_store(n: int, dim: int, seed: int = 0) -> tuple[FAISS, list[Document]]:
+    rng = np.random.default_rng(seed)
+    documents = [Document(page_content=f'chunk {i} ' + 'lorem ipsum ' * 60, metadata={'source': f'file{i // 100}.pdf', 'page': i // 10, 'id': f'file{i // 100}.pdf:{i // 10}:{i % 10}'}) for i in range(n)]
+    vectors = rng.standard_normal((n, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    store = FAISS.from_embeddings(
+        [(d.page_content, v) for d, v in zip(documents, vectors)], 
+        LLMBatchEmbeddings(), 
+        metadatas=[d.metadata for d in documents], 
+        ids=[d.metadata['id'] for d in documents],
+    )
+    return store, documents
+
+
+def bench_cold_load(kind: str, path: str) -> dict:
+    output = subprocess.run([sys.executable, '-c', LOAD_SCRIPT.format(src=SRC_DIR, kind=kind, path=path)], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chunks', help='number of chunks in the store', default=100000, type=int)
+    parser.add_argument('--dim', help='embedding dimension', default=1024, type=int)
+    parser.add_argument('--update', help='chunks added per incremental update', default=100, type=int)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    store, _ = bench_make_store(args.chunks, args.dim)
+    extra, extra_docs = bench_make_store(args.update, args.dim, seed=1)
+    for d in extra_docs: d.metadata['id'] = 'new:' + d.metadata['id']
+    extra_vectors = [extra.index.reconstruct(i) for i in range(args.update)]
+    
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # pickle: every save rewrites everything
+        pickle_path = os.path.join(tmp, 'vectorstore.pkl')
+        with BenchTimer() as t_save:
+            with open(pickle_path, 'wb') as f: pickle.dump(store, f)
+        store.add_embeddings([(d.page_content, v) for d, v in zip(extra_docs, extra_vectors)], metadatas=[d.metadata for d in extra_docs], ids=[d.metadata['id'] for d in extra_docs])
+        with BenchTimer() as t_update:
+            with open(pickle_path, 'wb') as f: pickle.dump(store, f)
+        results.append({
+            'format': 'pickle', 
+            'save_s': t_save.elapsed, 
+            'update_save_s': t_update.elapsed, 
+            'disk_mb': os.path.getsize(pickle_path) / 2**20, 
+            **bench_cold_load('pickle', pickle_path),
+        })
+        
+        # native: raw index + append-only docstore
+        store.delete([d.metadata['id'] for d in extra_docs])
+        native_path = os.path.join(tmp, 'vectorstore')
+        with BenchTimer() as t_save:
+            vectorstore_save(store, path=native_path)
+        store.add_embeddings([(d.page_content, v) for d, v in zip(extra_docs, extra_vectors)], metadatas=[d.metadata for d in extra_docs], ids=[d.metadata['id'] for d in extra_docs])
+        with BenchTimer() as t_update:
+            vectorstore_save(store, path=native_path)
+        disk = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(native_path) for f in files)
+        results.append({
+            'format': 'native', 
+            'save_s': t_save.elapsed, 
+            'update_save_s': t_update.elapsed, 
+            'disk_mb': disk / 2**20, 
+            **bench_cold_load('native', native_path),
+        })
+    
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'persistence', results, vars(args))
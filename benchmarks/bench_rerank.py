@@ -0,0 +1,131 @@
+# module bench_rerank
+"""Rerank stage vs. the top k chunks as retrieved: context tokens, prompt size, answer latency and how often the chunk
+holding the answer is in the prompt
+
+    $ python benchmarks/bench_rerank.py --files 50 --questions 200 --budgets 0 512 1024
+
+The library is made of pages split with the app's chunk size and overlap, some files are uploaded twice under another name.
+A question asks about an identifier planted in one chunk and the words following it; answers are generated by the fake
+Ollama server, whose time before the first token grows with the prompt (--prompt_latency).
+"""
+
+# system
+import time
+import random
+import argparse
+
+# vector
+import faiss
+import numpy as np
+
+# ollama
+from ollama import Client as OllamaClient
+
+# langchain
+from langchain_community.vectorstores import FAISS
+from langchain.schema import Document
+
+# local
+from common import bench_percentile, bench_print_table, bench_write_json
+from fakes import FakeOllamaServer
+from fixtures import fixture_text
+from bench_retrieval import bench_bow_embedding
+from bm25 import BM25Index
+from llm import LLMBatchEmbeddings, llm_model_chat_stream
+from fileuploader import fu_split_documents, fu_count_tokens
+from ingest import INGEST_CHUNK_SIZE, INGEST_CHUNK_OVERLAP
+from vectorstore import VectorStoreDocstore, vectorstore_search
+from rerank import RERANK_FETCH_K, rerank_documents
+
+# constants
+BENCH_CODE = 'ZQ-{:05d}' # identifiers asked about, one per question
+
+
+def bench_make_library(files: int, pages: int, words_per_page: int, duplicates: float, dim: int, questions: int, seed: int = 0) -> tuple[FAISS, list[tuple[str, str]]]:
+    """Chunks of fixture pages with an identifier planted in some of them, a share of the files is stored twice
+
+    Returns:
+        tuple[FAISS, list[tuple[str, str]]]: vectorstore, questions and the identifier each one asks about
+    """
+    rng = random.Random(seed)
+    documents = []
+    for f in range(files):
+        pages_of_file = [Document(page_content=fixture_text(words_per_page, seed=f * 1000 + p), metadata={'source': f'file{f}.pdf', 'page': p}) for p in range(pages)]
+        documents += fu_split_documents(pages_of_file, INGEST_CHUNK_SIZE, INGEST_CHUNK_OVERLAP)
+    asked = []
+    for i, chunk in enumerate(rng.sample(documents, min(questions, len(documents)))):
+        code = BENCH_CODE.format(i)
+        words = chunk.page_content.split()
+        position = rng.randrange(len(words))
+        words.insert(position, code)
+        chunk.page_content = ' '.join(words)
+        asked.append((f'what does {code} say about {" ".join(words[position + 1:position + 4])}', code))
+    copies = [
+        Document(page_content=d.page_content, metadata={**d.metadata, 'source': f'copy-{d.metadata["source"]}', 'id': f'copy-{d.metadata["id"]}'})
+        for d in documents if int(d.metadata['source'][4:-4]) < files * duplicates
+    ]
+    documents += copies
+
+    vectors = np.stack([bench_bow_embedding(d.page_content, dim) for d in documents])
+    vectorStore = FAISS(LLMBatchEmbeddings(), faiss.IndexFlatL2(dim), VectorStoreDocstore(keywords=BM25Index()), {})
+    vectorStore.add_embeddings([(d.page_content, v) for d, v in zip(documents, vectors.tolist())], metadatas=[d.metadata for d in documents], ids=[d.metadata['id'] for d in documents])
+    return vectorStore, asked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--files', help='number of files', default=50, type=int)
+    parser.add_argument('--pages', help='pages per file', default=10, type=int)
+    parser.add_argument('--words_per_page', help='words per page', default=600, type=int)
+    parser.add_argument('--duplicates', help='share of files stored twice', default=0.2, type=float)
+    parser.add_argument('--dim', help='embedding dimension', default=256, type=int)
+    parser.add_argument('--questions', help='questions asked', default=200, type=int)
+    parser.add_argument('--k', help='chunks (passages) per prompt', default=5, type=int)
+    parser.add_argument('--fetch_k', help='chunks retrieved for reranking', default=RERANK_FETCH_K, type=int)
+    parser.add_argument('--budgets', help='context token budgets of the rerank stage (0 for no limit)', default=[0, 512, 1024], type=int, nargs='+')
+    parser.add_argument('--token_latency', help='seconds per generated token', default=0.002, type=float)
+    parser.add_argument('--prompt_latency', help='seconds per prompt character before the first token', default=0.0001, type=float)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    vectorStore, questions = bench_make_library(args.files, args.pages, args.words_per_page, args.duplicates, args.dim, args.questions)
+    server = FakeOllamaServer(token_latency=args.token_latency, prompt_latency=args.prompt_latency).start()
+    client = OllamaClient(server.base_url)
+
+    # baseline: top k chunks joined as they are retrieved
+    configs = [('top k', 0, 0)] + [('rerank', args.fetch_k, budget) for budget in args.budgets]
+    results = []
+    for name, fetch_k, budget in configs:
+        tokens, prompts, rerank_ms, answer_ms, found, duplicates = [], [], [], [], 0, 0
+        for question, code in questions:
+            vector = bench_bow_embedding(question, args.dim).tolist()
+            start = time.perf_counter()
+            documents = [doc for doc, _ in vectorstore_search(vectorStore, question, vector, fetch_k or args.k)]
+            if fetch_k:
+                stats = {}
+                rerank_start = time.perf_counter()
+                documents = rerank_documents(question, documents, args.k, budget, stats=stats)
+                rerank_ms.append((time.perf_counter() - rerank_start) * 1000)
+                duplicates += stats['duplicates']
+            context = '\n\n---\n\n'.join(doc.page_content for doc in documents)
+            prompt = f'{context}\n\n{question}'
+            ''.join(llm_model_chat_stream(prompt, client))
+            answer_ms.append((time.perf_counter() - start) * 1000)
+            tokens.append(fu_count_tokens(context))
+            prompts.append(len(prompt))
+            found += code in context
+        results.append({
+            'context': name,
+            'fetch_k': fetch_k or args.k,
+            'budget': budget or '-',
+            'context_tokens_p50': bench_percentile(tokens, 50),
+            'prompt_chars_p50': bench_percentile(prompts, 50),
+            'answer_in_context': found / len(questions),
+            'duplicates_per_q': duplicates / len(questions),
+            'rerank_p50_ms': bench_percentile(rerank_ms, 50) if rerank_ms else 0.0,
+            'answer_p50_ms': bench_percentile(answer_ms, 50),
+        })
+    server.stop()
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'rerank', results, vars(args))
@@ -0,0 +1,144 @@
+# module bench_retrieval
+"""Vector, keyword and hybrid retrieval: hit@k and p50/p95 query latency on a synthetic corpus with exact identifiers
+
+    $ python benchmarks/bench_retrieval.py --chunks 20000 --queries 200
+
+Embeddings are hashed bags of words that ignore tokens with digits, the way general-purpose embeddings blur
+part numbers and error codes. Identifier queries ask for a chunk by its code, topical queries by a few of its words.
+A hit is the chunk asked for among k results (identifier queries) or a top result on the chunk's topic (topical queries).
+Exits with 1 if the keyword index saved and loaded again ranks differently or still finds removed chunks.
+"""
+
+# system
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+
+# vector
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+# local
+from common import bench_check, bench_percentile, bench_print_table, bench_write_json
+from bm25 import BM25Index
+from llm import LLMBatchEmbeddings
+from vectorstore import VECTORSTORE_FETCH_K, VectorStoreDocstore, vectorstore_search, vectorstore_save, vectorstore_read
+
+# constants
+BENCH_WORDS = [f'{a}{b}' for a in ['ka', 'lo', 'mi', 'nu', 'pe', 'ri', 'so', 'tu', 'va', 'ze'] for b in ['bar', 'cel', 'dom', 'fin', 'gat', 'hul', 'jor', 'kim', 'lux', 'mor']]
+
+
+def bench_bow_embedding(text: str, dim: int) -> np.ndarray:
+    """Hashed bag of words without tokens containing digits, L2-normalized"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in text.lower().split():
+        if any(c.isdigit() for c in word): continue
+        vector[int.from_bytes(hashlib.md5(word.encode()).digest()[:4], 'little') % dim] += 1.0
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+def bench_make_corpus(n: int, topics: int, seed: int = 0) -> tuple[list[str], list[str], list[int]]:
+    """Chunks of topic words, each mentioning one unique identifier
+
+    Returns:
+        tuple[list[str], list[str], list[int]]: texts, identifiers, topic of every chunk
+    """
+    rng = random.Random(seed)
+    vocab = [rng.sample(BENCH_WORDS, 20) for _ in range(topics)]
+    texts, codes, labels = [], [], []
+    for i in range(n):
+        topic = rng.randrange(topics)
+        code = f'{chr(65 + rng.randrange(26))}{chr(65 + rng.randrange(26))}-{i:05d}-{chr(65 + rng.randrange(26))}'
+        words = rng.choices(vocab[topic], k=60)
+        words.insert(rng.randrange(len(words)), code)
+        texts.append(' '.join(words))
+        codes.append(code)
+        labels.append(topic)
+    return texts, codes, labels
+
+
+def bench_make_vectorstore(texts: list[str], vectors: np.ndarray) -> FAISS:
+    """In-memory FAISS object with a keyword-indexed docstore, like one loaded from disk"""
+    vectorStore = FAISS(LLMBatchEmbeddings(), faiss.IndexFlatL2(vectors.shape[1]), VectorStoreDocstore(keywords=BM25Index()), {})
+    ids = [f'chunk:0:{i}' for i in range(len(texts))]
+    vectorStore.add_embeddings(list(zip(texts, vectors.tolist())), metadatas=[{'id': id} for id in ids], ids=ids)
+    return vectorStore
+
+
+def bench_rankings(vectorStore: FAISS, queries: list[str], dim: int, k: int, fetch_k: int) -> list[list[tuple[str, float]]]:
+    """Keyword and hybrid results (id, score) of every query"""
+    rankings = []
+    for query in queries:
+        rankings.append(vectorStore.docstore.keywords.search(query, k))
+        rankings.append([(doc.metadata['id'], score) for doc, score in vectorstore_search(vectorStore, query, bench_bow_embedding(query, dim).tolist(), k, 'hybrid', fetch_k)])
+    return rankings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chunks', help='number of chunks', default=20000, type=int)
+    parser.add_argument('--topics', help='number of topics', default=50, type=int)
+    parser.add_argument('--dim', help='embedding dimension', default=256, type=int)
+    parser.add_argument('--queries', help='queries of each kind', default=200, type=int)
+    parser.add_argument('--k', help='documents per query', default=5, type=int)
+    parser.add_argument('--fetch_k', help='candidates per retriever in hybrid mode', default=VECTORSTORE_FETCH_K, type=int)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    texts, codes, labels = bench_make_corpus(args.chunks, args.topics)
+    start = time.perf_counter()
+    vectors = np.stack([bench_bow_embedding(text, args.dim) for text in texts])
+    vectorStore = bench_make_vectorstore(texts, vectors)
+    print(f'Indexed {args.chunks} chunks in {time.perf_counter() - start:.1f}s')
+
+    rng = random.Random(1)
+    targets = rng.sample(range(args.chunks), args.queries)
+    queries = {
+        'identifier': [(f'what is the status of {codes[i]}', i) for i in targets],
+        'topical': [(' '.join(rng.sample(texts[i].split(), 8)), i) for i in targets],
+    }
+
+    results = []
+    for kind, items in queries.items():
+        for retrieval in ['vector', 'keyword', 'hybrid']:
+            hits, latencies = 0, []
+            for query, target in items:
+                vector = bench_bow_embedding(query, args.dim).tolist()
+                start = time.perf_counter()
+                if retrieval == 'keyword': found = [id for id, _ in vectorStore.docstore.keywords.search(query, args.k)]
+                else: found = [doc.metadata['id'] for doc, _ in vectorstore_search(vectorStore, query, vector, args.k, retrieval, args.fetch_k)]
+                latencies.append((time.perf_counter() - start) * 1000)
+                if kind == 'identifier': hits += f'chunk:0:{target}' in found
+                else: hits += any(labels[int(id.rsplit(':', 1)[1])] == labels[target] for id in found[:1])
+            results.append({
+                'queries': kind,
+                'retrieval': retrieval,
+                f'hit@{args.k}': hits / len(items),
+                'p50_ms': bench_percentile(latencies, 50),
+                'p95_ms': bench_percentile(latencies, 95),
+            })
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'retrieval', results, vars(args))
+
+    # the keyword index is saved with the vectorstore and must rank the same once loaded, without removed chunks
+    # (until a save, document frequencies still count removed chunks, saving compacts the index in memory too)
+    removed = [f'chunk:0:{i}' for i in targets[::10]]
+    vectorStore.delete(removed)
+    texts = [query for items in queries.values() for query, _ in items]
+    before_save = bench_rankings(vectorStore, texts, args.dim, args.k, args.fetch_k)
+    with tempfile.TemporaryDirectory() as path:
+        expected = bench_rankings(vectorstore_save(vectorStore, path), texts, args.dim, args.k, args.fetch_k)
+        loaded = vectorstore_read(path, LLMBatchEmbeddings())
+        found = bench_rankings(loaded, texts, args.dim, args.k, args.fetch_k)
+        keywords = len(loaded.docstore.keywords)
+    bench_check({
+        'keyword index ranks the same after save and load': all(
+            [id for id, _ in a] == [id for id, _ in b] and np.allclose([score for _, score in a], [score for _, score in b], rtol=1e-5)
+            for a, b in zip(expected, found)
+        ),
+        'removed chunks are not found': keywords == args.chunks - len(removed) and not set(removed) & {id for ranking in before_save + found for id, _ in ranking},
+    })
@@ -0,0 +1,120 @@
+# module bench_shards
+"""Whole vs. sharded vectorstore: query latency over all documents and restricted to one, time to delete a file and save
+
+    $ python benchmarks/bench_shards.py --chunks 100000 --dim 256 --queries 100
+
+Exits with 1 if the shards, saved after the deletes and loaded again, hold other chunks than the whole index, find
+other nearest chunks, score keywords with other statistics, or if a search restricted to a file finds chunks of other files.
+The texts differ only in their chunk number, so keywords are checked with a query for one chunk and its BM25 score.
+"""
+
+# system
+import os
+import time
+import random
+import argparse
+import tempfile
+
+# vector
+import numpy as np
+
+# local
+from common import BenchTimer, bench_check, bench_percentile, bench_print_table, bench_write_json
+from bench_persistence import bench_make_store
+from vectorstore import *
+
+
+def bench_latency(search, vectors: np.ndarray) -> dict:
+    """Runs search for every query vector, returns p50/p95 latency in ms"""
+    latencies = []
+    for vector in vectors:
+        start = time.perf_counter()
+        search(vector.tolist())
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {'p50_ms': bench_percentile(latencies, 50), 'p95_ms': bench_percentile(latencies, 95)}
+
+
+def bench_found(search, vectors: np.ndarray) -> list[list[str]]:
+    """Runs search for every query vector, returns ids found"""
+    return [[doc.metadata['id'] for doc, _ in search(vector.tolist())] for vector in vectors]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chunks', help='number of chunks (100 per file)', default=100000, type=int)
+    parser.add_argument('--dim', help='embedding dimension', default=256, type=int)
+    parser.add_argument('--queries', help='queries per mode', default=100, type=int)
+    parser.add_argument('--k', help='documents per query', default=5, type=int)
+    parser.add_argument('--deletes', help='files deleted one by one', default=5, type=int)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    store, documents = bench_make_store(args.chunks, args.dim)
+    sources = sorted({d.metadata['source'] for d in documents})
+    rng = np.random.default_rng(1)
+    queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+    query = 'lorem ipsum chunk'
+    deleted = random.Random(1).sample(sources, min(args.deletes, len(sources)))
+    kept = [d.page_content.split()[1] for d in documents if d.metadata['source'] not in deleted]
+    keyword_queries = [f'chunk {number}' for number in random.Random(2).sample(kept, min(args.queries, len(kept)))]
+    results = []
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            # whole: one index, a delete saves all of it
+            whole = vectorstore_commit(store, path='whole')
+            # split before the deletes, so the shards delete the same files
+            shards = vectorstore_split(vectorstore_read('whole'))
+            for retrieval in VECTORSTORE_RETRIEVAL_MODES:
+                results.append({'layout': 'whole', 'retrieval': retrieval, 'search': 'all', **bench_latency(lambda v: vectorstore_search(whole, query, v, args.k, retrieval), queries)})
+            with BenchTimer() as t_delete:
+                for source in deleted:
+                    whole = vectorstore_commit(vectorstore_remove(vectorstore_writable(whole, 'whole'), [id for id in whole.index_to_docstore_id.values() if id.startswith(f'{source}:')]), path='whole')
+            delete_whole = t_delete.elapsed / len(deleted)
+
+            # the keyword index counts removed chunks until it is saved, so the shards are compared with the saved whole index
+            saved = vectorstore_read('whole')
+            whole_ids = sorted(saved.index_to_docstore_id.values())
+            whole_found = bench_found(lambda v: vectorstore_search(saved, query, v, args.k, 'vector'), queries)
+            whole_keywords = [saved.docstore.keywords.search(q, 1) for q in keyword_queries]
+
+            # sharded: the service fans out to the shards, a delete saves the shard of the file
+            vectorstore_commit_shards(shards, list(shards), path=VECTORSTORE_DIR)
+            service = VectorStoreService(embedding=store.embedding_function, writable=False)
+            for retrieval in VECTORSTORE_RETRIEVAL_MODES:
+                service.retrieval = retrieval
+                results.append({'layout': f'{len(service.shards)} shards', 'retrieval': retrieval, 'search': 'all', **bench_latency(lambda v: service.search(query, args.k, v), queries)})
+                results.append({'layout': f'{len(service.shards)} shards', 'retrieval': retrieval, 'search': '1 file', **bench_latency(lambda v: service.search(query, args.k, v, sources=sources[-1:]), queries)})
+            with BenchTimer() as t_delete:
+                for source in deleted:
+                    service.update([], [id for name in service.shards for id in service.shards[name].index_to_docstore_id.values() if id.startswith(f'{source}:')])
+            delete_sharded = t_delete.elapsed / len(deleted)
+
+            # the shards saved after the deletes, as another process loads them
+            service = VectorStoreService(embedding=store.embedding_function, writable=False)
+            sharded_ids = sorted(id for name in service.shards for id in service.shards[name].index_to_docstore_id.values())
+            service.retrieval = 'vector'
+            sharded_found = bench_found(lambda v: service.search(query, args.k, v), queries)
+            sharded_keywords = []
+            for q in keyword_queries:
+                stats = bm25_merge_stats([shard.docstore.keywords.stats(q) for shard in service.shards.values()])
+                sharded_keywords.append(max((shard.docstore.keywords.search(q, 1, stats=stats) for shard in service.shards.values()), key=lambda found: found[0][1] if found else 0.0))
+            service.retrieval = 'hybrid'
+            hybrid_found = [[doc.metadata['id'] for doc, _ in service.search(q, args.k, v.tolist())] for q, v in zip(keyword_queries, queries)]
+            one_file = bench_found(lambda v: service.search(query, args.k, v, sources=sources[-1:]), queries)
+        finally: os.chdir(cwd)
+
+    bench_print_table(results)
+    print(f'Delete a file and save: whole {delete_whole * 1000:.1f}ms, sharded {delete_sharded * 1000:.1f}ms ({delete_whole / delete_sharded:.1f}x)')
+    results.append({'layout': 'whole', 'delete_ms': delete_whole * 1000})
+    results.append({'layout': 'sharded', 'delete_ms': delete_sharded * 1000})
+    if args.json: bench_write_json(args.json, 'shards', results, vars(args))
+    bench_check({
+        'shards hold the chunks of the whole index': sharded_ids == whole_ids and not any(id.startswith(f'{source}:') for source in deleted for id in sharded_ids),
+        'shards find the same nearest chunks': sharded_found == whole_found,
+        'shards score keywords as the whole index': all(a[0][0] == b[0][0] and np.isclose(a[0][1], b[0][1], rtol=1e-5) for a, b in zip(whole_keywords, sharded_keywords)),
+        'hybrid search of the shards finds the chunk asked for': all(found[0][0] in ids for found, ids in zip(whole_keywords, hybrid_found)),
+        'search in a file finds only its chunks': all(id.startswith(f'{sources[-1]}:') for ids in one_file for id in ids) and all(one_file),
+    })
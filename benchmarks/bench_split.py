@@ -0,0 +1,109 @@
+# module bench_split
+"""Text splitter throughput (MB/s, chunks/s) and peak memory: langchain RecursiveCharacterTextSplitter vs. fu_split_text
+
+    $ python benchmarks/bench_split.py --mb 100 --page_kb 1024 --units chars tokens --fuzz 40000
+
+fu_split_text replaces the langchain splitter, so it must give the same chunks: on the benchmark pages and on --fuzz
+short random texts of separators, words and multi-byte characters with random chunk sizes. Exits with 1 on a mismatch.
+"""
+
+# system
+import random
+import argparse
+import tracemalloc
+
+# langchain
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# local
+from common import BenchTimer, bench_check, bench_print_table, bench_write_json
+from fixtures import fixture_text
+from ingest import INGEST_CHUNK_SIZE, INGEST_CHUNK_OVERLAP
+from fileuploader import fu_split_text, fu_iter_split_documents, fu_iter_document_ids, fu_get_length_function
+
+# constants
+BENCH_FUZZ_ALPHABET = ['a', 'b', 'c', 'xyz', ' ', '  ', '\t', '\n', '\n\n', '.', 'é', '🙂']
+
+
+def bench_langchain(pages: list[Document], chunk_size: int, chunk_overlap: int, unit: str) -> list[str]:
+    """Splitting and ids as done before fu_split_text"""
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=fu_get_length_function(unit) or len)
+    return [d.page_content for page in pages for d in fu_iter_document_ids(splitter.split_documents([page]))]
+
+
+def bench_native(pages: list[Document], chunk_size: int, chunk_overlap: int, unit: str) -> list[str]:
+    return [d.page_content for d in fu_iter_split_documents(pages, chunk_size, chunk_overlap, fu_get_length_function(unit))]
+
+
+def bench_fuzz(cases: int, units: list[str], seed: int = 0) -> list[tuple[str, int, int, str]]:
+    """Splits short random texts with random chunk sizes by both splitters
+
+    Returns:
+        list[tuple[str, int, int, str]]: cases whose chunks differ (text, chunk size, chunk overlap, unit)
+    """
+    rng = random.Random(seed)
+    mismatches = []
+    for case in range(cases):
+        text = ''.join(rng.choice(BENCH_FUZZ_ALPHABET) for _ in range(rng.randint(0, 400)))
+        chunk_size = rng.randint(1, 60)
+        chunk_overlap = rng.randint(0, chunk_size - 1)
+        unit = units[case % len(units)]
+        length_function = fu_get_length_function(unit)
+        expected = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=length_function or len).split_text(text)
+        if [text[start:end] for start, end in fu_split_text(text, chunk_size, chunk_overlap, length_function)] != expected:
+            mismatches.append((text, chunk_size, chunk_overlap, unit))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--mb', help='megabytes of text', default=20, type=int)
+    parser.add_argument('--page_kb', help='page size in KB (a TXT page is up to 1024)', default=64, type=int)
+    parser.add_argument('--chunk_size', help='chunk size', default=INGEST_CHUNK_SIZE, type=int)
+    parser.add_argument('--chunk_overlap', help='chunk overlap', default=INGEST_CHUNK_OVERLAP, type=int)
+    parser.add_argument('--units', help='chunk size units to test (tokens use a smaller chunk size)', default=['chars', 'tokens'], type=str, nargs='+')
+    parser.add_argument('--fuzz', help='random texts compared between the splitters', default=4000, type=int)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    # pages of paragraphs of a few sentences
+    words = args.page_kb * 1024 // 6
+    pages = []
+    while sum(len(p.page_content) for p in pages) < args.mb * 2**20:
+        text = fixture_text(words, seed=len(pages)).replace('. ', '.\n\n', words // 40).replace('. ', '.\n', words // 20)
+        pages.append(Document(page_content=text, metadata={'source': 'bench.txt', 'page': len(pages)}))
+    size = sum(len(p.page_content) for p in pages) / 2**20
+
+    results = []
+    for unit in args.units:
+        chunk_size, chunk_overlap = (args.chunk_size, args.chunk_overlap) if unit == 'chars' else (args.chunk_size // 4, args.chunk_overlap // 4)
+        reference = None
+        for splitter, function in [('langchain', bench_langchain), ('native', bench_native)]:
+            with BenchTimer() as t: chunks = function(pages, chunk_size, chunk_overlap, unit)
+            reference = reference or chunks
+            del chunks
+
+            # peak memory of splitting a single page, chunks are consumed as they are produced
+            tracemalloc.start()
+            if splitter == 'native': sum(1 for _ in fu_iter_split_documents(pages[:1], chunk_size, chunk_overlap, fu_get_length_function(unit)))
+            else: len(function(pages[:1], chunk_size, chunk_overlap, unit))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results.append({
+                'unit': unit,
+                'splitter': splitter,
+                'chunks': len(reference),
+                'mb_per_s': size / t.elapsed,
+                'chunks_per_s': len(reference) / t.elapsed,
+                'page_peak_mb': peak / 2**20,
+                'same_chunks': splitter == 'langchain' or reference == function(pages, chunk_size, chunk_overlap, unit),
+            })
+
+    mismatches = bench_fuzz(args.fuzz, args.units)
+    for text, chunk_size, chunk_overlap, unit in mismatches[:3]: print(f'mismatch: chunk_size={chunk_size} chunk_overlap={chunk_overlap} unit={unit} text={text!r}')
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'split', results, vars(args))
+    bench_check({'same chunks': all(row['same_chunks'] for row in results), f'same chunks on fuzzed texts ({len(mismatches)} of {args.fuzz} differ)': not mismatches})
@@ -0,0 +1,85 @@
+# module bench_storage
+"""Mongo ingest, lookup and load throughput: client per call with one ordered insert vs. shared client with chunked unordered bulk writes
+
+    $ python benchmarks/bench_storage.py --chunks 20000                                   # mongomock
+    $ python benchmarks/bench_storage.py --chunks 100000 --mongo_connect mongodb://localhost:27017/
+"""
+
+# system
+import argparse
+import itertools
+
+# db
+import pymongo
+
+# langchain
+from langchain.schema import Document
+
+# local
+from common import BenchTimer, bench_print_table, bench_write_json
+import storage
+from storage import StorageRepository, storage_get_client, storage_documents_to_dict, storage_iter_add_documents
+
+
+def bench_make_documents(n: int, chunks_per_file: int = 100) -> list[Document]:
+    return [
+        Document(page_content=f'chunk {i} ' + 'lorem ipsum ' * 60, metadata={'source': f'file{i // chunks_per_file}.pdf', 'page': i // 10, 'id': f'file{i // chunks_per_file}.pdf:{i // 10}:{i % 10}'}) 
+        for i in range(n)
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--chunks', help='number of chunks', default=20000, type=int)
+    parser.add_argument('--chunks_per_file', help='chunks per source', default=100, type=int)
+    parser.add_argument('--mongo_connect', help="mongo connect url, 'mongomock' for an in-process fake", default='mongomock', type=str)
+    parser.add_argument('--mongo_dbname', help='scratch database, dropped before and after', default='filechat_bench', type=str)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    # a fake server keeps one client, client creation is only measured against a real one
+    if args.mongo_connect == 'mongomock':
+        import mongomock
+        mock = mongomock.MongoClient()
+        storage.STORAGE_CLIENTS[args.mongo_connect] = mock
+        new_client = lambda: mock
+    else: new_client = lambda: pymongo.MongoClient(args.mongo_connect)
+    
+    documents = bench_make_documents(args.chunks, args.chunks_per_file)
+    sources = lambda: ((source, list(chunks)) for source, chunks in itertools.groupby(documents, key=lambda d: d.metadata['source']))
+    client = storage_get_client(args.mongo_connect)
+    results = []
+
+    # before: a client per call, one ordered insert of everything, lookups fetch whole documents
+    client.drop_database(args.mongo_dbname)
+    with BenchTimer() as t:
+        dbcol = new_client()[args.mongo_dbname]['documents']
+        dbcol.insert_many(storage_documents_to_dict(documents))
+    results.append({'path': 'client per call', 'op': 'ingest', 'seconds': t.elapsed, 'per_s': len(documents) / t.elapsed})
+    with BenchTimer() as t:
+        for source, _ in sources(): new_client()[args.mongo_dbname]['documents'].find_one({'metadata.source': source})
+    results.append({'path': 'client per call', 'op': 'lookup', 'seconds': t.elapsed, 'per_s': len(documents) / args.chunks_per_file / t.elapsed})
+    with BenchTimer() as t:
+        loaded = list(new_client()[args.mongo_dbname]['documents'].find({}))
+    results.append({'path': 'client per call', 'op': 'load', 'seconds': t.elapsed, 'per_s': len(loaded) / t.elapsed})
+
+    # after: shared client, repository with bulk writes, manifests and projections
+    client.drop_database(args.mongo_dbname)
+    for d in documents: d.metadata.pop('hash', None)
+    with BenchTimer() as t:
+        for _ in storage_iter_add_documents(sources(), args.mongo_connect, args.mongo_dbname, verbose=False): pass
+    results.append({'path': 'repository', 'op': 'ingest', 'seconds': t.elapsed, 'per_s': len(documents) / t.elapsed})
+    with BenchTimer() as t:
+        for _ in storage_iter_add_documents(sources(), args.mongo_connect, args.mongo_dbname, verbose=False): pass
+    results.append({'path': 'repository', 'op': 'ingest unchanged', 'seconds': t.elapsed, 'per_s': len(documents) / t.elapsed})
+    repository = StorageRepository(args.mongo_connect, args.mongo_dbname)
+    with BenchTimer() as t:
+        for source, _ in sources(): repository.find_manifest(source)
+    results.append({'path': 'repository', 'op': 'lookup', 'seconds': t.elapsed, 'per_s': len(documents) / args.chunks_per_file / t.elapsed})
+    with BenchTimer() as t:
+        loaded = list(repository.iter_documents())
+    results.append({'path': 'repository', 'op': 'load', 'seconds': t.elapsed, 'per_s': len(loaded) / t.elapsed})
+    client.drop_database(args.mongo_dbname)
+
+    bench_print_table(results)
+    if args.json: bench_write_json(args.json, 'storage', results, vars(args))
@@ -0,0 +1,196 @@
+# module bench_suite
+"""End-to-end benchmark suite, runs offline against the fake Ollama server and mongomock (or a local mongod)
+
+    $ python benchmarks/bench_suite.py --json baseline.json                                    # 1k and 100k chunks
+    $ python benchmarks/bench_suite.py --scales 1000 100000 1000000 --dim 256 --json full.json
+    $ python benchmarks/bench_compare.py baseline.json current.json
+
+Stages:
+    parse   files/s and pages/s per format (fileuploader, one process)
+    split   chunks/s and MB/s of the text splitter
+    ingest  files/s and chunks/s of a full ingest run: parse, split, store, embed and index
+    index   build, save and cold load time, RSS and disk size of a vectorstore per scale
+    query   p50/p95 search latency per scale and retrieval mode
+    startup import time of the app (-X importtime): the page shell and the modules imported while warming up
+"""
+
+# system
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+# vector
+import numpy as np
+
+# langchain
+from langchain.schema import Document
+from langchain_community.vectorstores import FAISS
+
+# local
+from common import BenchTimer, bench_percentile, bench_print_table, bench_write_json
+from fakes import FakeOllamaServer
+from fixtures import fixture_make_corpus, fixture_text
+from bench_ann import bench_make_vectors
+from bench_persistence import bench_cold_load
+import storage
+from llm import LLMBatchEmbeddings, llm_get_embedding_function
+from ingest import ingest_run, INGEST_CHUNK_SIZE, INGEST_CHUNK_OVERLAP
+from fileuploader import fu_iter_content_parallel, fu_iter_split_documents
+from vectorstore import VECTORSTORE_INDEX_TYPES, VECTORSTORE_RETRIEVAL_MODES, VectorStoreService, vectorstore_build_index, vectorstore_save, vectorstore_read, vectorstore_search
+
+# constants
+BENCH_STAGES = ['parse', 'split', 'ingest', 'index', 'query', 'startup']
+BENCH_SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+BENCH_STARTUP_PHASES = {
+    'shell': 'import main_filechat',
+    'warmup': 'import importlib, main_filechat; [importlib.import_module(m) for m in main_filechat.MAIN_MODULES]',
+}
+
+
+def bench_parse(dirpath: str, files: int, pages: int, words_per_page: int, formats: list[str]) -> list[dict]:
+    results = []
+    for fmt in formats:
+        paths = fixture_make_corpus(os.path.join(dirpath, fmt), files, pages, words_per_page, [fmt])
+        count = 0
+        with BenchTimer() as t:
+            for _, documents in fu_iter_content_parallel(paths, max_workers=1): count += sum(1 for _ in documents)
+        mb = sum(os.path.getsize(p) for p in paths) / 2**20
+        results.append({'stage': 'parse', 'case': fmt, 'seconds': t.elapsed, 'files_per_s': files / t.elapsed, 'pages_per_s': count / t.elapsed, 'mb_per_s': mb / t.elapsed})
+    return results
+
+
+def bench_split(pages: int, words_per_page: int) -> list[dict]:
+    documents = [Document(page_content=fixture_text(words_per_page, seed=p), metadata={'source': 'bench.txt', 'page': p}) for p in range(pages)]
+    mb = sum(len(d.page_content) for d in documents) / 2**20
+    with BenchTimer() as t:
+        chunks = sum(1 for _ in fu_iter_split_documents(documents, INGEST_CHUNK_SIZE, INGEST_CHUNK_OVERLAP))
+    return [{'stage': 'split', 'case': 'recursive', 'seconds': t.elapsed, 'chunks_per_s': chunks / t.elapsed, 'mb_per_s': mb / t.elapsed}]
+
+
+def bench_ingest(dirpath: str, files: int, pages: int, words_per_page: int, formats: list[str], base_url: str, mongo_connect: str) -> list[dict]:
+    paths = fixture_make_corpus(os.path.join(dirpath, 'ingest'), files, pages, words_per_page, formats, seed=1)
+    embedding = llm_get_embedding_function(base_url=base_url, cache_dir='')
+    mongo = {'mongo_connect': mongo_connect, 'mongo_dbname': 'filechat_bench', 'mongo_colname': 'documents'}
+    storage.storage_get_client(mongo_connect).drop_database(mongo['mongo_dbname'])
+
+    # the service works in the current directory
+    cwd = os.getcwd()
+    os.chdir(dirpath)
+    try:
+        with BenchTimer() as t:
+            counts = ingest_run(paths, VectorStoreService(**mongo, embedding=embedding), parse_workers=1, **mongo)
+    finally:
+        os.chdir(cwd)
+        storage.storage_get_client(mongo_connect).drop_database(mongo['mongo_dbname'])
+    return [{'stage': 'ingest', 'case': '+'.join(formats), 'seconds': t.elapsed, 'files_per_s': files / t.elapsed, 'chunks_per_s': counts['chunks_added'] / t.elapsed, 'errors': len(counts['errors'])}]
+
+
+def bench_importtime(code: str) -> tuple[float, float, list[tuple[str, float]]]:
+    """Runs code in a fresh interpreter with -X importtime
+
+    Returns:
+        tuple[float, float, list[tuple[str, float]]]: wall ms, import ms, (top level module, cumulative ms) slowest first
+    """
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=BENCH_SRC_DIR, capture_output=True, text=True, check=True).stderr
+    wall = (time.perf_counter() - start) * 1000
+
+    # "import time: self [us] | cumulative | imported package", nested imports are indented
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'): continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '): modules.append((name.strip(), int(cumulative) / 1000))
+    return wall, sum(ms for _, ms in modules), sorted(modules, key=lambda m: -m[1])
+
+
+def bench_startup(runs: int, top: int = 5) -> list[dict]:
+    """Import time of the app per phase, median of runs, prints the slowest top level imports"""
+    results = []
+    for phase, code in BENCH_STARTUP_PHASES.items():
+        samples = [bench_importtime(code) for _ in range(runs)]
+        wall, imports, modules = sorted(samples, key=lambda s: s[0])[len(samples) // 2]
+        results.append({'stage': 'startup', 'case': phase, 'wall_ms': wall, 'import_ms': imports})
+        print(f'{phase}: ' + ', '.join(f'{name} {ms:.0f}ms' for name, ms in modules[:top]))
+    return results
+
+
+def bench_make_store(n: int, dim: int) -> FAISS:
+    """Vectorstore of n chunks: a few hundred distinct texts, each chunk with its own identifier"""
+    texts = [fixture_text(60, seed=i) for i in range(min(n, 500))]
+    vectors = bench_make_vectors(n, dim)
+    ids = [f'file{i // 1000}.txt:{i // 10 % 100}:{i % 10}' for i in range(n)]
+    return FAISS.from_embeddings(
+        ((f'{texts[i % len(texts)]} REF-{i:07d}', vectors[i]) for i in range(n)),
+        LLMBatchEmbeddings(),
+        metadatas=[{'source': id.split(':')[0], 'id': id} for id in ids],
+        ids=ids,
+    )
+
+
+def bench_index_and_query(dirpath: str, n: int, dim: int, index_type: str, queries: int) -> list[dict]:
+    path = os.path.join(dirpath, f'vectorstore-{n}')
+    with BenchTimer() as t_build:
+        vectorStore = vectorstore_build_index(bench_make_store(n, dim), index_type)
+    with BenchTimer() as t_save:
+        vectorstore_save(vectorStore, path)
+    del vectorStore
+    disk = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    results = [{'stage': 'index', 'case': index_type, 'chunks': n, 'build_s': t_build.elapsed, 'save_s': t_save.elapsed, 'disk_mb': disk / 2**20, **bench_cold_load('native', path)}]
+
+    vectorStore = vectorstore_read(path, LLMBatchEmbeddings())
+    rng = random.Random(0)
+    vectors = bench_make_vectors(queries, dim, seed=1)
+    words = [f'{fixture_text(5, seed=rng.randrange(500))} REF-{rng.randrange(n):07d}' for _ in range(queries)]
+    for retrieval in VECTORSTORE_RETRIEVAL_MODES:
+        latencies = []
+        for text, vector in zip(words, vectors):
+            start = time.perf_counter()
+            vectorstore_search(vectorStore, text, vector.tolist(), 5, retrieval)
+            latencies.append((time.perf_counter() - start) * 1000)
+        results.append({'stage': 'query', 'case': f'{index_type}/{retrieval}', 'chunks': n, 'p50_ms': bench_percentile(latencies, 50), 'p95_ms': bench_percentile(latencies, 95)})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--stages', help='stages to run', default=BENCH_STAGES, choices=BENCH_STAGES, nargs='+')
+    parser.add_argument('--scales', help='library sizes in chunks (index, query)', default=[1000, 100000], type=int, nargs='+')
+    parser.add_argument('--dim', help='embedding dimension (index, query)', default=256, type=int)
+    parser.add_argument('--index_type', help='vector index type (index, query)', default='flat', choices=VECTORSTORE_INDEX_TYPES, type=str)
+    parser.add_argument('--queries', help='queries per scale and retrieval mode', default=200, type=int)
+    parser.add_argument('--files', help='files per format (parse, ingest)', default=8, type=int)
+    parser.add_argument('--pages', help='pages per file', default=10, type=int)
+    parser.add_argument('--words_per_page', help='words per page', default=400, type=int)
+    parser.add_argument('--formats', help='file formats', default=['pdf', 'docx', 'odt', 'txt'], type=str, nargs='+')
+    parser.add_argument('--startup_runs', help='interpreter runs per phase (startup)', default=3, type=int)
+    parser.add_argument('--mongo_connect', help="mongo connect url, 'mongomock' for an in-process fake", default='mongomock', type=str)
+    parser.add_argument('--json', help='write results to file', default='', type=str)
+    args = parser.parse_args()
+
+    if args.mongo_connect == 'mongomock':
+        import mongomock
+        storage.STORAGE_CLIENTS[args.mongo_connect] = mongomock.MongoClient()
+
+    results = []
+    server = FakeOllamaServer(latency=0.001, item_latency=0.0001, dim=args.dim).start()
+    with tempfile.TemporaryDirectory() as dirpath:
+        if 'parse' in args.stages: results += bench_parse(dirpath, args.files, args.pages, args.words_per_page, args.formats)
+        if 'split' in args.stages: results += bench_split(args.files * args.pages, args.words_per_page)
+        if 'ingest' in args.stages: results += bench_ingest(dirpath, args.files * len(args.formats), args.pages, args.words_per_page, args.formats, server.base_url, args.mongo_connect)
+        if 'index' in args.stages or 'query' in args.stages:
+            for n in args.scales:
+                rows = bench_index_and_query(dirpath, n, args.dim, args.index_type, args.queries)
+                results += [row for row in rows if row['stage'] in args.stages]
+                print(f'{n} chunks done')
+    server.stop()
+    if 'startup' in args.stages: results += bench_startup(args.startup_runs)
+
+    # stages report different metrics, one table each
+    for stage in BENCH_STAGES:
+        bench_print_table([row for row in results if row['stage'] == stage])
+    if args.json: bench_write_json(args.json, 'suite', results, vars(args))
@@ -0,0 +1,88 @@
+# module common
+
+# system
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+# make 'src' modules importable the same way main_filechat.py sees them
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+if SRC_DIR not in sys.path: sys.path.insert(0, SRC_DIR)
+
+
+class BenchTimer:
+    """Context manager measuring wall time in seconds"""
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        return self
+    
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def bench_percentile(values: list[float], q: float) -> float:
+    """Returns q-th percentile (0..100) using nearest rank
+
+    Args:
+        values (list[float]): samples
+        q (float): percentile
+
+    Returns:
+        float: percentile value, 0 if no samples
+    """
+    if not values: return 0.0
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def bench_check(checks: dict[str, bool]):
+    """Exits with 1 listing the checks that failed, so a benchmark also guards the behaviour it measures
+
+    Args:
+        checks (dict[str, bool]): check name => passed
+    """
+    failed = [name for name, passed in checks.items() if not passed]
+    if failed: sys.exit('failed checks: ' + ', '.join(failed))
+
+
+def bench_print_table(rows: list[dict]):
+    """Prints rows as an aligned table
+
+    Args:
+        rows (list[dict]): rows with the same keys
+    """
+    if not rows: return
+    keys = list(rows[0].keys())
+    cells = [[f'{row[k]:.3f}' if isinstance(row[k], float) else str(row[k]) for k in keys] for row in rows]
+    widths = [max(len(k), *(len(c[i]) for c in cells)) for i, k in enumerate(keys)]
+    print('  '.join(k.ljust(w) for k, w in zip(keys, widths)))
+    for c in cells: print('  '.join(v.ljust(w) for v, w in zip(c, widths)))
+
+
+def bench_write_json(path: str, name: str, results: list[dict], params: dict = None):
+    """Writes benchmark results to JSON so runs can be compared between commits
+
+    Args:
+        path (str): output file
+        name (str): benchmark name
+        results (list[dict]): result rows
+        params (dict, optional): benchmark parameters. Defaults to None.
+    """
+    try: commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=SRC_DIR).stdout.strip()
+    except OSError: commit = ''
+    with open(path, 'w') as f:
+        json.dump({
+            'benchmark': name,
+            'commit': commit,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': params or {},
+            'results': results,
+        }, f, indent=2)
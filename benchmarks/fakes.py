@@ -0,0 +1,167 @@
+# module fakes
+
+# system
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def fake_embedding(text: str, dim: int = 256) -> list[float]:
+    """Deterministic pseudo-embedding of a text (same text => same unit vector)
+
+    Args:
+        text (str): text
+        dim (int, optional): dimension. Defaults to 256.
+
+    Returns:
+        list[float]: L2-normalized vector
+    """
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dim)]
+    norm = sum(x * x for x in vector) ** 0.5 or 1.0
+    return [x / norm for x in vector]
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """Local stand-in for the Ollama HTTP API
+
+    Latency model: every request costs 'latency' seconds plus 'item_latency' per embedded text 
+    or 'token_latency' per generated token (plus 'prompt_latency' per prompt character before the first token),
+    at most 'parallel' requests are served at once (like OLLAMA_NUM_PARALLEL) and, if 'max_queue' is set, chat requests
+    beyond 'max_queue' waiting ones are refused with 503 (like OLLAMA_MAX_QUEUE).
+    Chat answers are deterministic: the answer tokens are derived from the prompt.
+    """
+    daemon_threads = True
+    
+    def __init__(
+        self, 
+        port: int = 0, 
+        dim: int = 256, 
+        latency: float = 0.005, 
+        item_latency: float = 0.001, 
+        parallel: int = 4, 
+        legacy: bool = False,
+        token_latency: float = 0.002,
+        prompt_latency: float = 0.00001,
+        answer_tokens: int = 50,
+        max_queue: int = None,
+    ):
+        super().__init__(('127.0.0.1', port), FakeOllamaHandler)
+        self.dim = dim
+        self.latency = latency
+        self.item_latency = item_latency
+        self.legacy = legacy
+        self.token_latency = token_latency
+        self.prompt_latency = prompt_latency
+        self.answer_tokens = answer_tokens
+        self.max_queue = max_queue
+        self.prompt_chars = 0
+        self.parallel = parallel
+        self.slots = threading.Semaphore(parallel)
+        self.requests = 0
+        self.connections = 0   # tcp connections accepted, fewer than requests with keep-alive
+        self.chats = 0         # chat requests in progress or waiting for a slot
+        self.peak_chats = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self) -> 'FakeOllamaServer':
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock: self.server.connections += 1
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        server.requests += 1
+        
+        if self.path == '/api/embed' and not server.legacy:
+            texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+            with server.slots:
+                time.sleep(server.latency + server.item_latency * len(texts))
+                self.send_json({'model': body.get('model'), 'embeddings': [fake_embedding(t, server.dim) for t in texts]})
+        elif self.path == '/api/embeddings':
+            with server.slots:
+                time.sleep(server.latency + server.item_latency)
+                self.send_json({'embedding': fake_embedding(body['prompt'], server.dim)})
+        elif self.path == '/api/chat':
+            with server.lock:
+                if server.max_queue is not None and server.chats >= server.max_queue + server.parallel:
+                    server.refused += 1
+                    refused = True
+                else:
+                    server.chats += 1
+                    server.peak_chats = max(server.peak_chats, server.chats)
+                    refused = False
+            if refused:
+                self.send_json({'error': 'server busy, please try again. maximum pending requests exceeded'}, status=503)
+                return
+            try:
+                with server.slots: self.send_chat(body)
+            except (BrokenPipeError, ConnectionResetError): pass # client went away mid-stream
+            finally:
+                with server.lock: server.chats -= 1
+        else:
+            self.send_json({'error': 'not found'}, status=404)
+
+    def send_chat(self, body: dict):
+        server = self.server
+        prompt = ' '.join(m.get('content', '') for m in body.get('messages', []))
+        server.prompt_chars += len(prompt)
+        words = prompt.split() or ['empty']
+        tokens = [words[i * 7919 % len(words)] + ' ' for i in range(server.answer_tokens)]
+        time.sleep(server.latency + server.prompt_latency * len(prompt))
+        
+        done = {'model': body.get('model'), 'done': True, 'eval_count': len(tokens), 'prompt_eval_count': len(prompt) // 4}
+        if not body.get('stream', True):
+            time.sleep(server.token_latency * len(tokens))
+            self.send_json({**done, 'message': {'role': 'assistant', 'content': ''.join(tokens)}})
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        start = time.perf_counter()
+        for token in tokens:
+            time.sleep(server.token_latency)
+            self.send_chunk({'model': body.get('model'), 'done': False, 'message': {'role': 'assistant', 'content': token}})
+        self.send_chunk({**done, 'message': {'role': 'assistant', 'content': ''}, 'eval_duration': int((time.perf_counter() - start) * 1e9)})
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_chunk(self, payload: dict):
+        data = json.dumps(payload).encode() + b'\n'
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def send_json(self, payload: dict, status: int = 200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
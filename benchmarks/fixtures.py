@@ -0,0 +1,115 @@
+# module fixtures
+
+# system
+import os
+import random
+import textwrap
+
+# documents
+import docx
+from odf.opendocument import OpenDocumentText
+from odf import text as odfText
+
+# deterministic vocabulary with identifiers like part numbers and error codes
+FIXTURE_WORDS = (
+    'the of and to in is that for it as with was on be by this are from or have an which not but at all were when we there can been one '
+    'system pressure valve pump motor sensor controller voltage current temperature maintenance procedure inspection replacement '
+    'warning caution clause contract party agreement liability payment schedule delivery warranty termination notice section'
+).split()
+
+
+def fixture_text(words: int, seed: int = 0) -> str:
+    """Deterministic pseudo-text with sentences and identifiers
+
+    Args:
+        words (int): number of words
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        str: text
+    """
+    rng = random.Random(seed)
+    out = []
+    for i in range(words):
+        if rng.random() < 0.02: word = f'{rng.choice("ABCDEFGH")}{rng.choice("KLMNPRST")}-{rng.randint(1000, 9999)}'
+        else: word = rng.choice(FIXTURE_WORDS)
+        out.append(word.capitalize() if not out or out[-1].endswith('.') else word)
+        if rng.random() < 0.08: out[-1] += '.'
+    return ' '.join(out) + '.'
+
+
+def fixture_write_pdf(path: str, pages: list[str]):
+    """Writes a minimal text PDF, one string per page
+
+    Args:
+        path (str): output file
+        pages (list[str]): page texts
+    """
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for text in pages:
+        lines = textwrap.wrap(text, 90) or ['']
+        escaped = [line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') for line in lines]
+        stream = 'BT /F1 10 Tf 12 TL 40 800 Td ' + ' '.join(f'({line}) Tj T*' for line in escaped) + ' ET'
+        objects.append(f'<< /Length {len(stream.encode("latin-1", "replace"))} >>\nstream\n{stream}\nendstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>')
+        kids.append(f'{len(objects)} 0 R')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {len(kids)} >>'
+    
+    data = b'%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(data))
+        data += f'{i + 1} 0 obj\n{obj}\nendobj\n'.encode('latin-1', 'replace')
+    xref = len(data)
+    data += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    data += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    data += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    with open(path, 'wb') as f: f.write(data)
+
+
+def fixture_write_docx(path: str, paragraphs: list[str]):
+    document = docx.Document()
+    for paragraph in paragraphs: document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def fixture_write_odt(path: str, paragraphs: list[str]):
+    document = OpenDocumentText()
+    for paragraph in paragraphs: document.text.addElement(odfText.P(text=paragraph))
+    document.save(path)
+
+
+def fixture_write_txt(path: str, paragraphs: list[str]):
+    with open(path, 'w') as f: f.write('\n\n'.join(paragraphs))
+
+
+def fixture_make_corpus(dirpath: str, files: int = 10, pages: int = 10, words_per_page: int = 400, formats: list[str] = ['pdf', 'docx', 'odt', 'txt'], seed: int = 0) -> list[str]:
+    """Writes a fixture corpus, formats are assigned round-robin
+
+    Args:
+        dirpath (str): output directory
+        files (int, optional): number of files. Defaults to 10.
+        pages (int, optional): pages per file (paragraph groups for docx/odt/txt). Defaults to 10.
+        words_per_page (int, optional): words per page. Defaults to 400.
+        formats (list[str], optional): file formats. Defaults to ['pdf', 'docx', 'odt', 'txt'].
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        list[str]: file paths
+    """
+    os.makedirs(dirpath, exist_ok=True)
+    paths = []
+    for i in range(files):
+        ext = formats[i % len(formats)]
+        path = os.path.join(dirpath, f'doc{i:05d}.{ext}')
+        page_texts = [fixture_text(words_per_page, seed=seed * 1000003 + i * 1009 + p) for p in range(pages)]
+        if ext == 'pdf': 
+            fixture_write_pdf(path, page_texts)
+        else:
+            # split pages into paragraphs of a few sentences, like real documents
+            paragraphs = [s.strip() + '.' for text in page_texts for s in text.split('. ') if s.strip()]
+            paragraphs = [' '.join(paragraphs[j:j + 3]) for j in range(0, len(paragraphs), 3)]
+            {'docx': fixture_write_docx, 'odt': fixture_write_odt, 'txt': fixture_write_txt}[ext](path, paragraphs)
+        paths.append(path)
+    return paths
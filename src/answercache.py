@@ -0,0 +1,190 @@
+# module answercache
+
+# system
+import time
+import hashlib
+import threading
+import collections
+
+# vector
+import numpy as np
+
+# langchain
+from langchain.schema import Document
+
+# local
+from metrics import metrics_count
+
+# constants
+ANSWERCACHE_MAX_ENTRIES = 1024
+ANSWERCACHE_TTL = 24 * 3600   # seconds
+ANSWERCACHE_THRESHOLD = 0.95  # cosine similarity of questions sharing an answer
+
+
+class AnswerCache:
+    """In-memory cache of LLM answers for repeated and near-duplicate questions
+
+    Answers are grouped by (model, prompt template, retrieved chunks), a question gets a cached answer of its group if their embeddings are
+    at least 'threshold' cosine-similar. Chunks are identified by id and content, so once a chunk changes or is removed
+    the questions it answered retrieve a different group and its answers are never served again (they expire by TTL/LRU).
+    The template keeps apart answers of the same chunks asked in different ways, e.g. a question to the LLM alone and
+    a question to the knowledge base that retrieved nothing.
+    """
+
+    def __init__(self, max_entries: int = ANSWERCACHE_MAX_ENTRIES, ttl: float = ANSWERCACHE_TTL, threshold: float = ANSWERCACHE_THRESHOLD):
+        """Creates cache
+
+        Args:
+            max_entries (int, optional): number of answers kept, least recently used are evicted. Defaults to ANSWERCACHE_MAX_ENTRIES.
+            ttl (float, optional): seconds an answer is kept. Defaults to ANSWERCACHE_TTL.
+            threshold (float, optional): minimum cosine similarity of questions. Defaults to ANSWERCACHE_THRESHOLD.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = collections.OrderedDict() # (model, template, context, question) => {'vector', 'answer', 'created'}, least recently used first
+        self.groups = {}                         # (model, template, context) => keys of its entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def context_key(documents: list[Document]) -> str:
+        """Returns key of a set of retrieved chunks
+
+        Args:
+            documents (list[Document]): retrieved documents
+
+        Returns:
+            str: sha256 hex digest of sorted (id, content hash) pairs, order of retrieval does not matter
+        """
+        chunks = sorted(f'{d.metadata.get("id")}\0{hashlib.sha256(d.page_content.encode("utf-8", errors="surrogatepass")).hexdigest()}' for d in documents)
+        return hashlib.sha256('\n'.join(chunks).encode('utf-8', errors='surrogatepass')).hexdigest()
+
+    @staticmethod
+    def group_key(model: str, template: str, documents: list[Document]) -> tuple[str, str, str]:
+        """Returns key of the answers of a model, prompt template and set of retrieved chunks
+
+        Args:
+            model (str): model name
+            template (str): prompt template
+            documents (list[Document]): retrieved documents
+
+        Returns:
+            tuple[str, str, str]: model, sha256 hex digest of the template, context key
+        """
+        return model, hashlib.sha256(template.encode('utf-8', errors='surrogatepass')).hexdigest(), AnswerCache.context_key(documents)
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        """Normalizes question so that case and whitespace differences are exact matches
+
+        Args:
+            question (str): question
+
+        Returns:
+            str: normalized question
+        """
+        return ' '.join(question.lower().split())
+
+    def get(self, model: str, question: str, vector: list[float], documents: list[Document], template: str = '') -> str | None:
+        """Looks up answer
+
+        Args:
+            model (str): model name
+            question (str): question
+            vector (list[float]): question embedding
+            documents (list[Document]): documents retrieved for the question
+            template (str, optional): prompt template the question is asked with. Defaults to ''.
+
+        Returns:
+            str | None: answer or None on a miss
+        """
+        group = self.group_key(model, template, documents)
+        exact = (*group, self.normalize(question))
+        with self.lock:
+            self.expire()
+
+            # same question first, then the most similar one of the group
+            key = exact if exact in self.entries else None
+            if key is None and group in self.groups:
+                keys = list(self.groups[group])
+                similarities = np.stack([self.entries[k]['vector'] for k in keys]) @ self.unit(vector)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold: key = keys[best]
+
+            if key is None:
+                self.misses += 1
+                metrics_count('filechat_cache_requests_total', cache='answer', result='miss')
+                return None
+            self.hits += 1
+            metrics_count('filechat_cache_requests_total', cache='answer', result='hit')
+            self.entries.move_to_end(key)
+            return self.entries[key]['answer']
+
+    def put(self, model: str, question: str, vector: list[float], documents: list[Document], answer: str, template: str = ''):
+        """Stores answer, evicts least recently used answers if the cache is full
+
+        Args:
+            model (str): model name
+            question (str): question
+            vector (list[float]): question embedding
+            documents (list[Document]): documents the answer is based on
+            answer (str): answer
+            template (str, optional): prompt template the question was asked with. Defaults to ''.
+        """
+        if self.max_entries <= 0: return
+        group = self.group_key(model, template, documents)
+        key = (*group, self.normalize(question))
+        with self.lock:
+            self.entries[key] = {'vector': self.unit(vector), 'answer': answer, 'created': time.monotonic()}
+            self.entries.move_to_end(key)
+            self.groups.setdefault(group, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def expire(self):
+        """Removes answers older than TTL, must be called with the lock held"""
+        deadline = time.monotonic() - self.ttl
+        for key in [k for k, entry in self.entries.items() if entry['created'] < deadline]:
+            self.remove(key)
+
+    def remove(self, key: tuple):
+        """Removes answer, must be called with the lock held
+
+        Args:
+            key (tuple): (model, template, context, question)
+        """
+        del self.entries[key]
+        group = self.groups[key[:3]]
+        group.discard(key)
+        if not group: del self.groups[key[:3]]
+
+    def clear(self):
+        """Removes all answers"""
+        with self.lock:
+            self.entries.clear()
+            self.groups.clear()
+
+    @staticmethod
+    def unit(vector: list[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def stats(self) -> dict:
+        """Returns cache counters
+
+        Returns:
+            dict: {'hits', 'misses', 'hit_ratio', 'evictions', 'entries'}
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+            }
@@ -0,0 +1,248 @@
+# module bm25
+
+# system
+import os
+import re
+import json
+import math
+import array
+import collections
+
+# vector
+import numpy as np
+
+# constants
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_TOKEN = re.compile(r'\w+(?:[-./:]\w+)*') # keeps identifiers like 'XK-4471-B', '3.2.1' or 'E:42' whole
+BM25_SEPARATOR = re.compile(r'[-./:]')
+
+
+def bm25_tokenize(text: str) -> list[str]:
+    """Splits text into lowercase terms, identifiers are indexed whole and by their parts
+
+    Args:
+        text (str): text
+
+    Returns:
+        list[str]: terms
+    """
+    terms = []
+    for token in BM25_TOKEN.findall(text.lower()):
+        terms.append(token)
+        if BM25_SEPARATOR.search(token): terms += BM25_SEPARATOR.split(token)
+    return terms
+
+
+def bm25_merge_stats(stats: list[dict]) -> dict:
+    """Sums collection statistics of several indexes, so their documents are scored as if they were in one index
+
+    Args:
+        stats (list[dict]): statistics of each index, see BM25Index.stats
+
+    Returns:
+        dict: merged statistics
+    """
+    df = collections.Counter()
+    for s in stats: df.update(s['df'])
+    return {'documents': sum(s['documents'] for s in stats), 'length': sum(s['length'] for s in stats), 'df': dict(df)}
+
+
+class BM25Index:
+    """Okapi BM25 keyword index
+
+    Postings saved by the last save() are kept in compressed sparse rows (memory-mapped when loaded),
+    documents added since then are kept in a dict, removed documents are masked until the next save.
+    """
+
+    def __init__(self):
+        """Creates an empty index"""
+        self.ids = []              # document number => id
+        self.numbers = {}          # id => document number
+        self.lengths = array.array('f')
+        self.alive = array.array('f')
+        self.total_length = 0.0
+        self.vocab = {}            # term => row of saved postings
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.docs = np.zeros(0, dtype=np.int32)
+        self.tfs = np.zeros(0, dtype=np.uint16)
+        self.delta = {}            # term => {document number: term frequency}
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def add(self, id: str, text: str):
+        """Adds document, replaces a document with the same id
+
+        Args:
+            id (str): document id
+            text (str): document text
+        """
+        if id in self.numbers: self.remove([id])
+        terms = bm25_tokenize(text)
+        number = len(self.ids)
+        self.ids.append(id)
+        self.numbers[id] = number
+        self.lengths.append(len(terms))
+        self.alive.append(1.0)
+        self.total_length += len(terms)
+        for term, tf in collections.Counter(terms).items():
+            self.delta.setdefault(term, {})[number] = tf
+
+    def remove(self, ids: list[str]):
+        """Removes documents, unknown ids are ignored
+
+        Args:
+            ids (list[str]): document ids
+        """
+        for id in ids:
+            number = self.numbers.pop(id, None)
+            if number is None: continue
+            self.alive[number] = 0.0
+            self.total_length -= self.lengths[number]
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """Returns documents containing a term (removed ones included)
+
+        Args:
+            term (str): term
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: document numbers, term frequencies
+        """
+        docs, tfs = [], []
+        row = self.vocab.get(term)
+        if row is not None:
+            docs.append(self.docs[self.offsets[row]:self.offsets[row + 1]])
+            tfs.append(self.tfs[self.offsets[row]:self.offsets[row + 1]].astype(np.float32))
+        delta = self.delta.get(term)
+        if delta:
+            docs.append(np.fromiter(delta.keys(), dtype=np.int32, count=len(delta)))
+            tfs.append(np.fromiter(delta.values(), dtype=np.float32, count=len(delta)))
+        if not docs: return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        return np.concatenate(docs), np.concatenate(tfs)
+
+    def stats(self, query: str) -> dict:
+        """Returns collection statistics of query terms, see bm25_merge_stats
+
+        Args:
+            query (str): query text
+
+        Returns:
+            dict: {'documents', 'length' (total terms), 'df' (term => documents containing it, removed ones included)}
+        """
+        df = {}
+        for term in set(bm25_tokenize(query)):
+            row = self.vocab.get(term)
+            df[term] = (int(self.offsets[row + 1] - self.offsets[row]) if row is not None else 0) + len(self.delta.get(term, ()))
+        return {'documents': len(self.numbers), 'length': self.total_length, 'df': df}
+
+    def search(self, query: str, k: int = 5, ids: list[str] = None, stats: dict = None) -> list[tuple[str, float]]:
+        """Finds documents best matching query terms
+
+        Args:
+            query (str): query text
+            k (int, optional): number of documents. Defaults to 5.
+            ids (list[str], optional): search only these documents. Defaults to None (all).
+            stats (dict, optional): collection statistics to score with, see stats(). Defaults to None (of this index).
+
+        Returns:
+            list[tuple[str, float]]: document ids and their BM25 score, best first
+        """
+        if not self.numbers: return []
+        stats = stats or self.stats(query)
+        n = stats['documents']
+        lengths = np.frombuffer(self.lengths, dtype=np.float32)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / (stats['length'] / n or 1.0))
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(bm25_tokenize(query)):
+            docs, tfs = self.postings(term)
+            if not len(docs): continue
+            # document frequency counts removed documents until the next save, close enough for ranking
+            df = stats['df'].get(term, len(docs))
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            scores[docs] += idf * tfs * (BM25_K1 + 1) / (tfs + norm[docs])
+        scores *= np.frombuffer(self.alive, dtype=np.float32)
+        if ids is not None:
+            allowed = np.zeros(len(self.ids), dtype=np.float32)
+            allowed[[self.numbers[id] for id in ids if id in self.numbers]] = 1.0
+            scores *= allowed
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+    def save(self, path: str):
+        """Writes index to a directory and compacts it: pending documents are merged, removed ones are dropped
+
+        Args:
+            path (str): directory
+
+        Note:
+            files: 'bm25-vocab.json' (terms), 'bm25-ids.json' (document ids), 'bm25-offsets.npy', 'bm25-docs.npy', 'bm25-tfs.npy'
+            (postings of term i are docs[offsets[i]:offsets[i + 1]]), 'bm25-lengths.npy' (terms per document)
+        """
+        # renumber live documents
+        alive = np.frombuffer(self.alive, dtype=np.float32) > 0
+        renumber = np.full(len(self.ids), -1, dtype=np.int64)
+        renumber[alive] = np.arange(int(alive.sum()))
+
+        # merge saved and pending postings as (row, document, tf) triples
+        terms = list(self.vocab)
+        for term in self.delta:
+            if term not in self.vocab: terms.append(term)
+        rows = {term: i for i, term in enumerate(terms)}
+        base_rows = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        delta_rows = np.fromiter((rows[term] for term, postings in self.delta.items() for _ in postings), dtype=np.int64)
+        delta_docs = np.fromiter((number for postings in self.delta.values() for number in postings), dtype=np.int64)
+        delta_tfs = np.fromiter((tf for postings in self.delta.values() for tf in postings.values()), dtype=np.int64)
+        all_rows = np.concatenate([base_rows, delta_rows])
+        all_docs = renumber[np.concatenate([self.docs.astype(np.int64), delta_docs])]
+        all_tfs = np.concatenate([self.tfs.astype(np.int64), delta_tfs])
+        keep = all_docs >= 0
+        all_rows, all_docs, all_tfs = all_rows[keep], all_docs[keep], all_tfs[keep]
+        order = np.lexsort((all_docs, all_rows))
+
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(all_rows, minlength=len(terms)))]).astype(np.int64)
+        self.docs = all_docs[order].astype(np.int32)
+        self.tfs = np.minimum(all_tfs[order], np.iinfo(np.uint16).max).astype(np.uint16)
+        self.vocab = rows
+        self.delta = {}
+        self.ids = [id for id, live in zip(self.ids, alive) if live]
+        self.numbers = {id: i for i, id in enumerate(self.ids)}
+        self.lengths = array.array('f', np.frombuffer(self.lengths, dtype=np.float32)[alive].tobytes())
+        self.alive = array.array('f', [1.0]) * len(self.ids)
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'bm25-vocab.json'), 'w') as f: json.dump(terms, f)
+        with open(os.path.join(path, 'bm25-ids.json'), 'w') as f: json.dump(self.ids, f)
+        np.save(os.path.join(path, 'bm25-offsets.npy'), self.offsets)
+        np.save(os.path.join(path, 'bm25-docs.npy'), self.docs)
+        np.save(os.path.join(path, 'bm25-tfs.npy'), self.tfs)
+        np.save(os.path.join(path, 'bm25-lengths.npy'), np.frombuffer(self.lengths, dtype=np.float32))
+
+    @staticmethod
+    def load(path: str, memory_map: bool = True) -> 'BM25Index | None':
+        """Reads index written by save()
+
+        Args:
+            path (str): directory
+            memory_map (bool, optional): memory-map postings. Defaults to True.
+
+        Returns:
+            BM25Index | None: index or None if nothing was saved
+        """
+        if not os.path.exists(os.path.join(path, 'bm25-ids.json')): return None
+        mode = 'r' if memory_map else None
+        index = BM25Index()
+        with open(os.path.join(path, 'bm25-vocab.json'), 'r') as f: index.vocab = {term: i for i, term in enumerate(json.load(f))}
+        with open(os.path.join(path, 'bm25-ids.json'), 'r') as f: index.ids = json.load(f)
+        index.numbers = {id: i for i, id in enumerate(index.ids)}
+        index.offsets = np.load(os.path.join(path, 'bm25-offsets.npy'), mmap_mode=mode)
+        index.docs = np.load(os.path.join(path, 'bm25-docs.npy'), mmap_mode=mode)
+        index.tfs = np.load(os.path.join(path, 'bm25-tfs.npy'), mmap_mode=mode)
+        index.lengths = array.array('f', np.load(os.path.join(path, 'bm25-lengths.npy')).tobytes())
+        index.alive = array.array('f', [1.0]) * len(index.ids)
+        index.total_length = float(np.frombuffer(index.lengths, dtype=np.float32).sum())
+        return index
@@ -0,0 +1,260 @@
+# module embedcache
+
+# system
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+# vector
+import numpy as np
+
+# local
+from metrics import metrics_count
+
+# constants
+EMBEDCACHE_DIR = 'embcache'
+EMBEDCACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class EmbeddingCache:
+    """On-disk embedding cache keyed by (model, normalized text hash)
+
+    Vectors are kept in a memory-mapped float32 file with fixed slots, the key => slot index lives in sqlite.
+    When all slots are taken the least recently used entries are evicted. Recency is a counter kept in the database and
+    bumped in the transaction that uses it, so processes sharing the cache (app and ingest workers) see one order.
+    Dimension and number of slots are fixed by the process that stores the first vector, processes opened with another 
+    size limit use them too (the file is mapped by all of them); delete the directory to change the size.
+    """
+
+    def __init__(self, path: str, model: str, max_bytes: int = EMBEDCACHE_MAX_BYTES):
+        """Opens (or creates) cache
+
+        Args:
+            path (str): cache directory
+            model (str): embedding model name, every model gets its own subdirectory
+            max_bytes (int, optional): size limit of the vector file if the cache is created. Defaults to EMBEDCACHE_MAX_BYTES.
+        """
+        self.model = model
+        self.path = os.path.join(path, re.sub(r'[^\w.-]', '_', model))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.capacity = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self.open_vectors()
+
+    def open_vectors(self, dim: int = None) -> bool:
+        """Maps vector file once the cache has a dimension
+
+        Args:
+            dim (int, optional): embedding dimension the cache is created with if it has none. Defaults to None (open an existing one).
+
+        Returns:
+            bool: True if the vector file is mapped
+        """
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        if 'dim' not in meta and dim is None: return False
+        
+        # the first process to store a vector decides dimension and capacity
+        filepath = os.path.join(self.path, 'vectors.f32')
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            meta = dict(self.db.execute('SELECT key, value FROM meta'))
+            if 'capacity' not in meta:
+                # caches created before the capacity was stored keep the size of their file
+                size = os.path.getsize(filepath) if 'dim' in meta and os.path.exists(filepath) else 0
+                meta.setdefault('dim', dim)
+                meta['capacity'] = size // (meta['dim'] * 4) or max(1, self.max_bytes // (meta['dim'] * 4))
+                self.db.execute('DELETE FROM entries WHERE slot >= ?', (meta['capacity'],))
+                self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('dim', meta['dim']), ('capacity', meta['capacity'])])
+            
+            # the file only grows, so the mappings of other processes stay valid
+            with open(filepath, 'ab') as f:
+                if f.seek(0, os.SEEK_END) < meta['capacity'] * meta['dim'] * 4: f.truncate(meta['capacity'] * meta['dim'] * 4)
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.dim = meta['dim']
+        self.capacity = meta['capacity']
+        self.vectors = np.memmap(filepath, dtype=np.float32, mode='r+', shape=(self.capacity, self.dim))
+        return True
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalizes text so that whitespace and unicode form differences share one entry
+
+        Args:
+            text (str): text
+
+        Returns:
+            str: normalized text
+        """
+        return unicodedata.normalize('NFC', ' '.join(text.split()))
+
+    def key(self, text: str) -> str:
+        """Returns cache key of a text
+
+        Args:
+            text (str): text
+
+        Returns:
+            str: sha256 hex digest of model and normalized text
+        """
+        return hashlib.sha256(f'{self.model}\0{self.normalize(text)}'.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+    def find_slots(self, keys: list[str]) -> dict[str, int]:
+        """Looks up slots of keys in the index
+
+        Args:
+            keys (list[str]): cache keys
+
+        Returns:
+            dict[str, int]: key => slot for keys found
+        """
+        slots = {}
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            slots.update(self.db.execute(f'SELECT key, slot FROM entries WHERE key IN ({",".join("?" * len(part))})', part))
+        return slots
+
+    def tick(self) -> int:
+        """Advances the shared recency clock, must be called in a transaction
+
+        Returns:
+            int: new clock value
+        """
+        self.db.execute("INSERT INTO meta VALUES ('clock', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1")
+        return self.db.execute("SELECT value FROM meta WHERE key = 'clock'").fetchone()[0]
+
+    def get_many(self, texts: list[str]) -> list[list[float] | None]:
+        """Looks up embeddings
+
+        Args:
+            texts (list[str]): texts
+
+        Returns:
+            list[list[float] | None]: embeddings, None for misses
+        """
+        keys = [self.key(text) for text in texts]
+        with self.lock:
+            # another process may have stored the first vectors since this one opened the cache
+            if self.vectors is None and not self.open_vectors():
+                self.misses += len(texts)
+                metrics_count('filechat_cache_requests_total', len(texts), cache='embedding', result='miss')
+                return [None] * len(texts)
+
+            # slots are read in the transaction, so no other process reuses them meanwhile
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                slots = self.find_slots(keys)
+
+                # mark entries as recently used
+                if slots:
+                    clock = self.tick()
+                    self.db.executemany('UPDATE entries SET last_used = ? WHERE key = ?', [(clock, key) for key in slots])
+
+                results = [self.vectors[slots[key]].tolist() if key in slots else None for key in keys]
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.hits += len(slots)
+            self.misses += len(keys) - len(slots)
+            metrics_count('filechat_cache_requests_total', len(slots), cache='embedding', result='hit')
+            metrics_count('filechat_cache_requests_total', len(keys) - len(slots), cache='embedding', result='miss')
+            return results
+
+    def put_many(self, texts: list[str], embeddings: list[list[float]]):
+        """Stores embeddings, evicts least recently used entries if the cache is full
+
+        Args:
+            texts (list[str]): texts
+            embeddings (list[list[float]]): embeddings
+        """
+        if not texts: return
+        items = dict(zip((self.key(text) for text in texts), embeddings))
+        with self.lock:
+            if self.vectors is None: self.open_vectors(len(embeddings[0]))
+            items = list(items.items())[-self.capacity:]
+
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                slots = self.find_slots([k for k, _ in items])
+                new_keys = [k for k, _ in items if k not in slots]
+                
+                # slots are always filled contiguously, take free ones first, then evict least recently used
+                count = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+                free_slots = list(range(count, min(self.capacity, count + len(new_keys))))
+                evict = len(new_keys) - len(free_slots)
+                if evict > 0:
+                    # entries rewritten by this call are never victims, their slots would be given away twice
+                    victims = self.db.execute('SELECT key, slot FROM entries ORDER BY last_used LIMIT ?', (evict + len(slots),)).fetchall()
+                    victims = [(k, slot) for k, slot in victims if k not in slots][:evict]
+                    self.db.executemany('DELETE FROM entries WHERE key = ?', [(k,) for k, _ in victims])
+                    free_slots += [slot for _, slot in victims]
+                    self.evictions += len(victims)
+                slots.update(zip(new_keys, free_slots))
+
+                clock = self.tick()
+                for key, embedding in items:
+                    self.vectors[slots[key]] = embedding
+                self.vectors.flush()
+                self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', [(k, slots[k], clock) for k, _ in items])
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def stats(self) -> dict:
+        """Returns cache counters
+
+        Returns:
+            dict: {'hits', 'misses', 'hit_ratio', 'evictions', 'entries', 'capacity'}
+        """
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'entries': entries,
+                'capacity': self.capacity,
+            }
+
+
+# caches are shared within a process, one per (directory, model)
+EMBEDCACHE_INSTANCES = {}
+EMBEDCACHE_LOCK = threading.Lock()
+
+
+def embedcache_open(path: str = EMBEDCACHE_DIR, model: str = 'llama3', max_bytes: int = EMBEDCACHE_MAX_BYTES) -> EmbeddingCache:
+    """Returns process-wide embedding cache for model
+
+    Args:
+        path (str, optional): cache directory. Defaults to EMBEDCACHE_DIR.
+        model (str, optional): embedding model name. Defaults to 'llama3'.
+        max_bytes (int, optional): size limit of the vector file if the cache is created. Defaults to EMBEDCACHE_MAX_BYTES.
+
+    Returns:
+        EmbeddingCache: cache
+    """
+    key = (os.path.abspath(path), model)
+    with EMBEDCACHE_LOCK:
+        if key not in EMBEDCACHE_INSTANCES:
+            EMBEDCACHE_INSTANCES[key] = EmbeddingCache(path, model, max_bytes)
+        return EMBEDCACHE_INSTANCES[key]
@@ -0,0 +1,269 @@
+# module filechat
+"""Headless command line: indexes documents and searches the library without the web app.
+Runs in the directory of the app (the index is written to vectorstore/ there) against the same database:
+
+    $ python src/filechat.py index /mnt/share/manuals report.pdf --parse_workers 16 --embed_workers 8
+    $ python src/filechat.py query "torque of the M8 bolt" -k 5
+    $ python src/filechat.py query "torque of the M8 bolt" --context
+    $ python src/filechat.py delete report.pdf
+"""
+
+# system
+import os
+import sys
+import socket
+import argparse
+
+# local
+from log import log_print
+from metrics import *
+from llm import *
+from jobs import *
+from storage import *
+from vectorstore import *
+from pdftext import *
+from fileuploader import *
+from ingest import *
+from rerank import *
+
+
+def filechat_print_progress(progress: dict):
+    """Prints job progress, see ingest_run_job"""
+    log_print(f'{progress["files_done"]}/{progress["files_total"]} files · {progress["chunks_added"]} chunks added · {progress["chunks_removed"]} removed · {len(progress["errors"])} errors')
+
+
+def filechat_index(
+    paths: list[str],
+    embedding: LLMBatchEmbeddings,
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+    index_type: str = 'flat',
+    nprobe: int = VECTORSTORE_NPROBE,
+    ef_search: int = VECTORSTORE_EF_SEARCH,
+    codec: str = 'float32',
+    reduced_dim: int = 0,
+    reduction: str = 'pca',
+    rescore: int = 0,
+    parse_workers: int = None,
+    pdf_backend: str = 'auto',
+    page_cache_dir: str = PDFTEXT_CACHE_DIR,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+    chunk_overlap: int = INGEST_CHUNK_OVERLAP,
+    chunk_unit: str = 'chars',
+    verbose: bool = False,
+) -> dict | None:
+    """Adds files and directories (walked recursively) to the library as a job of the ingest queue, run in this process
+
+    Args:
+        paths (list[str]): filepaths and directories
+        embedding (LLMBatchEmbeddings): embedding function
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): collection name. Defaults to 'documents'.
+        index_type (str, optional): one of VECTORSTORE_INDEX_TYPES. Defaults to 'flat'.
+        nprobe (int, optional): IVF lists visited per query. Defaults to VECTORSTORE_NPROBE.
+        ef_search (int, optional): HNSW search queue size. Defaults to VECTORSTORE_EF_SEARCH.
+        codec (str, optional): one of VECTORSTORE_CODECS. Defaults to 'float32'.
+        reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+        reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+        rescore (int, optional): keep exact vectors of a compressed index for re-scoring, see vectorstore_rank. Defaults to 0.
+        parse_workers (int, optional): document parsing processes. Defaults to None (number of CPUs).
+        pdf_backend (str, optional): PDF text extraction backend, see PDFTEXT_BACKENDS. Defaults to 'auto' (fastest installed).
+        page_cache_dir (str, optional): PDF page text cache directory, no caching if empty. Defaults to PDFTEXT_CACHE_DIR.
+        chunk_size (int, optional): chunk size in chunk_unit. Defaults to INGEST_CHUNK_SIZE.
+        chunk_overlap (int, optional): chunk overlap in chunk_unit. Defaults to INGEST_CHUNK_OVERLAP.
+        chunk_unit (str, optional): one of FU_SPLIT_UNITS. Defaults to 'chars'.
+        verbose (bool, optional): verbose output. Defaults to False.
+
+    Returns:
+        dict | None: finished job status (see jobs_status) or None if no files were found
+
+    Note:
+        an interrupted run of the same files is resumed after its last checkpoint, by running the command again or by a worker of the app
+    """
+    mongo = {'mongo_connect': mongo_connect, 'mongo_dbname': mongo_dbname, 'mongo_colname': mongo_colname}
+    files = [os.path.abspath(path) for path in fu_find_files(paths)]
+    if not files: return None
+
+    # documents are identified by file name, the first file of each name is added
+    files, skipped = ingest_unique_names(files)
+    if skipped: log_print(f'Skipping {len(skipped)} files with the name of another file: {", ".join(skipped[:5])}{", ..." if len(skipped) > 5 else ""}')
+
+    vectorService = VectorStoreService(
+        **mongo, 
+        embedding=embedding, 
+        index_type=index_type, 
+        nprobe=nprobe, 
+        ef_search=ef_search, 
+        codec=codec, 
+        reduced_dim=reduced_dim, 
+        reduction=reduction, 
+        rescore=rescore,
+    )
+
+    # workers of the app wait for the lock, the job is submitted and run while it is held
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    with vectorstore_lock():
+        job = jobs_find_unfinished(files, **mongo)
+        job_id = job['_id'] if job else jobs_submit(files, **mongo)
+        job = jobs_claim(worker, job_id=job_id, **mongo)
+        log_print(f'Job {job_id}: {len(files)} files')
+        vectorService.refresh(force=True)
+        ingest_run_job(
+            job,
+            vectorService,
+            parse_workers=parse_workers,
+            pdf_backend=pdf_backend,
+            page_cache_dir=page_cache_dir,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            chunk_unit=chunk_unit,
+            on_progress=filechat_print_progress,
+            verbose=verbose,
+            **mongo,
+        )
+    return jobs_status(jobs_get_collection(storage_get_client(mongo_connect), mongo_dbname, mongo_colname).find_one({'_id': job_id}, {'files': 0}))
+
+
+def filechat_query(query: str, vectorService: VectorStoreService, k: int = 5, sources: list[str] = None, width: int = 200) -> list[tuple[Document, float]]:
+    """Searches the library and prints the chunks found
+
+    Args:
+        query (str): question
+        vectorService (VectorStoreService): vectorstore service
+        k (int, optional): number of chunks. Defaults to 5.
+        sources (list[str], optional): search only these documents. Defaults to None (all).
+        width (int, optional): characters of chunk text printed. Defaults to 200.
+
+    Returns:
+        list[tuple[Document, float]]: chunks and their scores
+    """
+    results = vectorService.search(query, k=k, sources=sources)
+    for i, (doc, score) in enumerate(results):
+        text = ' '.join(doc.page_content.split())
+        print(f'{i + 1}. {doc.metadata["id"]} ({score:.3f})\n   {text[:width]}{"..." if len(text) > width else ""}')
+    return results
+
+
+def filechat_context(
+    query: str, 
+    vectorService: VectorStoreService, 
+    k: int = 5, 
+    fetch_k: int = RERANK_FETCH_K, 
+    context_tokens: int = RERANK_CONTEXT_TOKENS, 
+    sources: list[str] = None, 
+    width: int = 200,
+) -> list[Document]:
+    """Prints the passages a question is answered from in the app, see rerank_documents
+
+    Args:
+        query (str): question
+        vectorService (VectorStoreService): vectorstore service
+        k (int, optional): number of passages. Defaults to 5.
+        fetch_k (int, optional): chunks retrieved for reranking. Defaults to RERANK_FETCH_K.
+        context_tokens (int, optional): token budget, 0 for no limit. Defaults to RERANK_CONTEXT_TOKENS.
+        sources (list[str], optional): search only these documents. Defaults to None (all).
+        width (int, optional): characters of passage text printed. Defaults to 200.
+
+    Returns:
+        list[Document]: passages
+    """
+    stats = {}
+    passages = rerank_documents(query, [doc for doc, _ in vectorService.search(query, k=fetch_k, sources=sources)], k, context_tokens, stats=stats)
+    for i, doc in enumerate(passages):
+        text = ' '.join(doc.page_content.split())
+        print(f'{i + 1}. {" + ".join(doc.metadata.get("ids", [doc.metadata["id"]]))} ({fu_count_tokens(doc.page_content)} tokens)\n   {text[:width]}{"..." if len(text) > width else ""}')
+    if passages: print(f'{stats["tokens"]} tokens from {stats["candidates"]} chunks, {stats["duplicates"]} duplicates dropped')
+    return passages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--mongo_connect', help='mongo connect url', default='mongodb://localhost:27017/', type=str)
+    parser.add_argument('--mongo_dbname', help='mongo database name', default='filechat', type=str)
+    parser.add_argument('--mongo_colname', help='mongo collection name', default='documents', type=str)
+    parser.add_argument('--ollama_model', help='ollama model name', default='llama3', type=str)
+    parser.add_argument('--ollama_base_url', help='ollama url:port', default='http://localhost:11434', type=str)
+    parser.add_argument('--embed_batch_size', help='texts per embedding request', default=LLM_EMBED_BATCH_SIZE, type=int)
+    parser.add_argument('--embed_workers', help='concurrent embedding requests', default=LLM_EMBED_MAX_WORKERS, type=int)
+    parser.add_argument('--embed_cache_dir', help='embedding cache directory (empty to disable)', default=EMBEDCACHE_DIR, type=str)
+    parser.add_argument('--embed_cache_size', help='embedding cache size limit in MB (fixed once the cache is created)', default=EMBEDCACHE_MAX_BYTES // 2**20, type=int)
+    parser.add_argument('--index_type', help=f'vector index type, approximate ones are used from {VECTORSTORE_ANN_MIN_VECTORS} chunks', default='flat', choices=VECTORSTORE_INDEX_TYPES, type=str)
+    parser.add_argument('--nprobe', help='IVF lists visited per query (ivf, ivfpq, sq8)', default=VECTORSTORE_NPROBE, type=int)
+    parser.add_argument('--ef_search', help='HNSW search queue size (hnsw)', default=VECTORSTORE_EF_SEARCH, type=int)
+    parser.add_argument('--codec', help=f'how vectors are stored: float16 halves memory, int8 quarters it (trained once a shard has {VECTORSTORE_TRAIN_MIN_VECTORS} chunks)', default='float32', choices=VECTORSTORE_CODECS, type=str)
+    parser.add_argument('--reduced_dim', help='store vectors with this many dimensions (0 keeps all)', default=0, type=int)
+    parser.add_argument('--reduction', help=f'dimension reduction: pca (trained once a shard has {VECTORSTORE_TRAIN_MIN_VECTORS} chunks) or truncate (Matryoshka embeddings)', default='pca', choices=VECTORSTORE_REDUCTIONS, type=str)
+    parser.add_argument('--rescore', help='re-rank rescore x k candidates of a compressed index by exact vectors kept on disk (0 to disable)', default=0, type=int)
+    parser.add_argument('--verbose', help='verbose output', action='store_true')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    index = commands.add_parser('index', help='add files and directories (recursively) to the library', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    index.add_argument('paths', help='files and directories', type=str, nargs='+')
+    index.add_argument('--parse_workers', help='document parsing processes', default=os.cpu_count(), type=int)
+    index.add_argument('--pdf_backend', help='PDF text extraction backend (auto picks the fastest installed)', default='auto', choices=['auto', *PDFTEXT_BACKENDS], type=str)
+    index.add_argument('--page_cache_dir', help='PDF page text cache directory (empty to disable)', default=PDFTEXT_CACHE_DIR, type=str)
+    index.add_argument('--chunk_size', help='chunk size in chunk units', default=INGEST_CHUNK_SIZE, type=int)
+    index.add_argument('--chunk_overlap', help='overlap of neighbouring chunks in chunk units', default=INGEST_CHUNK_OVERLAP, type=int)
+    index.add_argument('--chunk_unit', help='chunk size unit, tokens are counted with tiktoken if installed (estimated otherwise)', default='chars', choices=FU_SPLIT_UNITS, type=str)
+
+    query = commands.add_parser('query', help='search the library', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    query.add_argument('query', help='question', type=str)
+    query.add_argument('-k', help='number of chunks', default=5, type=int)
+    query.add_argument('--retrieval', help='hybrid fuses keyword (BM25) and vector search results, vector uses embeddings only', default='hybrid', choices=VECTORSTORE_RETRIEVAL_MODES, type=str)
+    query.add_argument('--sources', help='search only these documents (file names)', default=None, type=str, nargs='+')
+    query.add_argument('--context', help='print the passages put into a prompt in the app: reranked, deduplicated and packed into --context_tokens', action='store_true')
+    query.add_argument('--fetch_k', help='chunks retrieved for reranking (--context)', default=RERANK_FETCH_K, type=int)
+    query.add_argument('--context_tokens', help='tokens of context put into a prompt, 0 for no limit (--context)', default=RERANK_CONTEXT_TOKENS, type=int)
+
+    delete = commands.add_parser('delete', help='delete documents from the library', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    delete.add_argument('sources', help='document file names', type=str, nargs='+')
+    args = parser.parse_args()
+
+    mongo = {'mongo_connect': args.mongo_connect, 'mongo_dbname': args.mongo_dbname, 'mongo_colname': args.mongo_colname}
+    index_params = {
+        'index_type': args.index_type, 
+        'nprobe': args.nprobe, 
+        'ef_search': args.ef_search, 
+        'codec': args.codec, 
+        'reduced_dim': args.reduced_dim, 
+        'reduction': args.reduction, 
+        'rescore': args.rescore,
+    }
+    embedding = llm_get_embedding_function(args.ollama_model, args.ollama_base_url, args.embed_batch_size, args.embed_workers, args.embed_cache_dir, args.embed_cache_size * 2**20)
+
+    if args.command == 'index':
+        missing = [path for path in args.paths if not os.path.exists(path)]
+        if missing: parser.error(f'not found: {", ".join(missing)}')
+        job = filechat_index(
+            args.paths,
+            embedding,
+            parse_workers=args.parse_workers,
+            pdf_backend=args.pdf_backend,
+            page_cache_dir=args.page_cache_dir,
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+            chunk_unit=args.chunk_unit,
+            verbose=args.verbose,
+            **mongo,
+            **index_params,
+        )
+        if not job:
+            log_print('No supported files found')
+            sys.exit(1)
+        log_print(f'Job {job["status"]} in {job["elapsed"]:.0f}s: {job["progress"]["chunks_added"]} chunks added, {job["progress"]["chunks_removed"]} removed ({job["chunks_per_s"]:.1f} chunks/s)')
+        sys.exit(1 if job['error'] else 0)
+    elif args.command == 'query':
+        vectorService = VectorStoreService(**mongo, embedding=embedding, **index_params, writable=False, retrieval=args.retrieval)
+        if args.context: found = filechat_context(args.query, vectorService, args.k, args.fetch_k, args.context_tokens, sources=args.sources)
+        else: found = filechat_query(args.query, vectorService, k=args.k, sources=args.sources)
+        if not found: log_print('Nothing found')
+    else:
+        vectorService = VectorStoreService(**mongo, embedding=embedding, **index_params, writable=False)
+        unknown = set(args.sources) - set(vectorService.sources())
+        if unknown: log_print(f'Not in the library: {", ".join(sorted(unknown))}')
+        if not vectorService.delete(args.sources):
+            log_print('Indexing is in progress, try again once it is done')
+            sys.exit(1)
+        log_print(f'Deleted {len(set(args.sources) - unknown)} documents, {vectorService.size()} chunks left')
@@ -2,33 +2,65 @@
 
 # system
 import os, io
-
-# loaders
-import docx
-from PyPDF2 import PdfReader
-from odf import text as odfText
-from odf.opendocument import load as odtload
+import re
+import time
+import codecs
+import shutil
+import tempfile
+import collections
+from typing import Callable, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# loaders (document libraries are imported by the readers, processes that do not parse never load them)
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# local
+from metrics import METRICS_STAGE, metrics_count, metrics_iter, metrics_observe, metrics_span
+from pdftext import pdftext_get_backend, pdftext_open, pdftext_open_cache, pdftext_hash_file
+
+# constants
+FU_DOCTYPES = ['pdf', 'docx', 'odt', 'txt']
+FU_PDF_PAGES_PER_TASK = 50
+FU_TXT_PAGE_SIZE = 1024 * 1024
+FU_PARAGRAPHS_PAGE_SIZE = 4000 # characters of DOCX/ODT paragraphs grouped into a page
+FU_SPLIT_SEPARATORS = ['\n\n', '\n', ' ', ''] # coarsest first
+FU_SPLIT_UNITS = ['chars', 'tokens']
+FU_TOKEN_ENCODING = 'cl100k_base'       # tiktoken encoding, if installed
+FU_TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]') # token estimate otherwise: words and punctuation
+FU_TOKEN_ENCODERS = {}                  # encoders are loaded once per process
 
 
-def fu_make_upload(file: UploadedFile | str) -> tuple[io.BytesIO, str, str]:
-    """Converts file to tuple pair of file data and type, and loads the file to memory
+def fu_make_upload(file: UploadedFile | str) -> tuple[io.BufferedIOBase, str, str]:
+    """Converts file to tuple of file object, type and name without copying its data, filepaths are opened for reading
 
     Args:
         file (UploadedFile | str): uploaded file from uploader or filepath
 
     Returns:
-        tuple[io.BytesIO, str, str]: file data, file type, file name
+        tuple[io.BufferedIOBase, str, str]: file object, file type, file name
     """
     if isinstance(file, UploadedFile):
-        return (io.BytesIO(file.read()), file.type, file.name)
+        file.seek(0)
+        return (file, file.type, file.name)
     else:
-        with open(file, 'rb') as f:
-            data = f.read()
-            type = file.split('.')[-1]
-        return (io.BytesIO(data), fu_get_encoded_type(type), os.path.basename(file))
+        type = file.split('.')[-1]
+        return (open(file, 'rb'), fu_get_encoded_type(type), os.path.basename(file))
+
+
+def fu_hash_file(file: UploadedFile | str) -> str:
+    """Hashes file contents without parsing it
+
+    Args:
+        file (UploadedFile | str): uploaded file from uploader or filepath
+
+    Returns:
+        str: sha256 hex digest
+    """
+    data = fu_make_upload(file)[0]
+    try: return pdftext_hash_file(data)
+    finally:
+        if not isinstance(file, UploadedFile): data.close()
 
 
 def fu_get_encoded_type(ext: str) -> str:
@@ -53,17 +85,52 @@ def fu_get_encoded_type(ext: str) -> str:
     else: raise Exception('Unsupported document type!')
 
 
-def fu_get_content(file: io.BytesIO, type: str, source: str = '') -> list[Document]:
+def fu_find_files(paths: Iterable[str], doctypes: list[str] = FU_DOCTYPES) -> list[str]:
+    """Finds documents of supported types, directories are walked recursively (hidden ones are skipped)
+
+    Args:
+        paths (Iterable[str]): filepaths and directories
+        doctypes (list[str], optional): file extensions. Defaults to FU_DOCTYPES.
+
+    Returns:
+        list[str]: filepaths in a stable order, files given explicitly are kept whatever their type
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, fnames in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            files.extend(os.path.join(root, fname) for fname in sorted(fnames) if fname.split('.')[-1] in doctypes and not fname.startswith('.'))
+    return list(dict.fromkeys(files))
+
+
+def fu_get_content(file: io.BufferedIOBase, type: str, source: str = '') -> list[Document]:
     """Reads file contents based in its text
 
     Args:
-        file (io.BytesIO): uploaded file object
+        file (io.BufferedIOBase): uploaded file object
         type (str): document type
         source (str, optional): filename. Defaults to ''.
 
     Returns:
         list[Document]: list of documents(page_content, metadata={'source', 'page'})
     """
+    return list(fu_count_pages(metrics_iter('parse', fu_iter_content(file, type, source))))
+
+
+def fu_iter_content(file: io.BufferedIOBase, type: str, source: str = '') -> Iterator[Document]:
+    """Reads file contents page by page
+
+    Args:
+        file (io.BufferedIOBase): uploaded file object
+        type (str): document type
+        source (str, optional): filename. Defaults to ''.
+
+    Returns:
+        Iterator[Document]: documents(page_content, metadata={'source', 'page'})
+    """
     if type == 'application/pdf': return fu_get_content_pdf(file, source)
     elif type == 'application/vnd.oasis.opendocument.text': return fu_get_content_odt(file, source)
     elif type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document': return fu_get_content_docx(file, source)
@@ -71,113 +138,410 @@ def fu_get_content(file: io.BytesIO, type: str, source: str = '') -> list[Docume
     else: raise Exception('Unsupported document type!')
 
 
-def fu_get_content_txt(file: io.BytesIO, source: str = '') -> list[Document]:
-    """Reads TXT file contents
+def fu_get_content_txt(file: io.BufferedIOBase, source: str = '', page_size: int = FU_TXT_PAGE_SIZE) -> Iterator[Document]:
+    """Reads TXT file contents, large files are split into pages of about page_size bytes at line breaks
 
     Args:
-        file (io.BytesIO): uploaded file object
+        file (io.BufferedIOBase): uploaded file object
         source (str, optional): filename. Defaults to ''.
+        page_size (int, optional): page size in bytes. Defaults to FU_TXT_PAGE_SIZE.
 
-    Returns:
-        list[Document]: list of documents(page_content, metadata={'source', 'page'})
+    Yields:
+        Iterator[Document]: documents(page_content, metadata={'source', 'page'})
     """
-    documents = [Document(
-        page_content=file.read().decode(errors='replace'),
-        metadata={
-            'source': source,
-            'page': 0,
-        }
-    )]
-    return documents
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    page = 0
+    tail = ''
+    while True:
+        data = file.read(page_size)
+        text = tail + decoder.decode(data, final=not data)
+        
+        # cut at the last line break, the rest goes to the next page
+        cut = text.rfind('\n') + 1 if data else len(text)
+        if data and not cut: cut = len(text)
+        text, tail = text[:cut], text[cut:]
+        if text or (not data and not page):
+            yield Document(
+                page_content=text,
+                metadata={
+                    'source': source,
+                    'page': page,
+                }
+            )
+            page += 1
+        if not data: break
+
+
+def fu_get_content_pdf(
+    file: io.BufferedIOBase, 
+    source: str = '', 
+    pages: tuple[int, int] = None, 
+    backend: str = 'auto', 
+    cache_dir: str = None, 
+    file_hash: str = None,
+) -> Iterator[Document]:
+    """Reads PDF file contents, page text is cached by file hash so a file read again is not parsed again
 
+    Args:
+        file (io.BufferedIOBase): uploaded file object
+        source (str, optional): filename. Defaults to ''.
+        pages (tuple[int, int], optional): page range [start, end) to read, all pages if None. Defaults to None.
+        backend (str, optional): text extraction backend, see PDFTEXT_BACKENDS. Defaults to 'auto' (fastest installed).
+        cache_dir (str, optional): page text cache directory, no caching if None. Defaults to None.
+        file_hash (str, optional): file hash if known, see pdftext_hash_file. Defaults to None.
 
-def fu_get_content_pdf(file: io.BytesIO, source: str = '') -> list[Document]:
-    """Reads PDF file contents
+    Yields:
+        Iterator[Document]: documents(page_content, metadata={'source', 'page'})
+    """
+    backend = pdftext_get_backend(backend)
+    cache = pdftext_open_cache(cache_dir) if cache_dir else None
+    if cache is not None and file_hash is None: file_hash = pdftext_hash_file(file)
+    
+    # the file is opened only if some page is not cached
+    reader = None
+    npages = cache.page_count(file_hash, backend) if cache is not None else None
+    if npages is None:
+        reader = pdftext_open(file, backend)
+        npages = reader.page_count()
+    start, end = pages or (0, npages)
+    end = min(end, npages)
+    cached = cache.get_many(file_hash, backend, start, end) if cache is not None else {}
+    
+    extracted = {}
+    try:
+        for i in range(start, end):
+            text = cached.get(i)
+            if text is None:
+                reader = reader or pdftext_open(file, backend)
+                text = extracted[i] = reader.extract(i)
+            yield Document(
+                page_content=text,
+                metadata={
+                    'source': source,
+                    'page': i,
+                }
+            )
+    finally:
+        if reader: reader.close()
+        if extracted and cache is not None: cache.put_many(file_hash, backend, npages, extracted)
+
+
+def fu_get_content_odt(file: io.BufferedIOBase, source: str = '', page_size: int = FU_PARAGRAPHS_PAGE_SIZE) -> Iterator[Document]:
+    """Reads ODT file contents, paragraphs and headings are grouped into pages of about page_size characters
 
     Args:
-        file (io.BytesIO): uploaded file object
+        file (io.BufferedIOBase): uploaded file object
         source (str, optional): filename. Defaults to ''.
+        page_size (int, optional): page size in characters, one page per paragraph if 0. Defaults to FU_PARAGRAPHS_PAGE_SIZE.
 
-    Returns:
-        list[Document]: list of documents(page_content, metadata={'source', 'page'})
+    Yields:
+        Iterator[Document]: documents(page_content, metadata={'source', 'page'})
     """
-    documents = []
-    loader = PdfReader(file)
-    for i, chunk in enumerate(loader.pages):
-        documents.append(Document(
-            page_content=chunk.extract_text(),
-            metadata={
-                'source': source,
-                'page': i,
-            }
-        ))
-    return documents
+    from odf import teletype
+    from odf.element import Node
+    from odf.namespaces import TEXTNS
+    from odf.opendocument import load as odtload
+    
+    def iter_paragraphs(element) -> Iterator[str]:
+        # document order, paragraphs nested in lists, tables and sections included
+        for child in element.childNodes:
+            if child.nodeType != Node.ELEMENT_NODE: continue
+            if child.qname in ((TEXTNS, 'p'), (TEXTNS, 'h')): yield teletype.extractText(child)
+            else: yield from iter_paragraphs(child)
+
+    loader = odtload(file)
+    yield from fu_iter_paragraph_pages(iter_paragraphs(loader.text), source, page_size)
 
 
-def fu_get_content_odt(file: io.BytesIO, source: str = '') -> list[Document]:
-    """Reads ODT file contents
+def fu_get_content_docx(file: io.BufferedIOBase, source: str = '', page_size: int = FU_PARAGRAPHS_PAGE_SIZE) -> Iterator[Document]:
+    """Reads DOCX file contents, paragraphs are grouped into pages of about page_size characters
 
     Args:
-        file (io.BytesIO): uploaded file object
+        file (io.BufferedIOBase): uploaded file object
         source (str, optional): filename. Defaults to ''.
+        page_size (int, optional): page size in characters, one page per paragraph if 0. Defaults to FU_PARAGRAPHS_PAGE_SIZE.
 
-    Returns:
-        list[Document]: list of documents(page_content, metadata={'source', 'page'})
-    """    
-    documents = []
-    loader = odtload(file)
-    for i, chunk in enumerate(loader.getElementsByType(odfText.P)):
-        documents.append(Document(
-            page_content=chunk.firstChild.data,
-            metadata={
-                'source': source,
-                'page': i,
-            }
-        ))
-    return documents
+    Yields:
+        Iterator[Document]: documents(page_content, metadata={'source', 'page'})
+    """
+    import docx
+    loader = docx.Document(file)
+    yield from fu_iter_paragraph_pages((paragraph.text for paragraph in loader.paragraphs), source, page_size)
 
 
-def fu_get_content_docx(file: io.BytesIO, source: str = '') -> list[Document]:
-    """Reads DOCX file contents
+def fu_iter_paragraph_pages(paragraphs: Iterable[str], source: str = '', page_size: int = FU_PARAGRAPHS_PAGE_SIZE) -> Iterator[Document]:
+    """Groups paragraphs into pages of up to page_size characters (a longer paragraph is a page of its own), 
+    empty paragraphs are skipped. The splitter then fills chunks from a page instead of a chunk per paragraph.
 
     Args:
-        file (io.BytesIO): uploaded file object
+        paragraphs (Iterable[str]): paragraph texts
         source (str, optional): filename. Defaults to ''.
+        page_size (int, optional): page size in characters, one page per paragraph if 0. Defaults to FU_PARAGRAPHS_PAGE_SIZE.
 
-    Returns:
-        list[Document]: list of documents(page_content, metadata={'source', 'page'})
+    Yields:
+        Iterator[Document]: documents(page_content, metadata={'source', 'page'}), paragraphs separated by blank lines
     """
-    documents = []
-    loader = docx.Document(file)
-    for i, chunk in enumerate(loader.paragraphs): 
-        documents.append(Document(
-            page_content=chunk.text,
+    page = 0
+    parts = []
+    size = 0
+    for paragraph in paragraphs:
+        paragraph = paragraph.strip()
+        if not paragraph: continue
+        if parts and size + len(paragraph) > page_size:
+            yield Document(
+                page_content='\n\n'.join(parts),
+                metadata={
+                    'source': source,
+                    'page': page,
+                }
+            )
+            page += 1
+            parts = []
+            size = 0
+        parts.append(paragraph)
+        size += len(paragraph) + 2
+    if parts:
+        yield Document(
+            page_content='\n\n'.join(parts),
             metadata={
                 'source': source,
-                'page': i,
+                'page': page,
             }
-        ))
-    return documents
+        )
 
 
-def fu_split_documents(documents: list[Document], chunk_size: int = 800, chunk_overlap: int = 80) -> list[Document]:
+def fu_split_documents(
+    documents: list[Document], 
+    chunk_size: int = 800, 
+    chunk_overlap: int = 80, 
+    length_function: Callable[[str], int] = None,
+) -> list[Document]:
     """Split documents into smaller chunks of specified size
 
     Args:
         documents (list[Document]): list of documents
         chunk_size (int, optional): chunk size split. Defaults to 800.
         chunk_overlap (int, optional): chunk size overlap. Defaults to 80.
+        length_function (Callable[[str], int], optional): size of a text, characters if None. Defaults to None.
 
     Returns:
-        list[Document]: list of documents of the approximate specified size
+        list[Document]: list of documents of the approximate specified size, with ids
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=len,
-        is_separator_regex=False,
-    )
-    return text_splitter.split_documents(documents)
+    return list(fu_iter_split_documents(documents, chunk_size, chunk_overlap, length_function))
+
+
+def fu_iter_split_documents(
+    documents: Iterable[Document], 
+    chunk_size: int = 800, 
+    chunk_overlap: int = 80, 
+    length_function: Callable[[str], int] = None,
+) -> Iterator[Document]:
+    """Splits documents into smaller chunks as they arrive and assigns chunk ids (see fu_iter_document_ids), 
+    only one page is held at a time
+
+    Args:
+        documents (Iterable[Document]): documents ordered by source and page
+        chunk_size (int, optional): chunk size split. Defaults to 800.
+        chunk_overlap (int, optional): chunk size overlap. Defaults to 80.
+        length_function (Callable[[str], int], optional): size of a text, characters if None. Defaults to None.
+
+    Yields:
+        Iterator[Document]: documents of the approximate specified size, with ids
+    """
+    last_page_id = None
+    index = 0
+    for document in documents:
+        text = document.page_content
+        page_id = f'{document.metadata.get("source")}:{document.metadata.get("page")}'
+        if page_id != last_page_id: index = 0
+        last_page_id = page_id
+        
+        chunks = 0
+        for start, end in metrics_iter('split', fu_split_text(text, chunk_size, chunk_overlap, length_function)):
+            # fields are known to be valid, validation would cost more than the split itself
+            yield Document.construct(page_content=text[start:end], metadata={**document.metadata, 'id': f'{page_id}:{index}'})
+            index += 1
+            chunks += 1
+        metrics_count('filechat_chunks_total', chunks)
+
+
+def fu_split_text(
+    text: str, 
+    chunk_size: int = 800, 
+    chunk_overlap: int = 80, 
+    length_function: Callable[[str], int] = None, 
+    separators: list[str] = FU_SPLIT_SEPARATORS,
+) -> Iterator[tuple[int, int]]:
+    """Splits text at the coarsest separator that gives chunks of up to chunk_size, neighbouring chunks overlap by up to chunk_overlap.
+    Chunks are the same as of langchain's RecursiveCharacterTextSplitter, but pieces are offsets into text and chunks are yielded 
+    as they are found, so no strings are created besides the chunks (and pieces measured by length_function).
+
+    Args:
+        text (str): text
+        chunk_size (int, optional): chunk size. Defaults to 800.
+        chunk_overlap (int, optional): chunk overlap. Defaults to 80.
+        length_function (Callable[[str], int], optional): size of a text, characters if None. Defaults to None.
+        separators (list[str], optional): separators, coarsest first, '' splits into characters. Defaults to FU_SPLIT_SEPARATORS.
+
+    Yields:
+        Iterator[tuple[int, int]]: chunk [start, end) offsets, without surrounding whitespace
+    """
+    if chunk_overlap > chunk_size: raise ValueError(f'Chunk overlap ({chunk_overlap}) is larger than chunk size ({chunk_size})')
+    separator_length = length_function('') if length_function else 0
+    
+    def length(start: int, end: int) -> int:
+        return length_function(text[start:end]) if length_function else end - start
+    
+    def strip(start: int, end: int) -> tuple[int, int]:
+        while start < end and text[start].isspace(): start += 1
+        while end > start and text[end - 1].isspace(): end -= 1
+        return start, end
+    
+    def pieces(start: int, end: int, separator: str) -> Iterator[tuple[int, int]]:
+        # a separator starts the piece following it, so pieces are contiguous and a run of them is a single slice
+        if not separator:
+            yield from ((i, i + 1) for i in range(start, end))
+            return
+        position = text.find(separator, start, end)
+        if position == -1: position = end
+        if position > start: yield start, position
+        while position < end:
+            following = text.find(separator, position + len(separator), end)
+            if following == -1: following = end
+            yield position, following
+            position = following
+    
+    def merge(splits: list[tuple[int, int, int]]) -> Iterator[tuple[int, int]]:
+        current = collections.deque()
+        total = 0
+        for start, end, size in splits:
+            if current and total + size + separator_length > chunk_size:
+                chunk = strip(current[0][0], current[-1][1])
+                if chunk[0] < chunk[1]: yield chunk
+                
+                # keep the tail that fits into the overlap
+                while current and (total > chunk_overlap or (total + size + separator_length > chunk_size and total > 0)):
+                    total -= current.popleft()[2] + (separator_length if current else 0)
+            current.append((start, end, size))
+            total += size + (separator_length if len(current) > 1 else 0)
+        if current:
+            chunk = strip(current[0][0], current[-1][1])
+            if chunk[0] < chunk[1]: yield chunk
+    
+    def split(start: int, end: int, separators: list[str]) -> Iterator[tuple[int, int]]:
+        separator, finer = separators[-1], []
+        for i, candidate in enumerate(separators):
+            if not candidate or text.find(candidate, start, end) != -1:
+                separator, finer = candidate, separators[i + 1:] if candidate else []
+                break
+        
+        if not length_function and len(separator) <= 1:
+            yield from split_chars(start, end, separator, finer)
+            return
+        
+        # runs of short pieces are merged, long pieces are split with finer separators
+        short = []
+        for piece_start, piece_end in pieces(start, end, separator):
+            size = length(piece_start, piece_end)
+            if size < chunk_size: 
+                short.append((piece_start, piece_end, size))
+                continue
+            if short: yield from merge(short)
+            short = []
+            if finer: yield from split(piece_start, piece_end, finer)
+            else: yield piece_start, piece_end
+        if short: yield from merge(short)
+    
+    def split_chars(start: int, end: int, separator: str, finer: list[str]) -> Iterator[tuple[int, int]]:
+        # split and merge measured in characters with a separator of up to one character: pieces are found between 
+        # separator positions, so a chunk takes a few find calls instead of a step per piece (word or character)
+        def next_boundary(position: int) -> int:
+            if not separator: return position + 1
+            found = text.find(separator, position + 1, end)
+            return end if found == -1 else found
+        
+        chunk_start = chunk_end = start
+        while chunk_end < end:
+            piece_end = next_boundary(chunk_end)
+            if piece_end - chunk_end >= chunk_size:
+                if chunk_start < chunk_end:
+                    chunk = strip(chunk_start, chunk_end)
+                    if chunk[0] < chunk[1]: yield chunk
+                if finer: yield from split(chunk_end, piece_end, finer)
+                else: yield chunk_end, piece_end
+                chunk_start = chunk_end = piece_end
+                continue
+            
+            if chunk_start < chunk_end and piece_end - chunk_start > chunk_size:
+                chunk = strip(chunk_start, chunk_end)
+                if chunk[0] < chunk[1]: yield chunk
+                
+                # the overlap starts at the first piece that keeps it within chunk_overlap and leaves room for the new piece
+                overlap = max(chunk_end - chunk_overlap, piece_end - chunk_size)
+                found = overlap if not separator else text.find(separator, overlap, chunk_end)
+                chunk_start = chunk_end if found == -1 else found
+            chunk_end = piece_end
+            
+            # pieces up to chunk_start + chunk_size are shorter than chunk_size and fit, they are taken at once
+            limit = chunk_start + chunk_size
+            if limit >= end: chunk_end = end
+            elif limit > chunk_end:
+                found = limit if not separator else text.rfind(separator, chunk_end + 1, limit + 1)
+                if found != -1: chunk_end = found
+        
+        if chunk_start < chunk_end:
+            chunk = strip(chunk_start, chunk_end)
+            if chunk[0] < chunk[1]: yield chunk
+    
+    yield from split(0, len(text), separators)
+
+
+def fu_count_tokens(text: str) -> int:
+    """Counts tokens of text with tiktoken (FU_TOKEN_ENCODING) if installed, estimates them as words and punctuation otherwise
+
+    Args:
+        text (str): text
+
+    Returns:
+        int: number of tokens
+    """
+    if FU_TOKEN_ENCODING not in FU_TOKEN_ENCODERS:
+        try:
+            import tiktoken
+            FU_TOKEN_ENCODERS[FU_TOKEN_ENCODING] = tiktoken.get_encoding(FU_TOKEN_ENCODING)
+        except ImportError: FU_TOKEN_ENCODERS[FU_TOKEN_ENCODING] = None
+    encoder = FU_TOKEN_ENCODERS[FU_TOKEN_ENCODING]
+    if encoder: return len(encoder.encode(text, disallowed_special=()))
+    return sum(1 for _ in FU_TOKEN_PATTERN.finditer(text))
+
+
+def fu_get_length_function(unit: str = 'chars') -> Callable[[str], int] | None:
+    """Returns length function of a chunk size unit
+
+    Args:
+        unit (str, optional): one of FU_SPLIT_UNITS. Defaults to 'chars'.
+
+    Returns:
+        Callable[[str], int] | None: length function, None for characters
+    """
+    if unit == 'chars': return None
+    elif unit == 'tokens': return fu_count_tokens
+    else: raise Exception(f'Unsupported chunk size unit: {unit}!')
+
+
+def fu_count_pages(documents: Iterable[Document]) -> Iterator[Document]:
+    """Counts pages and characters read as documents pass through
+
+    Args:
+        documents (Iterable[Document]): documents
+
+    Yields:
+        Iterator[Document]: the same documents
+    """
+    for document in documents:
+        metrics_count('filechat_parsed_pages_total')
+        metrics_count('filechat_parsed_bytes_total', len(document.page_content))
+        yield document
 
 
 def fu_calculate_document_ids(documents: list[Document]) -> list[Document]:
@@ -189,6 +553,18 @@ def fu_calculate_document_ids(documents: list[Document]) -> list[Document]:
     Returns:
         list[Document]: documents with unique id
     """
+    return list(fu_iter_document_ids(documents))
+
+
+def fu_iter_document_ids(documents: Iterable[Document]) -> Iterator[Document]:
+    """Creates unique document IDs like 'source:page_num:document_id' as documents arrive
+
+    Args:
+        documents (Iterable[Document]): documents ordered by source and page
+
+    Yields:
+        Iterator[Document]: documents with unique id
+    """
     last_page_id = None
     current_chunk_index = 0
     for document in documents:
@@ -208,5 +584,186 @@ def fu_calculate_document_ids(documents: list[Document]) -> list[Document]:
 
         # add it to the page meta-data.
         document.metadata["id"] = document_id
+        yield document
+
+
+def fu_make_parse_tasks(
+    file: UploadedFile | str, 
+    pages_per_task: int = FU_PDF_PAGES_PER_TASK, 
+    pdf_backend: str = 'auto', 
+    page_cache_dir: str = None,
+) -> Iterator[tuple]:
+    """Splits a file into parse tasks, large PDFs are split into page ranges (made as they are taken, not all at once)
+
+    Args:
+        file (UploadedFile | str): uploaded file from uploader or filepath
+        pages_per_task (int, optional): PDF pages per task. Defaults to FU_PDF_PAGES_PER_TASK.
+        pdf_backend (str, optional): PDF text extraction backend. Defaults to 'auto'.
+        page_cache_dir (str, optional): PDF page text cache directory, no caching if None. Defaults to None.
+
+    Yields:
+        Iterator[tuple]: tasks (uploaded file or filepath, file type, file name, page range or None, PDF options or None)
+    """
+    if isinstance(file, UploadedFile): type, name = file.type, file.name
+    else: type, name = fu_get_encoded_type(file.split('.')[-1]), os.path.basename(file)
+    
+    if type != 'application/pdf': 
+        yield (file, type, name, None, None)
+        return
+    
+    # the file is hashed once here, page count of a cached file is known without parsing it
+    options = {'backend': pdftext_get_backend(pdf_backend), 'cache_dir': page_cache_dir, 'file_hash': None}
+    data = fu_make_upload(file)[0]
+    try:
+        npages = None
+        if page_cache_dir:
+            options['file_hash'] = pdftext_hash_file(data)
+            npages = pdftext_open_cache(page_cache_dir).page_count(options['file_hash'], options['backend'])
+        if npages is None:
+            reader = pdftext_open(data, options['backend'])
+            try: npages = reader.page_count()
+            finally: reader.close()
+    finally:
+        if not isinstance(file, UploadedFile): data.close()
+    for start in range(0, max(npages, 1), pages_per_task): yield (file, type, name, (start, start + pages_per_task), options)
+
+
+def fu_iter_parse_task(task: tuple) -> Iterator[Document]:
+    """Parses a file or a page range of a PDF
+
+    Args:
+        task (tuple): task from fu_make_parse_tasks
+
+    Yields:
+        Iterator[Document]: documents(page_content, metadata={'source', 'page'})
+    """
+    data, type, name, pages, options = task
+    file = fu_make_upload(data)[0]
+    try:
+        if pages: yield from fu_get_content_pdf(file, name, pages, **options)
+        else: yield from fu_iter_content(file, type, name)
+    finally:
+        if not isinstance(data, UploadedFile): file.close()
+
+
+def fu_run_parse_task(task: tuple) -> tuple[list[Document], float]:
+    """Parses a file or a page range of a PDF (runs in a worker process)
 
-    return documents
+    Args:
+        task (tuple): task from fu_make_parse_tasks
+
+    Returns:
+        tuple[list[Document], float]: list of documents(page_content, metadata={'source', 'page'}), seconds spent parsing 
+            (metrics of worker processes are not collected, the caller records them)
+    """
+    start = time.perf_counter()
+    documents = list(fu_iter_parse_task(task))
+    return documents, time.perf_counter() - start
+
+
+def fu_iter_content_parallel(
+    files: list[UploadedFile | str], 
+    max_workers: int = None, 
+    pages_per_task: int = FU_PDF_PAGES_PER_TASK, 
+    progress: Callable[[int, int, str, Exception | None], None] = None,
+    pdf_backend: str = 'auto',
+    page_cache_dir: str = None,
+) -> Iterator[tuple[str, Iterator[Document]]]:
+    """Parses files in a process pool, yields every file in input order with an iterator over its documents
+
+    Only a bounded number of tasks is in flight, tasks of a large PDF are submitted one by one as earlier ones are consumed,
+    so memory use does not grow with the number or size of files.
+    Text files are streamed in this process, parsing them is cheaper than sending their contents to a worker.
+
+    Args:
+        files (list[UploadedFile | str]): uploaded files or filepaths
+        max_workers (int, optional): worker processes, parses in this process if 1. Defaults to None (number of CPUs).
+        pages_per_task (int, optional): PDF pages per task. Defaults to FU_PDF_PAGES_PER_TASK.
+        progress (Callable[[int, int, str, Exception | None], None], optional): called with (files done, total, file name, error) once a file is consumed. Defaults to None.
+        pdf_backend (str, optional): PDF text extraction backend, see PDFTEXT_BACKENDS. Defaults to 'auto' (fastest installed).
+        page_cache_dir (str, optional): PDF page text cache directory, no caching if None. Defaults to None.
+
+    Yields:
+        Iterator[tuple[str, Iterator[Document]]]: file name, documents of the file (raises the error that stopped parsing it)
+    
+    Note:
+        documents of a file must be consumed before advancing to the next file, the rest of a file is dropped otherwise
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+    window = 4 * max_workers
+    queue = collections.deque()
+    pending = iter(enumerate(files))
+    current = None # (index, parse tasks) of the file whose tasks are being submitted
+    spooled = {}
+    
+    def submit(task: tuple):
+        data, type, name, pages, options = task
+        if not executor or type == 'text/plain': return task
+        
+        # uploads are spooled to disk once, so page range tasks do not copy the whole file to workers
+        if isinstance(data, UploadedFile):
+            if id(data) not in spooled:
+                with tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1], delete=False) as f:
+                    data.seek(0)
+                    shutil.copyfileobj(data, f)
+                spooled[id(data)] = f.name
+            task = (spooled[id(data)], type, name, pages, options)
+        return executor.submit(fu_run_parse_task, task)
+    
+    def fill():
+        nonlocal current
+        while len(queue) < window:
+            if current is None:
+                item = next(pending, None)
+                if item is None: return
+                i, file = item
+                current = (i, fu_make_parse_tasks(file, pages_per_task, pdf_backend, page_cache_dir))
+            
+            # one task at a time, so the window bounds tasks rather than files
+            i, tasks = current
+            try: 
+                task = next(tasks, None)
+                if task is None: 
+                    current = None
+                    continue
+                queue.append((i, submit(task)))
+            except Exception as e:
+                queue.append((i, e))
+                current = None
+    
+    def iter_file(i: int, state: dict) -> Iterator[Document]:
+        try:
+            while queue and queue[0][0] == i:
+                _, task = queue.popleft()
+                fill()
+                if isinstance(task, Exception): raise task
+                elif isinstance(task, Future): 
+                    documents, seconds = task.result()
+                    metrics_observe(METRICS_STAGE, seconds, stage='parse')
+                    yield from fu_count_pages(documents)
+                else: yield from fu_count_pages(metrics_iter('parse', fu_iter_parse_task(task)))
+        except Exception as e:
+            state['error'] = e
+            raise
+    
+    try:
+        fill()
+        for i, file in enumerate(files):
+            name = file.name if isinstance(file, UploadedFile) else os.path.basename(file)
+            state = {'error': None}
+            documents = iter_file(i, state)
+            yield name, documents
+            
+            # drop whatever the consumer did not read
+            documents.close()
+            while queue and queue[0][0] == i:
+                _, task = queue.popleft()
+                if isinstance(task, Future): task.cancel()
+            if current is not None and current[0] == i: current = None
+            fill()
+            if id(file) in spooled: os.remove(spooled.pop(id(file)))
+            if progress: progress(i + 1, len(files), name, state['error'])
+    finally:
+        if executor: executor.shutdown(cancel_futures=True)
+        for path in spooled.values(): os.remove(path)
@@ -0,0 +1,361 @@
+# module ingest
+"""Ingestion engine: reads, splits, stores and indexes files. Runs as a worker process that takes jobs from the queue:
+
+    $ python src/ingest.py --mongo_connect mongodb://localhost:27017/ --ollama_model llama3
+"""
+
+# system
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import traceback
+from typing import Callable
+
+# webui
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+
+# local
+from log import log_print
+from metrics import *
+from llm import *
+from jobs import *
+from storage import *
+from vectorstore import *
+from pdftext import *
+from fileuploader import *
+
+# constants
+INGEST_UPLOAD_DIR = 'uploads'
+INGEST_CHUNK_SIZE = 1000
+INGEST_CHUNK_OVERLAP = 200
+INGEST_POLL_INTERVAL = 1.0     # seconds between checks for new jobs
+INGEST_PROGRESS_INTERVAL = 1.0 # seconds between job progress writes
+
+
+def ingest_unique_names(files: list[UploadedFile | str]) -> tuple[list[UploadedFile | str], list[UploadedFile | str]]:
+    """Keeps the first file of each name: documents are identified by file name, a file with the name of another one 
+    would replace its chunks
+
+    Args:
+        files (list[UploadedFile | str]): uploaded files or filepaths
+
+    Returns:
+        tuple[list[UploadedFile | str], list[UploadedFile | str]]: files kept, files skipped
+    """
+    kept, skipped, names = [], [], set()
+    for file in files:
+        name = os.path.basename(file.name if isinstance(file, UploadedFile) else file)
+        if name in names: skipped.append(file)
+        else:
+            names.add(name)
+            kept.append(file)
+    return kept, skipped
+
+
+def ingest_spool_uploads(files: list[UploadedFile | str], dirpath: str) -> list[str]:
+    """Writes uploaded files to disk, so that a worker process can read them after the script run ends
+
+    Args:
+        files (list[UploadedFile | str]): uploaded files or filepaths
+        dirpath (str): directory for uploaded files
+
+    Returns:
+        list[str]: filepaths, filepaths given are kept as they are; files with the name of a file before them are skipped (see ingest_unique_names)
+    """
+    paths = []
+    for file in ingest_unique_names(files)[0]:
+        if isinstance(file, UploadedFile):
+            os.makedirs(dirpath, exist_ok=True)
+            path = os.path.join(dirpath, os.path.basename(file.name))
+            with open(path, 'wb') as f:
+                file.seek(0)
+                shutil.copyfileobj(file, f)
+            paths.append(path)
+        else: paths.append(file)
+    return paths
+
+
+def ingest_run(
+    files: list[UploadedFile | str],
+    vectorService: VectorStoreService,
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+    parse_workers: int = None,
+    pdf_backend: str = 'auto',
+    page_cache_dir: str = PDFTEXT_CACHE_DIR,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+    chunk_overlap: int = INGEST_CHUNK_OVERLAP,
+    chunk_unit: str = 'chars',
+    progress: Callable[[dict], None] = None,
+    verbose: bool = False,
+) -> dict:
+    """Adds files to the library: reads, splits and stores documents, then indexes them in bounded batches
+
+    Args:
+        files (list[UploadedFile | str]): uploaded files or filepaths
+        vectorService (VectorStoreService): writable vectorstore service
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): collection name. Defaults to 'documents'.
+        parse_workers (int, optional): document parsing processes. Defaults to None (number of CPUs).
+        pdf_backend (str, optional): PDF text extraction backend, see PDFTEXT_BACKENDS. Defaults to 'auto' (fastest installed).
+        page_cache_dir (str, optional): PDF page text cache directory, no caching if empty. Defaults to PDFTEXT_CACHE_DIR.
+        chunk_size (int, optional): chunk size in chunk_unit. Defaults to INGEST_CHUNK_SIZE.
+        chunk_overlap (int, optional): chunk overlap in chunk_unit. Defaults to INGEST_CHUNK_OVERLAP.
+        chunk_unit (str, optional): one of FU_SPLIT_UNITS. Defaults to 'chars'.
+        progress (Callable[[dict], None], optional): called with counts after every file and batch. Defaults to None.
+        verbose (bool, optional): verbose output. Defaults to False.
+
+    Returns:
+        dict: {'files_done', 'files_checkpointed', 'chunks_added', 'chunks_removed', 'errors': [{'file', 'error'}]}
+
+    Note:
+        'files_checkpointed' files are saved to the index and their manifests, a run interrupted later can resume after them.
+        Files stored before from the same contents with the same split settings are not parsed.
+    """
+    counts = {'files_done': 0, 'files_checkpointed': 0, 'chunks_added': 0, 'chunks_removed': 0, 'errors': []}
+
+    # unchanged files cost a hash of their contents and one manifest lookup
+    repository = StorageRepository(mongo_connect, mongo_dbname, mongo_colname)
+    versions, positions = {}, []
+    for i, file in enumerate(files):
+        name = file.name if isinstance(file, UploadedFile) else os.path.basename(file)
+        try: versions[name] = storage_make_version(fu_hash_file(file), chunk_size, chunk_overlap, chunk_unit)
+        except OSError: pass # reported when the file is read
+        if not repository.is_unchanged(name, versions.get(name)): positions.append(i)
+    if verbose and len(positions) < len(files): log_print(f'{len(files) - len(positions)} unchanged files skipped')
+
+    def on_file_done(done: int, total: int, fname: str, error: Exception | None):
+        # files skipped before the one done are done as well
+        counts['files_done'] = positions[done - 1] + 1
+        if progress: progress(counts)
+
+    def on_file_error(fname: str, error: Exception):
+        counts['errors'].append({'file': fname, 'error': str(error)})
+        log_print(f'Failed to read {fname}: {error}')
+
+    def checkpoint():
+        # files before the one being read are complete once the index is saved
+        vectorService.save()
+        counts['files_checkpointed'] = counts['files_done']
+
+    sources = fu_iter_content_parallel([files[i] for i in positions], max_workers=parse_workers, progress=on_file_done, pdf_backend=pdf_backend, page_cache_dir=page_cache_dir or None)
+    length_function = fu_get_length_function(chunk_unit)
+    sources = ((fname, fu_iter_split_documents(documents, chunk_size, chunk_overlap, length_function)) for fname, documents in sources)
+    for new_docs, removed_ids in storage_iter_add_documents(
+        sources,
+        mongo_connect=mongo_connect,
+        mongo_dbname=mongo_dbname,
+        mongo_colname=mongo_colname,
+        checkpoint=checkpoint,
+        on_error=on_file_error,
+        versions=versions,
+        verbose=verbose,
+    ):
+        vectorService.update(new_docs, removed_ids=removed_ids, save=False)
+        counts['chunks_added'] += len(new_docs)
+        counts['chunks_removed'] += len(removed_ids)
+        if progress: progress(counts)
+
+    counts['files_checkpointed'] = counts['files_done'] = len(files)
+    return counts
+
+
+def ingest_run_job(
+    job: dict,
+    vectorService: VectorStoreService,
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+    parse_workers: int = None,
+    pdf_backend: str = 'auto',
+    page_cache_dir: str = PDFTEXT_CACHE_DIR,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+    chunk_overlap: int = INGEST_CHUNK_OVERLAP,
+    chunk_unit: str = 'chars',
+    on_progress: Callable[[dict], None] = None,
+    verbose: bool = False,
+):
+    """Runs a job taken from the queue, resumes after its last checkpoint
+
+    Args:
+        job (dict): job from jobs_claim
+        vectorService (VectorStoreService): writable vectorstore service
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): collection name. Defaults to 'documents'.
+        parse_workers (int, optional): document parsing processes. Defaults to None (number of CPUs).
+        pdf_backend (str, optional): PDF text extraction backend, see PDFTEXT_BACKENDS. Defaults to 'auto' (fastest installed).
+        page_cache_dir (str, optional): PDF page text cache directory, no caching if empty. Defaults to PDFTEXT_CACHE_DIR.
+        chunk_size (int, optional): chunk size in chunk_unit. Defaults to INGEST_CHUNK_SIZE.
+        chunk_overlap (int, optional): chunk overlap in chunk_unit. Defaults to INGEST_CHUNK_OVERLAP.
+        chunk_unit (str, optional): one of FU_SPLIT_UNITS. Defaults to 'chars'.
+        on_progress (Callable[[dict], None], optional): called with the job progress each time it is written. Defaults to None.
+        verbose (bool, optional): verbose output. Defaults to False.
+    """
+    mongo = {'mongo_connect': mongo_connect, 'mongo_dbname': mongo_dbname, 'mongo_colname': mongo_colname}
+    resumed = job['progress']
+    skip = resumed['files_checkpointed']
+    if skip: log_print(f'Resuming job {job["_id"]} after {skip} files')
+
+    last_write = 0.0
+    def progress(counts: dict, force: bool = False):
+        nonlocal last_write
+        if not force and time.monotonic() - last_write < INGEST_PROGRESS_INTERVAL: return
+        last_write = time.monotonic()
+        update = {
+            'files_done': skip + counts['files_done'],
+            'files_checkpointed': skip + counts['files_checkpointed'],
+            'chunks_added': resumed['chunks_added'] + counts['chunks_added'],
+            'chunks_removed': resumed['chunks_removed'] + counts['chunks_removed'],
+            'errors': resumed['errors'] + counts['errors'],
+        }
+        jobs_update(job['_id'], update, metrics=metrics_summary(), **mongo)
+        if on_progress: on_progress({**resumed, **update})
+
+    try:
+        counts = ingest_run(job['files'][skip:], vectorService, parse_workers=parse_workers, pdf_backend=pdf_backend, page_cache_dir=page_cache_dir, chunk_size=chunk_size, chunk_overlap=chunk_overlap, chunk_unit=chunk_unit, progress=progress, verbose=verbose, **mongo)
+        progress(counts, force=True)
+        jobs_finish(job['_id'], **mongo)
+    except Exception as e:
+        log_print(f'Job {job["_id"]} failed: {e}')
+        if verbose: traceback.print_exc()
+        jobs_finish(job['_id'], error=str(e), **mongo)
+
+    # spooled uploads are not needed anymore
+    shutil.rmtree(os.path.join(INGEST_UPLOAD_DIR, str(job['_id'])), ignore_errors=True)
+
+
+def ingest_worker(
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+    embedding: LLMBatchEmbeddings = None,
+    index_type: str = 'flat',
+    nprobe: int = VECTORSTORE_NPROBE,
+    ef_search: int = VECTORSTORE_EF_SEARCH,
+    codec: str = 'float32',
+    reduced_dim: int = 0,
+    reduction: str = 'pca',
+    rescore: int = 0,
+    parse_workers: int = None,
+    pdf_backend: str = 'auto',
+    page_cache_dir: str = PDFTEXT_CACHE_DIR,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+    chunk_overlap: int = INGEST_CHUNK_OVERLAP,
+    chunk_unit: str = 'chars',
+    parent_pid: int = None,
+    metrics_port: int = 0,
+    verbose: bool = False,
+):
+    """Takes jobs from the queue until the parent process exits (forever if no parent given)
+
+    Args:
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): collection name. Defaults to 'documents'.
+        embedding (LLMBatchEmbeddings, optional): embedding function. Defaults to None.
+        index_type (str, optional): one of VECTORSTORE_INDEX_TYPES. Defaults to 'flat'.
+        nprobe (int, optional): IVF lists visited per query. Defaults to VECTORSTORE_NPROBE.
+        ef_search (int, optional): HNSW search queue size. Defaults to VECTORSTORE_EF_SEARCH.
+        codec (str, optional): one of VECTORSTORE_CODECS. Defaults to 'float32'.
+        reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+        reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+        rescore (int, optional): keep exact vectors of a compressed index for re-scoring, see vectorstore_rank. Defaults to 0.
+        parse_workers (int, optional): document parsing processes. Defaults to None (number of CPUs).
+        pdf_backend (str, optional): PDF text extraction backend, see PDFTEXT_BACKENDS. Defaults to 'auto' (fastest installed).
+        page_cache_dir (str, optional): PDF page text cache directory, no caching if empty. Defaults to PDFTEXT_CACHE_DIR.
+        chunk_size (int, optional): chunk size in chunk_unit. Defaults to INGEST_CHUNK_SIZE.
+        chunk_overlap (int, optional): chunk overlap in chunk_unit. Defaults to INGEST_CHUNK_OVERLAP.
+        chunk_unit (str, optional): one of FU_SPLIT_UNITS. Defaults to 'chars'.
+        parent_pid (int, optional): exit when this process is gone. Defaults to None.
+        metrics_port (int, optional): serve metrics of this worker on http://127.0.0.1:port/metrics, 0 to disable. Defaults to 0.
+        verbose (bool, optional): verbose output. Defaults to False.
+    """
+    mongo = {'mongo_connect': mongo_connect, 'mongo_dbname': mongo_dbname, 'mongo_colname': mongo_colname}
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    vectorService = VectorStoreService(
+        **mongo, 
+        embedding=embedding, 
+        index_type=index_type, 
+        nprobe=nprobe, 
+        ef_search=ef_search, 
+        codec=codec, 
+        reduced_dim=reduced_dim, 
+        reduction=reduction, 
+        rescore=rescore,
+    )
+    log_print(f'Ingest worker {worker} started')
+    if metrics_port:
+        try: metrics_serve(metrics_port)
+        except OSError as e: log_print(f'Metrics are not served on port {metrics_port}: {e}')
+
+    while not parent_pid or os.getppid() == parent_pid:
+        if not jobs_pending(**mongo):
+            time.sleep(INGEST_POLL_INTERVAL)
+            continue
+
+        # one writer at a time: jobs are taken and run under the vectorstore lock
+        with vectorstore_lock():
+            job = jobs_claim(worker, **mongo)
+            if not job: continue
+            log_print(f'Job {job["_id"]}: {len(job["files"])} files')
+            vectorService.refresh(force=True)
+            ingest_run_job(job, vectorService, parse_workers=parse_workers, pdf_backend=pdf_backend, page_cache_dir=page_cache_dir, chunk_size=chunk_size, chunk_overlap=chunk_overlap, chunk_unit=chunk_unit, verbose=verbose, **mongo)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--mongo_connect', help='mongo connect url', default='mongodb://localhost:27017/', type=str)
+    parser.add_argument('--mongo_dbname', help='mongo database name', default='filechat', type=str)
+    parser.add_argument('--mongo_colname', help='mongo collection name', default='documents', type=str)
+    parser.add_argument('--ollama_model', help='ollama model name', default='llama3', type=str)
+    parser.add_argument('--ollama_base_url', help='ollama url:port', default='http://localhost:11434', type=str)
+    parser.add_argument('--embed_batch_size', help='texts per embedding request', default=LLM_EMBED_BATCH_SIZE, type=int)
+    parser.add_argument('--embed_workers', help='concurrent embedding requests', default=LLM_EMBED_MAX_WORKERS, type=int)
+    parser.add_argument('--embed_cache_dir', help='embedding cache directory (empty to disable)', default=EMBEDCACHE_DIR, type=str)
+    parser.add_argument('--embed_cache_size', help='embedding cache size limit in MB (fixed once the cache is created)', default=EMBEDCACHE_MAX_BYTES // 2**20, type=int)
+    parser.add_argument('--index_type', help=f'vector index type, approximate ones are used from {VECTORSTORE_ANN_MIN_VECTORS} chunks', default='flat', choices=VECTORSTORE_INDEX_TYPES, type=str)
+    parser.add_argument('--nprobe', help='IVF lists visited per query (ivf, ivfpq, sq8)', default=VECTORSTORE_NPROBE, type=int)
+    parser.add_argument('--ef_search', help='HNSW search queue size (hnsw)', default=VECTORSTORE_EF_SEARCH, type=int)
+    parser.add_argument('--codec', help=f'how vectors are stored: float16 halves memory, int8 quarters it (trained once a shard has {VECTORSTORE_TRAIN_MIN_VECTORS} chunks)', default='float32', choices=VECTORSTORE_CODECS, type=str)
+    parser.add_argument('--reduced_dim', help='store vectors with this many dimensions (0 keeps all)', default=0, type=int)
+    parser.add_argument('--reduction', help=f'dimension reduction: pca (trained once a shard has {VECTORSTORE_TRAIN_MIN_VECTORS} chunks) or truncate (Matryoshka embeddings)', default='pca', choices=VECTORSTORE_REDUCTIONS, type=str)
+    parser.add_argument('--rescore', help='re-rank rescore x k candidates of a compressed index by exact vectors kept on disk (0 to disable)', default=0, type=int)
+    parser.add_argument('--parse_workers', help='document parsing processes', default=os.cpu_count(), type=int)
+    parser.add_argument('--pdf_backend', help='PDF text extraction backend (auto picks the fastest installed)', default='auto', choices=['auto', *PDFTEXT_BACKENDS], type=str)
+    parser.add_argument('--page_cache_dir', help='PDF page text cache directory (empty to disable)', default=PDFTEXT_CACHE_DIR, type=str)
+    parser.add_argument('--chunk_size', help='chunk size in chunk units', default=INGEST_CHUNK_SIZE, type=int)
+    parser.add_argument('--chunk_overlap', help='overlap of neighbouring chunks in chunk units', default=INGEST_CHUNK_OVERLAP, type=int)
+    parser.add_argument('--chunk_unit', help='chunk size unit, tokens are counted with tiktoken if installed (estimated otherwise)', default='chars', choices=FU_SPLIT_UNITS, type=str)
+    parser.add_argument('--metrics_port', help='serve Prometheus metrics on this port (0 to disable)', default=0, type=int)
+    parser.add_argument('--parent_pid', help='exit when this process exits', default=None, type=int)
+    parser.add_argument('--verbose', help='verbose output', action='store_true')
+    args = parser.parse_args()
+
+    ingest_worker(
+        mongo_connect=args.mongo_connect,
+        mongo_dbname=args.mongo_dbname,
+        mongo_colname=args.mongo_colname,
+        embedding=llm_get_embedding_function(args.ollama_model, args.ollama_base_url, args.embed_batch_size, args.embed_workers, args.embed_cache_dir, args.embed_cache_size * 2**20),
+        index_type=args.index_type,
+        nprobe=args.nprobe,
+        ef_search=args.ef_search,
+        codec=args.codec,
+        reduced_dim=args.reduced_dim,
+        reduction=args.reduction,
+        rescore=args.rescore,
+        parse_workers=args.parse_workers,
+        pdf_backend=args.pdf_backend,
+        page_cache_dir=args.page_cache_dir,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        chunk_unit=args.chunk_unit,
+        parent_pid=args.parent_pid,
+        metrics_port=args.metrics_port,
+        verbose=args.verbose,
+    )
@@ -0,0 +1,276 @@
+# module jobs
+
+# system
+import time
+
+# db
+import pymongo
+from bson import ObjectId
+
+# local
+from storage import storage_get_client
+
+
+def jobs_get_collection(db: pymongo.MongoClient, mongo_dbname: str = 'filechat', mongo_colname: str = 'documents') -> pymongo.collection.Collection:
+    """Returns ingestion job collection
+
+    Args:
+        db (pymongo.MongoClient): mongo client
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+
+    Returns:
+        pymongo.collection.Collection: job collection {'_id', 'status', 'files', 'created', 'started', 'updated', 'finished', 'worker', 'progress', 'metrics', 'error'}
+    """
+    return db[mongo_dbname][f'{mongo_colname}_jobs']
+
+
+def jobs_submit(
+    files: list[str],
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+    job_id: ObjectId = None,
+) -> ObjectId:
+    """Queues an ingestion job
+
+    Args:
+        files (list[str]): filepaths
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+        job_id (ObjectId, optional): job id, generated if None. Defaults to None.
+
+    Returns:
+        ObjectId: job id
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    dbjobs.create_index([('status', 1), ('created', 1)])
+    job_id = job_id or ObjectId()
+    dbjobs.insert_one({
+        '_id': job_id,
+        'status': 'queued',
+        'files': files,
+        'created': time.time(),
+        'started': None,
+        'updated': None,
+        'finished': None,
+        'worker': None,
+        'progress': {'files_total': len(files), 'files_done': 0, 'files_checkpointed': 0, 'chunks_added': 0, 'chunks_removed': 0, 'errors': []},
+        'metrics': None,
+        'error': None,
+    })
+    return job_id
+
+
+def jobs_claim(
+    worker: str,
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+    job_id: ObjectId = None,
+) -> dict | None:
+    """Takes the oldest job, interrupted jobs are resumed before queued ones
+
+    Args:
+        worker (str): worker name
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+        job_id (ObjectId, optional): take this job only. Defaults to None (any job).
+
+    Returns:
+        dict | None: job or None if there is nothing to do
+
+    Note:
+        must be called with the vectorstore writer lock held: a job still 'running' then belongs to a worker that died
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    now = time.time()
+    for status in ['running', 'queued']:
+        job = dbjobs.find_one_and_update(
+            {'status': status, **({'_id': job_id} if job_id else {})},
+            {'$set': {'status': 'running', 'worker': worker, 'updated': now}},
+            sort=[('created', 1)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        if job:
+            if not job['started']:
+                dbjobs.update_one({'_id': job['_id']}, {'$set': {'started': now}})
+                job['started'] = now
+            return job
+    return None
+
+
+def jobs_find_unfinished(
+    files: list[str],
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+) -> dict | None:
+    """Finds a queued or interrupted job of the same files, so that it is resumed rather than submitted again
+
+    Args:
+        files (list[str]): filepaths in job order
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+
+    Returns:
+        dict | None: oldest such job or None
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    return dbjobs.find_one({'status': {'$in': ['queued', 'running']}, 'files': files}, sort=[('created', 1)])
+
+
+def jobs_pending(mongo_connect: str = 'mongodb://localhost:27017/', mongo_dbname: str = 'filechat', mongo_colname: str = 'documents') -> bool:
+    """Checks if there are jobs to take
+
+    Args:
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+
+    Returns:
+        bool: True if a job is queued or was interrupted
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    return dbjobs.find_one({'status': {'$in': ['queued', 'running']}}, {'_id': 1}) is not None
+
+
+def jobs_count(mongo_connect: str = 'mongodb://localhost:27017/', mongo_dbname: str = 'filechat', mongo_colname: str = 'documents') -> dict[str, int]:
+    """Counts jobs waiting and being run (queue depth)
+
+    Args:
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+
+    Returns:
+        dict[str, int]: {'queued', 'running'}
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    return {status: dbjobs.count_documents({'status': status}) for status in ['queued', 'running']}
+
+
+def jobs_update(
+    job_id: ObjectId,
+    progress: dict,
+    metrics: dict[str, dict] = None,
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+):
+    """Records job progress
+
+    Args:
+        job_id (ObjectId): job id
+        progress (dict): progress fields to set
+        metrics (dict[str, dict], optional): latency percentiles of the worker process, see metrics_summary. Defaults to None (unchanged).
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    update = {'updated': time.time(), **{f'progress.{k}': v for k, v in progress.items()}}
+    if metrics is not None: update['metrics'] = metrics
+    dbjobs.update_one({'_id': job_id}, {'$set': update})
+
+
+def jobs_finish(
+    job_id: ObjectId,
+    error: str = None,
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+):
+    """Marks job as done or failed
+
+    Args:
+        job_id (ObjectId): job id
+        error (str, optional): error that stopped the job. Defaults to None.
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    now = time.time()
+    dbjobs.update_one({'_id': job_id}, {'$set': {'status': 'failed' if error else 'done', 'error': error, 'updated': now, 'finished': now}})
+
+
+def jobs_list(
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+    limit: int = 5,
+) -> list[dict]:
+    """Returns status of active jobs and the most recent finished ones
+
+    Args:
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+        limit (int, optional): number of jobs. Defaults to 5.
+
+    Returns:
+        list[dict]: job statuses (see jobs_status), newest first
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    jobs = dbjobs.find({}, {'files': 0}).sort('created', pymongo.DESCENDING).limit(limit)
+    return [jobs_status(job) for job in jobs]
+
+
+def jobs_worker_metrics(
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+    limit: int = 20,
+) -> dict[str, dict]:
+    """Returns latency percentiles of the workers of recent jobs, as they last wrote them
+
+    Args:
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+        limit (int, optional): number of recently updated jobs to look at. Defaults to 20.
+
+    Returns:
+        dict[str, dict]: worker => stage => {'count', 'p50', 'p95'}, see metrics_summary
+    """
+    db = storage_get_client(mongo_connect)
+    dbjobs = jobs_get_collection(db, mongo_dbname, mongo_colname)
+    jobs = dbjobs.find({'metrics': {'$ne': None}}, {'worker': 1, 'metrics': 1}).sort('updated', pymongo.DESCENDING).limit(limit)
+    workers = {}
+    for job in jobs: workers.setdefault(job['worker'], job['metrics'])
+    return workers
+
+
+def jobs_status(job: dict) -> dict:
+    """Adds throughput and ETA to a job
+
+    Args:
+        job (dict): job
+
+    Returns:
+        dict: job with 'elapsed', 'files_per_s', 'chunks_per_s' and 'eta' (seconds, None if unknown)
+    """
+    progress = job['progress']
+    end = job['finished'] or time.time()
+    elapsed = end - job['started'] if job['started'] else 0.0
+    files_per_s = progress['files_done'] / elapsed if elapsed else 0.0
+    remaining = progress['files_total'] - progress['files_done']
+    return {
+        **job,
+        'elapsed': elapsed,
+        'files_per_s': files_per_s,
+        'chunks_per_s': progress['chunks_added'] / elapsed if elapsed else 0.0,
+        'eta': remaining / files_per_s if files_per_s and job['status'] == 'running' else None,
+    }
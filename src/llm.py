@@ -1,38 +1,288 @@
 # module llm
 
+# system
+import math
+import time
+import threading
+import collections
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# http
+import httpx
+
 # langchain
+from langchain_core.embeddings import Embeddings
 from langchain_community.embeddings import OllamaEmbeddings
 
 # ollama
 from ollama import Client as OllamaClient, Options as OllamaOptions
 
+# local
+from log import log_print
+from metrics import METRICS_STAGE, metrics_count, metrics_observe, metrics_span
+from embedcache import EmbeddingCache, embedcache_open, EMBEDCACHE_DIR, EMBEDCACHE_MAX_BYTES
+
+# constants
+LLM_EMBED_BATCH_SIZE = 32
+LLM_EMBED_MAX_WORKERS = 4
+LLM_EMBED_RETRIES = 3
+LLM_EMBED_BACKOFF = 0.5
+LLM_EMBED_TIMEOUT = 120
+LLM_QUERY_CACHE_SIZE = 1024
+
+
+class LLMBatchEmbeddings(Embeddings):
+    """Ollama embedding function that sends texts in batches over a bounded pool of concurrent requests
+
+    Vectors are L2-normalized, so results from '/api/embed' and the legacy '/api/embeddings' endpoint are interchangeable.
+    If a cache is given, texts embedded before are served from it without a request.
+    Query embeddings are kept in an in-process LRU, so a repeated question costs no request.
+    """
+    
+    def __init__(
+        self, 
+        model: str = 'llama3', 
+        base_url: str = 'http://localhost:11434', 
+        batch_size: int = LLM_EMBED_BATCH_SIZE, 
+        max_workers: int = LLM_EMBED_MAX_WORKERS,
+        retries: int = LLM_EMBED_RETRIES,
+        backoff: float = LLM_EMBED_BACKOFF,
+        timeout: float = LLM_EMBED_TIMEOUT,
+        cache: EmbeddingCache = None,
+        query_cache_size: int = LLM_QUERY_CACHE_SIZE,
+    ):
+        """Creates embedding function
+
+        Args:
+            model (str, optional): model name. Defaults to 'llama3'.
+            base_url (str, optional): connection url. Defaults to 'http://localhost:11434'.
+            batch_size (int, optional): texts per request. Defaults to LLM_EMBED_BATCH_SIZE.
+            max_workers (int, optional): concurrent requests. Defaults to LLM_EMBED_MAX_WORKERS.
+            retries (int, optional): retries per batch on connection or server errors. Defaults to LLM_EMBED_RETRIES.
+            backoff (float, optional): initial retry delay in seconds, doubled on every retry. Defaults to LLM_EMBED_BACKOFF.
+            timeout (float, optional): request timeout in seconds. Defaults to LLM_EMBED_TIMEOUT.
+            cache (EmbeddingCache, optional): embedding cache. Defaults to None.
+            query_cache_size (int, optional): query embeddings kept in memory. Defaults to LLM_QUERY_CACHE_SIZE.
+        """
+        self.model = model
+        self.base_url = base_url
+        self.batch_size = max(1, batch_size)
+        self.max_workers = max(1, max_workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.query_cache_size = query_cache_size
+        self.query_cache = collections.OrderedDict() # normalized query => embedding, least recently used first
+        self.query_hits = 0
+        self.query_misses = 0
+        self._client = None
+        self._legacy_api = False
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_client'] = None
+        state['_lock'] = None
+        state['cache'] = None
+        state['query_cache'] = collections.OrderedDict()
+        return state
+    
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents
+
+        Args:
+            texts (list[str]): texts
+
+        Returns:
+            list[list[float]]: embeddings in the order of texts
+        """
+        embeddings = [None] * len(texts)
+        for positions, vectors in self.embed_batches(texts):
+            for i, vector in zip(positions, vectors): embeddings[i] = vector
+        return embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed query
+
+        Args:
+            text (str): query text
+
+        Returns:
+            list[float]: embedding
+        """
+        key = EmbeddingCache.normalize(text)
+        with self._lock:
+            if key in self.query_cache:
+                self.query_hits += 1
+                metrics_count('filechat_cache_requests_total', cache='query', result='hit')
+                self.query_cache.move_to_end(key)
+                return self.query_cache[key]
+            self.query_misses += 1
+            metrics_count('filechat_cache_requests_total', cache='query', result='miss')
+        
+        embedding = self.embed_batch([text])[0]
+        with self._lock:
+            self.query_cache[key] = embedding
+            while len(self.query_cache) > self.query_cache_size: self.query_cache.popitem(last=False)
+        return embedding
+
+    def embed_batches(self, texts: list[str]) -> Iterator[tuple[list[int], list[list[float]]]]:
+        """Embeds texts batch by batch, yields batches as soon as they arrive (in any order)
+
+        Args:
+            texts (list[str]): texts
 
-def llm_get_embedding_function(model: str = 'llama3', base_url: str = 'http://localhost:11434') -> OllamaEmbeddings:
+        Yields:
+            Iterator[tuple[list[int], list[list[float]]]]: positions of the batch in texts, embeddings
+        """
+        positions = list(range(len(texts)))
+        
+        # serve cached embeddings first
+        if self.cache:
+            cached = self.cache.get_many(texts)
+            hits = [i for i, vector in enumerate(cached) if vector is not None]
+            for start in range(0, len(hits), self.batch_size * 32):
+                part = hits[start:start + self.batch_size * 32]
+                yield part, [cached[i] for i in part]
+            positions = [i for i, vector in enumerate(cached) if vector is None]
+            del cached
+        
+        batches = (positions[start:start + self.batch_size] for start in range(0, len(positions), self.batch_size))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # keep a bounded number of batches in flight
+            pending = {}
+            for batch in batches:
+                pending[executor.submit(self.embed_batch, [texts[i] for i in batch])] = batch
+                if len(pending) < 2 * self.max_workers: continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done: yield self.store_batch(texts, pending.pop(future), future.result())
+            
+            # drain
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done: yield self.store_batch(texts, pending.pop(future), future.result())
+
+    def store_batch(self, texts: list[str], positions: list[int], vectors: list[list[float]]) -> tuple[list[int], list[list[float]]]:
+        """Saves embedded batch to cache
+
+        Args:
+            texts (list[str]): all texts
+            positions (list[int]): positions of the batch in texts
+            vectors (list[list[float]]): embeddings of the batch
+
+        Returns:
+            tuple[list[int], list[list[float]]]: positions, embeddings
+        """
+        if self.cache: self.cache.put_many([texts[i] for i in positions], vectors)
+        return positions, vectors
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """Embeds a single batch with one request, retries with exponential backoff
+
+        Args:
+            texts (list[str]): texts
+
+        Returns:
+            list[list[float]]: embeddings
+        """
+        metrics_count('filechat_embedded_texts_total', len(texts))
+        with metrics_span('embed'):
+            for attempt in range(self.retries + 1):
+                try:
+                    if not self._legacy_api:
+                        response = self.get_client().post('/api/embed', json={'model': self.model, 'input': texts})
+                        if response.status_code != 404:
+                            response.raise_for_status()
+                            return response.json()['embeddings']
+                    
+                        # ollama < 0.3 has no batch endpoint
+                        log_print('/api/embed is not supported, falling back to /api/embeddings')
+                        self._legacy_api = True
+                    return [self.embed_legacy(text) for text in texts]
+                except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                    retryable = isinstance(e, httpx.TransportError) or e.response.status_code in (429, 500, 502, 503, 504)
+                    if not retryable or attempt == self.retries: raise
+                    log_print(f'embedding request failed ({e}), retrying...')
+                    time.sleep(self.backoff * 2**attempt)
+
+    def embed_legacy(self, text: str) -> list[float]:
+        """Embeds a single text using '/api/embeddings' endpoint
+
+        Args:
+            text (str): text
+
+        Returns:
+            list[float]: L2-normalized embedding
+        """
+        response = self.get_client().post('/api/embeddings', json={'model': self.model, 'prompt': text})
+        response.raise_for_status()
+        embedding = response.json()['embedding']
+        norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+        return [x / norm for x in embedding]
+
+    def get_client(self) -> httpx.Client:
+        """Returns shared keep-alive http client (created on first use)
+
+        Returns:
+            httpx.Client: http client
+        """
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(
+                    base_url=self.base_url,
+                    timeout=self.timeout,
+                    limits=httpx.Limits(max_connections=self.max_workers, max_keepalive_connections=self.max_workers),
+                )
+            return self._client
+
+
+def llm_get_embedding_function(
+    model: str = 'llama3', 
+    base_url: str = 'http://localhost:11434',
+    batch_size: int = LLM_EMBED_BATCH_SIZE,
+    max_workers: int = LLM_EMBED_MAX_WORKERS,
+    cache_dir: str = EMBEDCACHE_DIR,
+    cache_size: int = EMBEDCACHE_MAX_BYTES,
+) -> LLMBatchEmbeddings:
     """Get ollama embedding function
 
     Args:
         model (str, optional): model name. Defaults to 'llama3'.
         base_url (_type_, optional): connection url. Defaults to 'http://localhost:11434'.
+        batch_size (int, optional): texts per request. Defaults to LLM_EMBED_BATCH_SIZE.
+        max_workers (int, optional): concurrent requests. Defaults to LLM_EMBED_MAX_WORKERS.
+        cache_dir (str, optional): embedding cache directory, no caching if empty. Defaults to EMBEDCACHE_DIR.
+        cache_size (int, optional): embedding cache size limit in bytes. Defaults to EMBEDCACHE_MAX_BYTES.
 
     Returns:
-        OllamaEmbeddings: embedding
+        LLMBatchEmbeddings: embedding
     """
-    return OllamaEmbeddings(model=model, base_url=base_url)
+    return LLMBatchEmbeddings(
+        model=model, 
+        base_url=base_url, 
+        batch_size=batch_size, 
+        max_workers=max_workers, 
+        cache=embedcache_open(cache_dir, model, cache_size) if cache_dir else None,
+    )
 
 
-def llm_model_chat(prompt: str, ollama_client: OllamaClient, system_task: str = 'You are an intelligent AI assistant.', model='llama3') -> str:
-    """Chat with Ollama
+def llm_make_messages(prompt: str, system_task: str = 'You are an intelligent AI assistant.') -> list[dict]:
+    """Creates chat messages
 
     Args:
         prompt (str): prompt
-        ollama_client (OllamaClient): ollama client
         system_task (str, optional): system task. Defaults to 'You are an intelligent AI assistant.'.
-        model (str, optional): model name. Defaults to 'llama3'.
 
     Returns:
-        str: response
+        list[dict]: messages
     """
-    response = ollama_client.chat(model=model, messages=[
+    return [
         {
             'role': 'system',
             'content': system_task,
@@ -41,5 +291,83 @@ def llm_model_chat(prompt: str, ollama_client: OllamaClient, system_task: str =
             'role': 'user',
             'content': prompt
         },
-    ], options=OllamaOptions(temperature=0))
+    ]
+
+
+def llm_model_chat(prompt: str, ollama_client: OllamaClient, system_task: str = 'You are an intelligent AI assistant.', model='llama3') -> str:
+    """Chat with Ollama
+
+    Args:
+        prompt (str): prompt
+        ollama_client (OllamaClient): ollama client
+        system_task (str, optional): system task. Defaults to 'You are an intelligent AI assistant.'.
+        model (str, optional): model name. Defaults to 'llama3'.
+
+    Returns:
+        str: response
+    """
+    with metrics_span('generate'):
+        response = ollama_client.chat(model=model, messages=llm_make_messages(prompt, system_task), options=OllamaOptions(temperature=0))
+    metrics_count('filechat_generated_tokens_total', response.get('eval_count', 0))
     return response['message']['content']
+
+
+def llm_model_chat_stream(
+    prompt: str, 
+    ollama_client: OllamaClient, 
+    system_task: str = 'You are an intelligent AI assistant.', 
+    model='llama3', 
+    stats: dict = None,
+) -> Iterator[str]:
+    """Chat with Ollama, yields response tokens as they are generated
+
+    Args:
+        prompt (str): prompt
+        ollama_client (OllamaClient): ollama client
+        system_task (str, optional): system task. Defaults to 'You are an intelligent AI assistant.'.
+        model (str, optional): model name. Defaults to 'llama3'.
+        stats (dict, optional): filled with {'ttft', 'tokens', 'tokens_per_s', 'prompt_tokens', 'total'} once generation ends. Defaults to None.
+
+    Yields:
+        Iterator[str]: response pieces
+    """
+    start = time.perf_counter()
+    ttft = None
+    chunks = 0
+    final = {}
+    for chunk in ollama_client.chat(model=model, messages=llm_make_messages(prompt, system_task), options=OllamaOptions(temperature=0), stream=True):
+        content = chunk['message']['content']
+        if content:
+            if ttft is None: ttft = time.perf_counter() - start
+            chunks += 1
+            yield content
+        if chunk.get('done'): final = chunk
+    result = llm_chat_stats(time.perf_counter() - start, ttft, chunks, final)
+    metrics_observe(METRICS_STAGE, result['total'], stage='generate')
+    metrics_observe('filechat_time_to_first_token_seconds', result['ttft'])
+    metrics_count('filechat_generated_tokens_total', result['tokens'])
+    metrics_count('filechat_prompt_tokens_total', result['prompt_tokens'])
+    if stats is not None: stats.update(result)
+
+
+def llm_chat_stats(total: float, ttft: float | None, chunks: int, final: dict) -> dict:
+    """Returns generation stats of a streamed chat, server-side counters are preferred, every streamed chunk is a token otherwise
+
+    Args:
+        total (float): seconds from request to the last chunk
+        ttft (float | None): seconds to the first content, None if nothing was generated
+        chunks (int): chunks with content
+        final (dict): last chunk ('done'), empty if not received
+
+    Returns:
+        dict: {'ttft', 'tokens', 'tokens_per_s', 'prompt_tokens', 'total'}
+    """
+    tokens = final.get('eval_count') or chunks
+    eval_seconds = final.get('eval_duration', 0) / 1e9 or (total - (ttft or 0))
+    return {
+        'ttft': ttft or total,
+        'tokens': tokens,
+        'tokens_per_s': tokens / eval_seconds if eval_seconds > 0 else 0.0,
+        'prompt_tokens': final.get('prompt_eval_count', 0),
+        'total': total,
+    }
@@ -0,0 +1,305 @@
+# module llmgateway
+
+# system
+import time
+import queue
+import asyncio
+import threading
+import collections
+from typing import Iterator
+
+# http
+import httpx
+
+# ollama
+from ollama import AsyncClient as OllamaAsyncClient, Options as OllamaOptions
+
+# local
+from metrics import METRICS_STAGE, metrics_count, metrics_gauge, metrics_observe
+from llm import llm_make_messages, llm_chat_stats
+
+# constants
+LLMGATEWAY_MAX_CONCURRENCY = 4  # generations sent to the server at once, like OLLAMA_NUM_PARALLEL
+LLMGATEWAY_QUEUE_TIMEOUT = 120  # seconds a request waits for a free slot before it fails
+LLMGATEWAY_TIMEOUT = 300        # seconds of connect/read timeout of a generation
+LLMGATEWAY_WAIT_WINDOW = 1024   # recent queue waits kept for percentiles
+
+
+class LLMFlight:
+    """Generation shared by identical requests: pieces are kept, so a request that joins late gets them from the start"""
+
+    def __init__(self):
+        self.pieces = []
+        self.final = {}
+        self.error = None
+        self.done = False
+        self.wait = 0.0
+        self.subscribers = 0
+        self.task = None
+        self.updated = asyncio.Event()
+
+    def notify(self):
+        """Wakes up subscribers, they wait on the event taken before they checked for news"""
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+
+class LLMGateway:
+    """Chat requests of all sessions of a process go through one gateway to the Ollama server
+
+    Generations run on an event loop in a background thread over one keep-alive http connection pool. At most
+    'max_concurrency' of them are sent to the server at once, the rest wait in a queue that serves sessions in turns,
+    so a session asking many questions does not hold up the others. Identical requests (model, system task and prompt)
+    that are in flight at the same time are generated once and streamed to all of them; answers are generated with
+    temperature 0, so they would be the same anyway.
+    """
+
+    def __init__(
+        self,
+        base_url: str = 'http://localhost:11434',
+        max_concurrency: int = LLMGATEWAY_MAX_CONCURRENCY,
+        queue_timeout: float = LLMGATEWAY_QUEUE_TIMEOUT,
+        timeout: float = LLMGATEWAY_TIMEOUT,
+    ):
+        """Creates gateway and starts its event loop
+
+        Args:
+            base_url (str, optional): connection url. Defaults to 'http://localhost:11434'.
+            max_concurrency (int, optional): generations sent to the server at once. Defaults to LLMGATEWAY_MAX_CONCURRENCY.
+            queue_timeout (float, optional): seconds a request waits for a slot, 0 to wait as long as it takes. Defaults to LLMGATEWAY_QUEUE_TIMEOUT.
+            timeout (float, optional): connect/read timeout of a generation in seconds. Defaults to LLMGATEWAY_TIMEOUT.
+        """
+        self.base_url = base_url
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.active = 0
+        self.queued = 0
+        self.waiting = collections.OrderedDict() # session => futures of its waiting requests, next session to be served first
+        self.flights = {}                        # (model, system task, prompt) => LLMFlight in progress
+        self.requests = 0
+        self.coalesced = 0
+        self.waits = collections.deque(maxlen=LLMGATEWAY_WAIT_WINDOW)
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.transport = None
+        self.thread = threading.Thread(target=self.loop.run_forever, name='llmgateway', daemon=True)
+        self.thread.start()
+
+    def chat_stream(
+        self,
+        prompt: str,
+        model: str = 'llama3',
+        session: str = None,
+        system_task: str = 'You are an intelligent AI assistant.',
+        stats: dict = None,
+    ) -> Iterator[str]:
+        """Chat with Ollama through the gateway, yields response pieces as they are generated (see llm_model_chat_stream)
+
+        Args:
+            prompt (str): prompt
+            model (str, optional): model name. Defaults to 'llama3'.
+            session (str, optional): session id, requests are queued in turns by session. Defaults to None.
+            system_task (str, optional): system task. Defaults to 'You are an intelligent AI assistant.'.
+            stats (dict, optional): filled with {'ttft', 'tokens', 'tokens_per_s', 'prompt_tokens', 'total', 'queue_wait', 'coalesced'}
+                once generation ends. Defaults to None.
+
+        Raises:
+            TimeoutError: no slot was free within queue_timeout
+
+        Yields:
+            Iterator[str]: response pieces
+        """
+        start = time.perf_counter()
+        ttft = None
+        chunks = 0
+        flight = None
+        pieces = queue.Queue()
+        request = asyncio.run_coroutine_threadsafe(self.request((model, system_task, prompt), session, pieces), self.loop)
+        try:
+            while flight is None:
+                piece, flight = pieces.get()
+                if flight is not None: break
+                if ttft is None: ttft = time.perf_counter() - start
+                chunks += 1
+                yield piece
+        finally:
+            # a consumer that stops early leaves the generation, it is cancelled once nobody follows it
+            if flight is None: request.cancel()
+        if flight.error is not None: raise flight.error
+
+        result = llm_chat_stats(time.perf_counter() - start, ttft, chunks, flight.final)
+        metrics_observe(METRICS_STAGE, result['total'] - flight.wait, stage='generate')
+        metrics_observe('filechat_time_to_first_token_seconds', result['ttft'])
+        if stats is not None: stats.update({**result, 'queue_wait': flight.wait, 'coalesced': request.result()})
+
+    def chat(self, prompt: str, model: str = 'llama3', session: str = None, system_task: str = 'You are an intelligent AI assistant.') -> str:
+        """Chat with Ollama through the gateway
+
+        Args:
+            prompt (str): prompt
+            model (str, optional): model name. Defaults to 'llama3'.
+            session (str, optional): session id. Defaults to None.
+            system_task (str, optional): system task. Defaults to 'You are an intelligent AI assistant.'.
+
+        Returns:
+            str: response
+        """
+        return ''.join(self.chat_stream(prompt, model, session, system_task))
+
+    def stats(self) -> dict:
+        """Returns gateway state
+
+        Returns:
+            dict: {'active', 'queued', 'requests', 'coalesced', 'wait_p50', 'wait_p95'}, waits in seconds over recent requests
+        """
+        waits = sorted(self.waits.copy())
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'requests': self.requests,
+            'coalesced': self.coalesced,
+            'wait_p50': waits[int(0.50 * (len(waits) - 1))] if waits else 0.0,
+            'wait_p95': waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+        }
+
+    def close(self):
+        """Stops the event loop, requests in progress are cancelled"""
+        async def shutdown():
+            for flight in list(self.flights.values()): flight.task.cancel()
+            if self.transport is not None: await self.transport.aclose() # ollama's client has no close(), its connections are ours
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def request(self, key: tuple[str, str, str], session: str, pieces: queue.Queue) -> bool:
+        """Follows the generation of a request: joins an identical one in flight or starts it,
+        puts (piece, None) for every piece and (None, flight) at the end into pieces
+
+        Returns:
+            bool: whether an identical request was in flight
+        """
+        self.requests += 1
+        flight = self.flights.get(key)
+        coalesced = flight is not None
+        if coalesced:
+            self.coalesced += 1
+            metrics_count('filechat_llm_requests_total', result='coalesced')
+        else:
+            flight = self.flights[key] = LLMFlight()
+            flight.task = self.loop.create_task(self.generate(key, session, flight))
+
+        flight.subscribers += 1
+        try:
+            sent = 0
+            while True:
+                updated = flight.updated
+                while sent < len(flight.pieces):
+                    pieces.put((flight.pieces[sent], None))
+                    sent += 1
+                if flight.done: break
+                await updated.wait()
+            pieces.put((None, flight))
+            return coalesced
+        finally:
+            # nobody follows the generation any more, a new identical request starts over
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                if self.flights.get(key) is flight: del self.flights[key]
+                flight.task.cancel()
+
+    async def generate(self, key: tuple[str, str, str], session: str, flight: LLMFlight):
+        """Generates the answer of a flight once a slot is free"""
+        model, system_task, prompt = key
+        try:
+            start = time.perf_counter()
+            await self.acquire(session)
+            flight.wait = time.perf_counter() - start
+            self.waits.append(flight.wait)
+            metrics_observe('filechat_llm_queue_wait_seconds', flight.wait)
+            try:
+                chunks = 0
+                stream = await self.get_client().chat(model=model, messages=llm_make_messages(prompt, system_task), options=OllamaOptions(temperature=0), stream=True)
+                try:
+                    async for chunk in stream:
+                        content = chunk['message']['content']
+                        if content:
+                            flight.pieces.append(content)
+                            chunks += 1
+                            flight.notify()
+                        if chunk.get('done'): flight.final = chunk
+                finally: await stream.aclose() # returns the connection to the pool when cancelled
+            finally: self.release()
+            metrics_count('filechat_generated_tokens_total', flight.final.get('eval_count') or chunks)
+            metrics_count('filechat_prompt_tokens_total', flight.final.get('prompt_eval_count', 0))
+            metrics_count('filechat_llm_requests_total', result='generated')
+        except asyncio.CancelledError:
+            metrics_count('filechat_llm_requests_total', result='cancelled')
+            raise
+        except Exception as e:
+            flight.error = e
+            metrics_count('filechat_llm_requests_total', result='timeout' if isinstance(e, TimeoutError) else 'error')
+        finally:
+            flight.done = True
+            flight.notify()
+            if self.flights.get(key) is flight: del self.flights[key]
+
+    async def acquire(self, session: str):
+        """Waits for a free slot, sessions are served in turns
+
+        Args:
+            session (str): session id
+
+        Raises:
+            TimeoutError: no slot was free within queue_timeout
+        """
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            self.update_gauges()
+            return
+
+        # the slot is handed over by release(), active stays the same
+        future = self.loop.create_future()
+        self.waiting.setdefault(session, collections.deque()).append(future)
+        self.update_gauges()
+        try: await asyncio.wait_for(future, self.queue_timeout or None)
+        except BaseException as e:
+            if future.done() and not future.cancelled(): self.release()
+            else:
+                futures = self.waiting.get(session)
+                if futures is not None and future in futures:
+                    futures.remove(future)
+                    if not futures: del self.waiting[session]
+                self.update_gauges()
+            if isinstance(e, asyncio.TimeoutError): raise TimeoutError(f'No free slot for a generation within {self.queue_timeout}s') from None
+            raise
+
+    def release(self):
+        """Hands the slot to the first request of the next session in turn, frees it if nobody waits"""
+        while self.waiting:
+            session, futures = next(iter(self.waiting.items()))
+            future = futures.popleft()
+            if futures: self.waiting.move_to_end(session)
+            else: del self.waiting[session]
+            if not future.done():
+                future.set_result(None)
+                self.update_gauges()
+                return
+        self.active -= 1
+        self.update_gauges()
+
+    def update_gauges(self):
+        self.queued = sum(len(futures) for futures in self.waiting.values())
+        metrics_gauge('filechat_llm_active_requests', self.active)
+        metrics_gauge('filechat_llm_queue_depth', self.queued)
+
+    def get_client(self) -> OllamaAsyncClient:
+        """Returns shared keep-alive client (created on first use, in the event loop)
+
+        Returns:
+            OllamaAsyncClient: ollama client
+        """
+        if self.client is None:
+            self.transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency))
+            self.client = OllamaAsyncClient(self.base_url, timeout=self.timeout, transport=self.transport)
+        return self.client
@@ -4,24 +4,23 @@
 import os
 import sys
 import time
+import uuid
 import argparse
+import importlib
+import subprocess
+from typing import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # webui
 import streamlit as st
 
-# langchain
-from langchain.prompts import ChatPromptTemplate
-from langchain.chains.question_answering import load_qa_chain
-
-# ollama
-from ollama import Client as OllamaClient
-
-# local
-from llm import *
+# local (the rest is imported in the background once per server process, while the page is drawn)
+from log import log_print
+from metrics import *
 from widgets import *
-from storage import *
-from vectorstore import *
-from fileuploader import *
+
+# constants
+MAIN_MODULES = ['ingest', 'answercache', 'rerank', 'llmgateway', 'langchain.prompts', 'ollama'] # imported while warming up, with their dependencies
 
 
 PROMPT_TEMPLATE = """
@@ -39,13 +38,205 @@ ONLY DIRECT ANSWERS. DO NOT ADD ANY COMMENTS OR EXPLANATIONS. NO NARRATOR OR AI
 """
 
 
+@st.cache_resource
+def get_vectorstore_service(
+    mongo_connect: str, 
+    mongo_dbname: str, 
+    mongo_colname: str, 
+    ollama_model: str, 
+    ollama_base_url: str, 
+    embed_batch_size: int, 
+    embed_workers: int, 
+    embed_cache_dir: str, 
+    embed_cache_size: int,
+    index_type: str,
+    nprobe: int,
+    ef_search: int,
+    retrieval: str,
+    codec: str,
+    reduced_dim: int,
+    reduction: str,
+    rescore: int,
+) -> 'VectorStoreService':
+    """Returns vectorstore service shared by all sessions of this server process, the index is written by ingest workers
+    and loaded in the background (see VectorStoreService.ready)
+
+    Returns:
+        VectorStoreService: vectorstore service
+    """
+    return VectorStoreService(
+        mongo_connect=mongo_connect,
+        mongo_dbname=mongo_dbname,
+        mongo_colname=mongo_colname,
+        embedding=llm_get_embedding_function(ollama_model, ollama_base_url, embed_batch_size, embed_workers, embed_cache_dir, embed_cache_size),
+        index_type=index_type,
+        nprobe=nprobe,
+        ef_search=ef_search,
+        writable=False,
+        retrieval=retrieval,
+        background=True,
+        codec=codec,
+        reduced_dim=reduced_dim,
+        reduction=reduction,
+        rescore=rescore,
+    )
+
+
+@st.cache_resource
+def get_prompt_template() -> 'ChatPromptTemplate':
+    """Returns chat prompt, parsed once per server process
+
+    Returns:
+        ChatPromptTemplate: prompt template
+    """
+    from langchain.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+
+
+@st.cache_resource
+def get_answer_cache(max_entries: int, ttl: float, threshold: float) -> 'AnswerCache | None':
+    """Returns answer cache shared by all sessions of this server process
+
+    Returns:
+        AnswerCache | None: answer cache or None if disabled
+    """
+    return AnswerCache(max_entries, ttl, threshold) if max_entries > 0 else None
+
+
+@st.cache_resource
+def get_llm_gateway(ollama_base_url: str, max_concurrency: int, queue_timeout: float) -> 'LLMGateway':
+    """Returns chat gateway shared by all sessions of this server process
+
+    Returns:
+        LLMGateway: gateway
+    """
+    return LLMGateway(ollama_base_url, max_concurrency, queue_timeout)
+
+
+@st.cache_resource
+def get_modules() -> Future:
+    """Imports MAIN_MODULES in the background once per server process
+
+    Returns:
+        Future: done once the modules are imported
+    """
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='warmup')
+    future = executor.submit(lambda: [importlib.import_module(module) for module in MAIN_MODULES])
+    executor.shutdown(wait=False)
+    return future
+
+
+@st.cache_resource
+def get_metrics_server(port: int):
+    """Serves metrics of this server process once, on http://127.0.0.1:port/metrics"""
+    if not port: return None
+    try: return metrics_serve(port)
+    except OSError as e: log_print(f'Metrics are not served on port {port}: {e}')
+
+
+@st.cache_resource
+def get_ingest_workers(count: int, argv: tuple[str], metrics_port: int = 0) -> list[subprocess.Popen]:
+    """Starts ingest worker processes once per server process, they exit together with it
+
+    Args:
+        count (int): number of workers
+        argv (tuple[str]): worker options
+        metrics_port (int, optional): metrics port of this process, workers serve theirs on the following ports. Defaults to 0 (disabled).
+
+    Returns:
+        list[subprocess.Popen]: worker processes
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ingest.py')
+    return [
+        subprocess.Popen([sys.executable, script, *argv, '--parent_pid', str(os.getpid()), '--metrics_port', str(metrics_port + 1 + i if metrics_port else 0)]) 
+        for i in range(count)
+    ]
+
+
+@st.experimental_fragment(run_every=2)
+def show_jobs(mongo_connect: str, mongo_dbname: str, mongo_colname: str):
+    """Polls ingestion jobs, picks up index generations saved by workers"""
+    jobs = [job for job in jobs_list(mongo_connect, mongo_dbname, mongo_colname) if job['status'] in ['queued', 'running'] or time.time() - job['finished'] < 30]
+    if jobs:
+        with st.expander('Indexing', expanded=True):
+            for job in jobs: widget_job_status(job)
+    for status, count in jobs_count(mongo_connect, mongo_dbname, mongo_colname).items(): metrics_gauge('filechat_jobs', count, status=status)
+    vectorService.refresh()
+
+
+def delete_documents(vectorService: 'VectorStoreService'):
+    """Deletes the documents selected in 'Search in' and clears the selection, the outcome is shown by the next run"""
+    sources = st.session_state.search_sources
+    st.session_state.deleted_sources = len(sources) if vectorService.delete(sources) else None
+    if st.session_state.deleted_sources is not None: st.session_state.search_sources = []
+
+
+@st.experimental_fragment(run_every=0.5)
+def show_warmup(ready: Callable[[], bool], message: str):
+    """Shows warming up state, reruns the app once ready"""
+    if ready(): st.rerun()
+    widget_warmup(message)
+
+
+@st.experimental_fragment(run_every=5)
+def show_metrics(mongo_connect: str, mongo_dbname: str, mongo_colname: str):
+    """Shows live latency percentiles of this server process and those the ingest workers last wrote to their jobs"""
+    widget_metrics({'app': metrics_summary(), **{f'worker {worker}': summary for worker, summary in jobs_worker_metrics(mongo_connect, mongo_dbname, mongo_colname).items()}})
+
+
 if __name__ == '__main__':
+    # the first run of a server process draws the page while the modules are imported
+    modules = get_modules()
+    if not modules.done():
+        with st.sidebar: st.title('🤗💬 LLM File Chat')
+        st.header("Chat with files 💬")
+        show_warmup(modules.done, 'Warming up: loading modules...')
+        st.stop()
+    modules.result()
+    from llm import *
+    from storage import *
+    from vectorstore import *
+    from fileuploader import *
+    from ingest import *
+    from answercache import *
+    from rerank import *
+    from llmgateway import *
+    from bson import ObjectId
+    
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--mongo_connect', help='mongo connect url', default='mongodb://localhost:27017/', type=str)
     parser.add_argument('--mongo_dbname', help='mongo database name', default='filechat', type=str)
     parser.add_argument('--mongo_colname', help='mongo collection name', default='documents', type=str)
     parser.add_argument('--ollama_model', help='ollama model name', default='llama3', type=str)
     parser.add_argument('--ollama_base_url', help='ollama url:port', default='http://localhost:11434', type=str)
+    parser.add_argument('--embed_batch_size', help='texts per embedding request', default=LLM_EMBED_BATCH_SIZE, type=int)
+    parser.add_argument('--embed_workers', help='concurrent embedding requests', default=LLM_EMBED_MAX_WORKERS, type=int)
+    parser.add_argument('--embed_cache_dir', help='embedding cache directory (empty to disable)', default=EMBEDCACHE_DIR, type=str)
+    parser.add_argument('--embed_cache_size', help='embedding cache size limit in MB (fixed once the cache is created)', default=EMBEDCACHE_MAX_BYTES // 2**20, type=int)
+    parser.add_argument('--index_type', help=f'vector index type, approximate ones are used from {VECTORSTORE_ANN_MIN_VECTORS} chunks', default='flat', choices=VECTORSTORE_INDEX_TYPES, type=str)
+    parser.add_argument('--nprobe', help='IVF lists visited per query (ivf, ivfpq, sq8)', default=VECTORSTORE_NPROBE, type=int)
+    parser.add_argument('--ef_search', help='HNSW search queue size (hnsw)', default=VECTORSTORE_EF_SEARCH, type=int)
+    parser.add_argument('--codec', help=f'how vectors are stored: float16 halves memory, int8 quarters it (trained once a shard has {VECTORSTORE_TRAIN_MIN_VECTORS} chunks)', default='float32', choices=VECTORSTORE_CODECS, type=str)
+    parser.add_argument('--reduced_dim', help='store vectors with this many dimensions (0 keeps all)', default=0, type=int)
+    parser.add_argument('--reduction', help=f'dimension reduction: pca (trained once a shard has {VECTORSTORE_TRAIN_MIN_VECTORS} chunks) or truncate (Matryoshka embeddings)', default='pca', choices=VECTORSTORE_REDUCTIONS, type=str)
+    parser.add_argument('--rescore', help='re-rank rescore x k candidates of a compressed index by exact vectors kept on disk (0 to disable)', default=0, type=int)
+    parser.add_argument('--retrieval', help='hybrid fuses keyword (BM25) and vector search results, vector uses embeddings only', default='hybrid', choices=VECTORSTORE_RETRIEVAL_MODES, type=str)
+    parser.add_argument('--k', help='passages (joined neighbouring chunks) put into a prompt', default=5, type=int)
+    parser.add_argument('--fetch_k', help='chunks retrieved for reranking, deduplication and packing into --context_tokens (0 sends the top k chunks as they are)', default=RERANK_FETCH_K, type=int)
+    parser.add_argument('--context_tokens', help='tokens of context put into a prompt (0 for no limit)', default=RERANK_CONTEXT_TOKENS, type=int)
+    parser.add_argument('--llm_concurrency', help='answers generated at once by all sessions, the rest wait in turns (match OLLAMA_NUM_PARALLEL)', default=LLMGATEWAY_MAX_CONCURRENCY, type=int)
+    parser.add_argument('--llm_queue_timeout', help='seconds a question waits for generation to start (0 to wait as long as it takes)', default=LLMGATEWAY_QUEUE_TIMEOUT, type=float)
+    parser.add_argument('--answer_cache_size', help='answers kept for repeated questions (0 to disable)', default=ANSWERCACHE_MAX_ENTRIES, type=int)
+    parser.add_argument('--answer_cache_ttl', help='seconds an answer is kept', default=ANSWERCACHE_TTL, type=float)
+    parser.add_argument('--answer_cache_threshold', help='cosine similarity at which questions share an answer', default=ANSWERCACHE_THRESHOLD, type=float)
+    parser.add_argument('--parse_workers', help='document parsing processes per ingest worker', default=os.cpu_count(), type=int)
+    parser.add_argument('--pdf_backend', help='PDF text extraction backend (auto picks the fastest installed)', default='auto', choices=['auto', *PDFTEXT_BACKENDS], type=str)
+    parser.add_argument('--page_cache_dir', help='PDF page text cache directory (empty to disable)', default=PDFTEXT_CACHE_DIR, type=str)
+    parser.add_argument('--chunk_size', help='chunk size in chunk units', default=INGEST_CHUNK_SIZE, type=int)
+    parser.add_argument('--chunk_overlap', help='overlap of neighbouring chunks in chunk units', default=INGEST_CHUNK_OVERLAP, type=int)
+    parser.add_argument('--chunk_unit', help='chunk size unit, tokens are counted with tiktoken if installed (estimated otherwise)', default='chars', choices=FU_SPLIT_UNITS, type=str)
+    parser.add_argument('--ingest_workers', help='ingest worker processes to start (0 to use workers started with src/ingest.py)', default=1, type=int)
+    parser.add_argument('--metrics_port', help='serve Prometheus metrics on this port, ingest workers use the following ports (0 to disable)', default=9464, type=int)
     parser.add_argument('--verbose', help='verbose output', action='store_true')
     args = parser.parse_args()
     
@@ -55,22 +246,94 @@ if __name__ == '__main__':
     mongo_colname = args.mongo_colname
     ollama_model = args.ollama_model
     ollama_base_url = args.ollama_base_url
+    embed_batch_size = args.embed_batch_size
+    embed_workers = args.embed_workers
+    embed_cache_dir = args.embed_cache_dir
+    embed_cache_size = args.embed_cache_size * 2**20
+    index_type = args.index_type
+    nprobe = args.nprobe
+    ef_search = args.ef_search
+    codec = args.codec
+    reduced_dim = args.reduced_dim
+    reduction = args.reduction
+    rescore = args.rescore
+    retrieval = args.retrieval
+    k = args.k
+    fetch_k = args.fetch_k
+    context_tokens = args.context_tokens
+    llm_concurrency = args.llm_concurrency
+    llm_queue_timeout = args.llm_queue_timeout
+    answer_cache_size = args.answer_cache_size
+    answer_cache_ttl = args.answer_cache_ttl
+    answer_cache_threshold = args.answer_cache_threshold
+    parse_workers = args.parse_workers
+    pdf_backend = args.pdf_backend
+    page_cache_dir = args.page_cache_dir
+    chunk_size = args.chunk_size
+    chunk_overlap = args.chunk_overlap
+    chunk_unit = args.chunk_unit
+    ingest_workers = args.ingest_workers
+    metrics_port = args.metrics_port
     verbose = args.verbose
-    supported_doctypes = ['pdf', 'docx', 'odt', 'txt']
-        
-    # init vectorstore
-    if 'vectorStore' not in st.session_state:
-        st.session_state.vectorStore = vectorstore_load(
-            mongo_connect=mongo_connect,
-            mongo_dbname=mongo_dbname,
-            mongo_colname=mongo_colname,
-            ollama_model=ollama_model,
-            ollama_base_url=ollama_base_url,
-        )
+    supported_doctypes = FU_DOCTYPES
     
-    # init ollama
-    if 'ollama_model' not in st.session_state:
-        st.session_state.ollama_model = OllamaClient(ollama_base_url)
+    # init vectorstore (shared by all sessions)
+    vectorService = get_vectorstore_service(
+        mongo_connect, 
+        mongo_dbname, 
+        mongo_colname, 
+        ollama_model, 
+        ollama_base_url, 
+        embed_batch_size, 
+        embed_workers, 
+        embed_cache_dir, 
+        embed_cache_size,
+        index_type,
+        nprobe,
+        ef_search,
+        retrieval,
+        codec,
+        reduced_dim,
+        reduction,
+        rescore,
+    )
+    embedding = vectorService.embedding
+    answerCache = get_answer_cache(answer_cache_size, answer_cache_ttl, answer_cache_threshold)
+    llmGateway = get_llm_gateway(ollama_base_url, llm_concurrency, llm_queue_timeout)
+    
+    # init metrics endpoint
+    get_metrics_server(metrics_port)
+    
+    # init ingest workers, they take jobs submitted below
+    get_ingest_workers(ingest_workers, (
+        '--mongo_connect', mongo_connect,
+        '--mongo_dbname', mongo_dbname,
+        '--mongo_colname', mongo_colname,
+        '--ollama_model', ollama_model,
+        '--ollama_base_url', ollama_base_url,
+        '--embed_batch_size', str(embed_batch_size),
+        '--embed_workers', str(embed_workers),
+        '--embed_cache_dir', embed_cache_dir,
+        '--embed_cache_size', str(args.embed_cache_size),
+        '--index_type', index_type,
+        '--nprobe', str(nprobe),
+        '--ef_search', str(ef_search),
+        '--codec', codec,
+        '--reduced_dim', str(reduced_dim),
+        '--reduction', reduction,
+        '--rescore', str(rescore),
+        '--parse_workers', str(parse_workers),
+        '--pdf_backend', pdf_backend,
+        '--page_cache_dir', page_cache_dir,
+        '--chunk_size', str(chunk_size),
+        '--chunk_overlap', str(chunk_overlap),
+        '--chunk_unit', chunk_unit,
+        *(['--verbose'] if verbose else []),
+    ), metrics_port)
+    
+    # init session id, questions of sessions are generated in turns
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
 
     # init messages
     if 'messages' not in st.session_state:
@@ -92,67 +355,96 @@ if __name__ == '__main__':
         flag_load_from_folder = st.toggle('Load from folder', help='Drag & drop files or load from folder.')
         flag_private_chat = st.toggle('Private chat', help='Do not save files to database for repeated usage.', disabled=True)
         flag_ask_llm = st.toggle('Ask LLM', help='Ask LLM not the knowledge base.')
-        
+
+        # documents
+        st.markdown('''
+        # Documents
+        ''')
+        search_sources = st.multiselect(
+            'Search in',
+            vectorService.sources() if vectorService.ready.is_set() else [],
+            placeholder='All documents',
+            help='Answer from the selected documents only.',
+            key='search_sources',
+        )
+        st.button('Delete selected documents', use_container_width=True, disabled=not search_sources, on_click=delete_documents, args=(vectorService,))
+        if 'deleted_sources' in st.session_state:
+            if (deleted := st.session_state.pop('deleted_sources')) is not None: widget_info_notification(f'{deleted} documents deleted!')
+            else: st.warning('Indexing is in progress, try again once it is done.', icon='⚠️')
+
         # cache
         st.markdown('''
         # Cache
         ''')
-        if st.button('Delete database', use_container_width=True, on_click=storage_clear_database, args=(mongo_connect, mongo_dbname)):
-            st.session_state.vectorStore = None
-            if os.path.exists(VECTORSTORE_DB): os.remove(VECTORSTORE_DB)
-            widget_info_notification('Database deleted!')
+        if st.button('Delete database', use_container_width=True):
+            if vectorService.clear(): 
+                if answerCache: answerCache.clear()
+                widget_info_notification('Database deleted!')
+            else: st.warning('Indexing is in progress, try again once it is done.', icon='⚠️')
         if st.button('Delete messages', use_container_width=True, on_click=lambda: st.session_state.messages.clear()):
             widget_info_notification('Messages deleted!')
+        if embedding.cache:
+            stats = embedding.cache.stats()
+            st.caption(f'Embedding cache: {stats["hits"]} hits, {stats["misses"]} misses ({stats["hit_ratio"]:.0%}), {stats["entries"]} entries')
+        st.caption(f'Query embeddings: {embedding.query_hits} hits, {embedding.query_misses} misses, {len(embedding.query_cache)} entries')
+        if answerCache:
+            stats = answerCache.stats()
+            st.caption(f'Answer cache: {stats["hits"]} hits, {stats["misses"]} misses ({stats["hit_ratio"]:.0%}), {stats["entries"]} entries')
+        stats = llmGateway.stats()
+        st.caption(f'LLM: {stats["active"]} generating, {stats["queued"]} queued (wait p95 {stats["wait_p95"]:.1f}s), {stats["coalesced"]} of {stats["requests"]} shared')
+        if vectorService.ready.is_set(): st.caption(f'Library: {vectorService.size()} chunks, version {vectorService.version}')
+        else: st.caption('Library: loading...')
+        
+        # latency per stage
+        with st.expander('Metrics'):
+            show_metrics(mongo_connect, mongo_dbname, mongo_colname)
+            if metrics_port: st.caption(f'Prometheus: http://127.0.0.1:{metrics_port}/metrics, workers on the following ports')
         
     # ---
     # MAIN WINDOW
     
     st.header("Chat with files 💬")
     
+    # the library is loaded in the background, questions are accepted once it is ready
+    if not vectorService.ready.is_set(): show_warmup(vectorService.ready.is_set, 'Warming up: loading library...')
+    
     # file uploader widget
     files = None
     if flag_load_from_folder:
         dirpath = st.text_input('Enter path:')
         if os.path.isdir(dirpath):
-            # find and filter files in the directory
-            fnames = list(filter(lambda x: x.split('.')[-1] in supported_doctypes, os.listdir(dirpath)))
+            # find supported files in the directory and its subdirectories, documents are identified by file name
+            paths, skipped = ingest_unique_names(fu_find_files([dirpath], supported_doctypes))
             
-            if len(fnames):
+            if len(paths):
                 # list files to be uploaded
-                with st.expander(f'To be processed: {len(fnames)} files'):
-                    for i, fname in enumerate(fnames):
-                        st.write(f'{i+1}. {fname}')
+                with st.expander(f'To be processed: {len(paths)} files'):
+                    for i, path in enumerate(paths):
+                        st.write(f'{i+1}. {os.path.relpath(path, dirpath)}')
                 
                 # upload files
-                files = [os.path.join(dirpath, fname) for fname in fnames]
+                files = paths
+            if len(skipped):
+                with st.expander(f'Skipped, the name of another file: {len(skipped)} files'):
+                    for i, path in enumerate(skipped):
+                        st.write(f'{i+1}. {os.path.relpath(path, dirpath)}')
     else:
         files = st.file_uploader('Upload your files', type=supported_doctypes, accept_multiple_files=True)
+        if files:
+            # documents are identified by file name
+            files, skipped = ingest_unique_names(files)
+            if skipped: st.warning(f'Skipped, the name of another file: {", ".join(file.name for file in skipped)}', icon='⚠️')
     
-    # upload files
-    documents = []
+    # queue files for ingest workers, uploads are spooled to disk so the job outlives this script run
     submitIsPressed = st.button('Submit', use_container_width=True)
     if submitIsPressed and files:
-        # upload and convert to documents
-        for file in files: documents += fu_get_content(*fu_make_upload(file))
+        job_id = ObjectId()
+        paths = ingest_spool_uploads(files, os.path.join(INGEST_UPLOAD_DIR, str(job_id)))
+        jobs_submit(paths, mongo_connect, mongo_dbname, mongo_colname, job_id=job_id)
+        st.toast(f'{len(paths)} files queued for indexing', icon='✅')
     
-        # process documents
-        documents = fu_split_documents(documents, chunk_size=1000, chunk_overlap=200)
-        new_docs = storage_add_documents(
-            documents=documents,
-            mongo_connect=mongo_connect,
-            mongo_dbname=mongo_dbname,
-            mongo_colname=mongo_colname,
-            verbose=verbose,
-        )
-        
-        # display number of documents added
-        if new_docs:
-            widget_info_notification(f'{len(new_docs)} chunks added!')
-            
-            # update vectorstore
-            st.session_state.vectorStore = vectorstore_update(st.session_state.vectorStore, new_docs, ollama_model, ollama_base_url)
-            widget_info_notification(f'Library updated!')
-        else: widget_info_notification(f'All up to date!')
+    # job progress, refreshed in the background while chatting
+    show_jobs(mongo_connect, mongo_dbname, mongo_colname)
     
     # ---
     # CHAT
@@ -161,9 +453,10 @@ if __name__ == '__main__':
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+            if 'stats' in message: widget_chat_stats(message['stats'])
 
     # chat
-    if query_text := st.chat_input("What's your question?"):
+    if query_text := st.chat_input("What's your question?", disabled=not vectorService.ready.is_set()):
         # user
         st.session_state.messages.append({'role': 'user', 'content': query_text})
         with st.chat_message('user'): 
@@ -171,26 +464,55 @@ if __name__ == '__main__':
 
         # llm
         with st.chat_message('assistant'):
-            # generate response
-            prompt = ''
-            if flag_ask_llm: 
-                prompt = query_text
+            # every stage is timed: embed, search, rerank, cache lookup, prompt build, generate
+            stages = {}
+            start = time.perf_counter()
+
+            # find relevant documents, the question embedding is shared by search and answer cache
+            vector = embedding.embed_query(query_text) if answerCache or not flag_ask_llm else None
+            stages['embed'] = time.perf_counter() - start
+            documents = [] if flag_ask_llm else [doc for doc, _score in vectorService.search(query_text, k=fetch_k or k, vector=vector, sources=search_sources or None)]
+            stages['search'] = time.perf_counter() - start - sum(stages.values())
+            
+            # over-fetched chunks are joined, deduplicated and packed into the context budget
+            context = {}
+            if documents and fetch_k:
+                documents = rerank_documents(query_text, documents, k, context_tokens, stats=context)
+                stages['rerank'] = time.perf_counter() - start - sum(stages.values())
+
+            # answer repeated questions about the same documents from cache, asking the LLM alone is cached apart
+            template = '{question}' if flag_ask_llm else PROMPT_TEMPLATE
+            response = answerCache.get(ollama_model, query_text, vector, documents, template) if answerCache else None
+            if answerCache: stages['cache'] = time.perf_counter() - start - sum(stages.values())
+            if response is not None:
+                stats = {'cached': True, 'total': time.perf_counter() - start, 'stages': stages}
+                st.markdown(response)
             else:
-                results = None
-                if st.session_state.vectorStore:
-                    # find relevant documents
-                    results = st.session_state.vectorStore.similarity_search_with_score(query=query_text, k=5)
-                    
-                # generate context
-                context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results]) if results else ''
+                # generate response
+                prompt = ''
+                if flag_ask_llm: 
+                    prompt = query_text
+                else:
+                    # generate context
+                    context_text = "\n\n---\n\n".join([doc.page_content for doc in documents])
 
-                # create prompt query
-                prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-                prompt = prompt_template.format(context=context_text, question=query_text)
-                
-            # invoke llm
-            response = llm_model_chat(prompt, st.session_state.ollama_model)
-            st.markdown(response)
-        st.session_state.messages.append({'role': 'assistant', 'content': response})
+                    # create prompt query
+                    prompt = get_prompt_template().format(context=context_text, question=query_text)
+                stages['prompt'] = time.perf_counter() - start - sum(stages.values())
+                    
+                # invoke llm through the gateway shared by all sessions, render tokens as they arrive
+                stats = {}
+                try: response = st.write_stream(llmGateway.chat_stream(prompt, ollama_model, st.session_state.session_id, stats=stats))
+                except TimeoutError:
+                    st.warning('The model is busy answering other questions, ask again in a moment.', icon='⏳')
+                    st.session_state.messages.pop()
+                    st.stop()
+                stages['queue'] = stats['queue_wait']
+                stages['generate'] = stats['total'] - stats['queue_wait']
+                stats.update({'total': time.perf_counter() - start, 'stages': stages, **({'context_tokens': context['tokens']} if context else {})})
+                if answerCache: answerCache.put(ollama_model, query_text, vector, documents, response, template)
+            widget_chat_stats(stats)
+            if verbose: log_print(' · '.join(f'{stage} {seconds * 1000:.1f}ms' for stage, seconds in stages.items()) + f' · total {stats["total"]:.2f}s')
+        st.session_state.messages.append({'role': 'assistant', 'content': response, 'stats': stats})
 
 
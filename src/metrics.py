@@ -0,0 +1,238 @@
+# module metrics
+
+# system
+import time
+import bisect
+import threading
+import contextlib
+import collections
+from typing import Iterable, Iterator
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# constants
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_WINDOW = 1024                    # recent samples per histogram series kept for percentiles
+METRICS_STAGE = 'filechat_stage_seconds' # histogram of spans, labelled by stage
+METRICS_HELP = {
+    METRICS_STAGE: 'Time spent in a pipeline stage',
+    'filechat_parsed_pages_total': 'Pages (or paragraph groups) read from files',
+    'filechat_parsed_bytes_total': 'Characters of text read from files',
+    'filechat_chunks_total': 'Chunks produced by the splitter',
+    'filechat_stored_chunks_total': 'Chunks written to or removed from the database',
+    'filechat_embedded_texts_total': 'Texts sent to the embedding endpoint',
+    'filechat_cache_requests_total': 'Cache lookups by cache and result',
+    'filechat_generated_tokens_total': 'Tokens generated by the chat model',
+    'filechat_prompt_tokens_total': 'Prompt tokens evaluated by the chat model',
+    'filechat_context_tokens_total': 'Tokens of retrieved passages put into prompts',
+    'filechat_time_to_first_token_seconds': 'Time until the first generated token',
+    'filechat_jobs': 'Ingestion jobs by status',
+    'filechat_llm_requests_total': 'Chat requests of the LLM gateway by result',
+    'filechat_llm_active_requests': 'Generations in progress on the LLM server',
+    'filechat_llm_queue_depth': 'Chat requests waiting for a free generation slot',
+    'filechat_llm_queue_wait_seconds': 'Time a chat request waited for a generation slot',
+}
+
+
+class MetricsRegistry:
+    """Process-wide counters, gauges and histograms, exported in Prometheus text format
+
+    Every update takes one lock and does a constant amount of work, histograms also keep the last METRICS_WINDOW samples
+    of every series for percentiles.
+    """
+
+    def __init__(self, buckets: tuple[float] = METRICS_BUCKETS, window: int = METRICS_WINDOW):
+        """Creates empty registry
+
+        Args:
+            buckets (tuple[float], optional): histogram bucket upper bounds. Defaults to METRICS_BUCKETS.
+            window (int, optional): recent samples kept per histogram series. Defaults to METRICS_WINDOW.
+        """
+        self.buckets = buckets
+        self.window = window
+        self.counters = {}   # (name, labels) => value
+        self.gauges = {}     # (name, labels) => value
+        self.histograms = {} # (name, labels) => {'counts', 'sum', 'count', 'recent'}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1.0, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0, 'recent': collections.deque(maxlen=self.window)}
+            series['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+            series['count'] += 1
+            series['recent'].append(value)
+
+    def render(self) -> str:
+        """Returns all metrics in Prometheus text exposition format
+
+        Returns:
+            str: metrics
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: (list(s['counts']), s['sum'], s['count']) for key, s in self.histograms.items()}
+
+        lines = []
+        def header(name: str, kind: str):
+            if name in METRICS_HELP: lines.append(f'# HELP {name} {METRICS_HELP[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for kind, values in [('counter', counters), ('gauge', gauges)]:
+            last = None
+            for (name, labels), value in sorted(values.items()):
+                if name != last: header(name, kind)
+                last = name
+                lines.append(f'{name}{metrics_format_labels(labels)} {value:g}')
+
+        last = None
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            if name != last: header(name, 'histogram')
+            last = name
+            cumulative = 0
+            for bound, n in zip([*self.buckets, float('inf')], counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'{name}_bucket{metrics_format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{metrics_format_labels(labels)} {total:g}')
+            lines.append(f'{name}_count{metrics_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, name: str = METRICS_STAGE, label: str = 'stage') -> dict[str, dict]:
+        """Returns percentiles of recent samples of a histogram
+
+        Args:
+            name (str, optional): histogram name. Defaults to METRICS_STAGE.
+            label (str, optional): label the series are reported by. Defaults to 'stage'.
+
+        Returns:
+            dict[str, dict]: label value => {'count', 'p50', 'p95'} (count of all samples, percentiles of recent ones)
+        """
+        with self.lock:
+            series = {dict(labels).get(label, ''): (s['count'], sorted(s['recent'])) for (n, labels), s in self.histograms.items() if n == name}
+        return {
+            value: {'count': count, 'p50': recent[int(0.50 * (len(recent) - 1))], 'p95': recent[int(0.95 * (len(recent) - 1))]}
+            for value, (count, recent) in sorted(series.items()) if recent
+        }
+
+
+def metrics_format_labels(labels: tuple) -> str:
+    if not labels: return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+# metrics are shared within a process
+METRICS = MetricsRegistry()
+
+
+def metrics_count(name: str, value: float = 1.0, **labels):
+    """Adds to a counter
+
+    Args:
+        name (str): metric name
+        value (float, optional): increment. Defaults to 1.0.
+    """
+    METRICS.count(name, value, **labels)
+
+
+def metrics_gauge(name: str, value: float, **labels):
+    """Sets a gauge
+
+    Args:
+        name (str): metric name
+        value (float): value
+    """
+    METRICS.gauge(name, value, **labels)
+
+
+def metrics_observe(name: str, value: float, **labels):
+    """Adds a sample to a histogram
+
+    Args:
+        name (str): metric name
+        value (float): sample
+    """
+    METRICS.observe(name, value, **labels)
+
+
+@contextlib.contextmanager
+def metrics_span(stage: str):
+    """Times the block as a stage (also if it raises)
+
+    Args:
+        stage (str): stage name
+    """
+    start = time.perf_counter()
+    try: yield
+    finally: METRICS.observe(METRICS_STAGE, time.perf_counter() - start, stage=stage)
+
+
+def metrics_iter(stage: str, iterable: Iterable) -> Iterator:
+    """Times a lazy producer: only the time spent producing items counts, not the time the consumer holds them
+
+    Args:
+        stage (str): stage name
+        iterable (Iterable): producer
+
+    Yields:
+        Iterator: items of iterable
+    """
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try: item = next(iterator)
+            except StopIteration: return
+            finally: elapsed += time.perf_counter() - start
+            yield item
+    finally: METRICS.observe(METRICS_STAGE, elapsed, stage=stage)
+
+
+def metrics_summary(name: str = METRICS_STAGE, label: str = 'stage') -> dict[str, dict]:
+    """Returns percentiles of recent samples, see MetricsRegistry.summary"""
+    return METRICS.summary(name, label)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def metrics_serve(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Serves '/metrics' of this process in a background thread
+
+    Args:
+        port (int): port
+        host (str, optional): address to listen on. Defaults to '127.0.0.1'.
+
+    Returns:
+        ThreadingHTTPServer: server
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name=f'metrics:{port}').start()
+    return server
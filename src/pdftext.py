@@ -0,0 +1,308 @@
+# module pdftext
+
+# system
+import os
+import io
+import time
+import sqlite3
+import hashlib
+import threading
+import importlib.util
+
+# local
+from metrics import metrics_count
+
+# constants
+PDFTEXT_BACKENDS = ['pymupdf', 'pdfium', 'pypdf2', 'pdfminer'] # 'auto' takes the first one installed, fastest first
+PDFTEXT_MODULES = {'pymupdf': 'fitz', 'pdfium': 'pypdfium2', 'pypdf2': 'PyPDF2', 'pdfminer': 'pdfminer'}
+PDFTEXT_CACHE_DIR = 'pagecache'
+PDFTEXT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+class PdfTextReader:
+    """Extracts text of PDF pages, one subclass per backend"""
+
+    def __init__(self, file: io.BufferedIOBase):
+        self.file = file
+
+    def page_count(self) -> int:
+        raise NotImplementedError
+
+    def extract(self, i: int) -> str:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PyPDF2TextReader(PdfTextReader):
+    """Pure Python, always available"""
+
+    def __init__(self, file: io.BufferedIOBase):
+        from PyPDF2 import PdfReader
+        super().__init__(file)
+        self.reader = PdfReader(file)
+
+    def page_count(self) -> int:
+        return len(self.reader.pages)
+
+    def extract(self, i: int) -> str:
+        return self.reader.pages[i].extract_text()
+
+
+class PdfiumTextReader(PdfTextReader):
+    """pypdfium2 (PDFium bindings)"""
+
+    def __init__(self, file: io.BufferedIOBase):
+        import pypdfium2
+        super().__init__(file)
+        self.document = pypdfium2.PdfDocument(file)
+
+    def page_count(self) -> int:
+        return len(self.document)
+
+    def extract(self, i: int) -> str:
+        page = self.document[i]
+        textpage = page.get_textpage()
+        try: return textpage.get_text_range().replace('\r\n', '\n')
+        finally:
+            textpage.close()
+            page.close()
+
+    def close(self):
+        self.document.close()
+
+
+class PdfMinerTextReader(PdfTextReader):
+    """pdfminer.six with layout analysis, slow but keeps columns and reading order"""
+
+    def __init__(self, file: io.BufferedIOBase):
+        from pdfminer.pdfparser import PDFParser
+        from pdfminer.pdfdocument import PDFDocument
+        from pdfminer.pdfpage import PDFPage
+        from pdfminer.pdfinterp import PDFResourceManager
+        super().__init__(file)
+        self.pages = list(PDFPage.create_pages(PDFDocument(PDFParser(file))))
+        self.resources = PDFResourceManager(caching=True)
+
+    def page_count(self) -> int:
+        return len(self.pages)
+
+    def extract(self, i: int) -> str:
+        from pdfminer.layout import LAParams
+        from pdfminer.converter import TextConverter
+        from pdfminer.pdfinterp import PDFPageInterpreter
+        out = io.StringIO()
+        device = TextConverter(self.resources, out, laparams=LAParams())
+        try: PDFPageInterpreter(self.resources, device).process_page(self.pages[i])
+        finally: device.close()
+        return out.getvalue()
+
+
+class PyMuPDFTextReader(PdfTextReader):
+    """PyMuPDF (MuPDF bindings)"""
+
+    def __init__(self, file: io.BufferedIOBase):
+        try: import pymupdf
+        except ImportError: import fitz as pymupdf # before 1.24
+        super().__init__(file)
+        
+        # a file on disk is opened by path and read as pages are needed, in-memory uploads are passed as they are
+        if isinstance(file, io.BufferedReader) and isinstance(getattr(file, 'name', None), str): self.document = pymupdf.open(file.name, filetype='pdf')
+        else:
+            file.seek(0)
+            self.document = pymupdf.open(stream=file.getbuffer() if isinstance(file, io.BytesIO) else file.read(), filetype='pdf')
+
+    def page_count(self) -> int:
+        return self.document.page_count
+
+    def extract(self, i: int) -> str:
+        return self.document[i].get_text('text')
+
+    def close(self):
+        self.document.close()
+
+
+PDFTEXT_READERS = {'pymupdf': PyMuPDFTextReader, 'pdfium': PdfiumTextReader, 'pypdf2': PyPDF2TextReader, 'pdfminer': PdfMinerTextReader}
+
+
+def pdftext_available() -> list[str]:
+    """Returns backends that are installed
+
+    Returns:
+        list[str]: backend names, fastest first
+    """
+    return [name for name in PDFTEXT_BACKENDS if importlib.util.find_spec(PDFTEXT_MODULES[name]) is not None]
+
+
+def pdftext_get_backend(backend: str = 'auto') -> str:
+    """Resolves backend name
+
+    Args:
+        backend (str, optional): one of PDFTEXT_BACKENDS or 'auto' for the fastest installed one. Defaults to 'auto'.
+
+    Returns:
+        str: backend name
+    """
+    if backend == 'auto': return pdftext_available()[0]
+    if backend not in PDFTEXT_READERS: raise ValueError(f'Unknown PDF backend: {backend}')
+    if backend not in pdftext_available(): raise ValueError(f'PDF backend {backend} is not installed (pip install {PDFTEXT_MODULES[backend]})')
+    return backend
+
+
+def pdftext_open(file: io.BufferedIOBase, backend: str = 'auto') -> PdfTextReader:
+    """Opens PDF for text extraction
+
+    Args:
+        file (io.BufferedIOBase): PDF file object
+        backend (str, optional): one of PDFTEXT_BACKENDS or 'auto'. Defaults to 'auto'.
+
+    Returns:
+        PdfTextReader: reader
+    """
+    file.seek(0)
+    return PDFTEXT_READERS[pdftext_get_backend(backend)](file)
+
+
+def pdftext_hash_file(file: io.BufferedIOBase) -> str:
+    """Hashes file contents, file position is restored
+
+    Args:
+        file (io.BufferedIOBase): file object
+
+    Returns:
+        str: sha256 hex digest
+    """
+    position = file.tell()
+    file.seek(0)
+    digest = hashlib.sha256()
+    while block := file.read(1024 * 1024): digest.update(block)
+    file.seek(position)
+    return digest.hexdigest()
+
+
+class PageTextCache:
+    """On-disk cache of extracted page text keyed by (file hash, backend, page), shared by processes through sqlite
+
+    Files are evicted as a whole, least recently used first, once the cached text exceeds the size limit.
+    """
+
+    def __init__(self, path: str, max_bytes: int = PDFTEXT_CACHE_MAX_BYTES):
+        """Opens (or creates) cache
+
+        Args:
+            path (str): cache directory
+            max_bytes (int, optional): size limit of cached text. Defaults to PDFTEXT_CACHE_MAX_BYTES.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'pages.sqlite'), check_same_thread=False, isolation_level=None, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (file_hash TEXT, backend TEXT, pages INTEGER, bytes INTEGER, last_used REAL, PRIMARY KEY (file_hash, backend))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages (file_hash TEXT, backend TEXT, page INTEGER, text TEXT, PRIMARY KEY (file_hash, backend, page))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)')
+
+    def page_count(self, file_hash: str, backend: str) -> int | None:
+        """Returns number of pages of a cached file
+
+        Args:
+            file_hash (str): file hash
+            backend (str): backend name
+
+        Returns:
+            int | None: number of pages or None if the file was not seen
+        """
+        with self.lock:
+            row = self.db.execute('SELECT pages FROM files WHERE file_hash = ? AND backend = ?', (file_hash, backend)).fetchone()
+            if row: self.db.execute('UPDATE files SET last_used = ? WHERE file_hash = ? AND backend = ?', (time.time(), file_hash, backend))
+            return row[0] if row else None
+
+    def get_many(self, file_hash: str, backend: str, start: int, end: int) -> dict[int, str]:
+        """Looks up text of pages [start, end)
+
+        Args:
+            file_hash (str): file hash
+            backend (str): backend name
+            start (int): first page
+            end (int): page after the last one
+
+        Returns:
+            dict[int, str]: page => text for pages found
+        """
+        with self.lock:
+            texts = dict(self.db.execute('SELECT page, text FROM pages WHERE file_hash = ? AND backend = ? AND page >= ? AND page < ?', (file_hash, backend, start, end)))
+            self.hits += len(texts)
+            self.misses += end - start - len(texts)
+        metrics_count('filechat_cache_requests_total', len(texts), cache='page', result='hit')
+        metrics_count('filechat_cache_requests_total', end - start - len(texts), cache='page', result='miss')
+        return texts
+
+    def put_many(self, file_hash: str, backend: str, pages: int, texts: dict[int, str]):
+        """Stores text of pages, evicts least recently used files if the cache is full
+
+        Args:
+            file_hash (str): file hash
+            backend (str): backend name
+            pages (int): number of pages of the file
+            texts (dict[int, str]): page => text
+        """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)', [(file_hash, backend, page, text) for page, text in texts.items()])
+                
+                # size is counted from the pages, a page put again (workers parsing the same file) replaces the old one
+                self.db.execute(
+                    'INSERT INTO files VALUES (?, ?, ?, (SELECT COALESCE(SUM(LENGTH(text)), 0) FROM pages WHERE file_hash = ? AND backend = ?), ?) '
+                    'ON CONFLICT (file_hash, backend) DO UPDATE SET bytes = excluded.bytes, last_used = excluded.last_used',
+                    (file_hash, backend, pages, file_hash, backend, time.time()),
+                )
+
+                # evict whole files, the one being written last
+                total = self.db.execute('SELECT COALESCE(SUM(bytes), 0) FROM files').fetchone()[0]
+                for victim, victim_backend, victim_bytes in self.db.execute('SELECT file_hash, backend, bytes FROM files ORDER BY last_used').fetchall():
+                    if total <= self.max_bytes or (victim, victim_backend) == (file_hash, backend): break
+                    self.db.execute('DELETE FROM pages WHERE file_hash = ? AND backend = ?', (victim, victim_backend))
+                    self.db.execute('DELETE FROM files WHERE file_hash = ? AND backend = ?', (victim, victim_backend))
+                    total -= victim_bytes
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def stats(self) -> dict:
+        """Returns cache counters
+
+        Returns:
+            dict: {'hits', 'misses', 'hit_ratio', 'files', 'bytes'}
+        """
+        with self.lock:
+            files, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM files').fetchone()
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / total if total else 0.0, 'files': files, 'bytes': size}
+
+
+# caches are shared within a process, one per directory
+PDFTEXT_CACHES = {}
+PDFTEXT_LOCK = threading.Lock()
+
+
+def pdftext_open_cache(path: str = PDFTEXT_CACHE_DIR, max_bytes: int = PDFTEXT_CACHE_MAX_BYTES) -> PageTextCache:
+    """Returns process-wide page text cache
+
+    Args:
+        path (str, optional): cache directory. Defaults to PDFTEXT_CACHE_DIR.
+        max_bytes (int, optional): size limit of cached text. Defaults to PDFTEXT_CACHE_MAX_BYTES.
+
+    Returns:
+        PageTextCache: cache
+    """
+    key = os.path.abspath(path)
+    with PDFTEXT_LOCK:
+        if key not in PDFTEXT_CACHES: PDFTEXT_CACHES[key] = PageTextCache(path, max_bytes)
+        return PDFTEXT_CACHES[key]
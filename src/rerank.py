@@ -0,0 +1,231 @@
+# module rerank
+
+# system
+import math
+import collections
+from typing import Callable
+
+# langchain
+from langchain.schema import Document
+
+# local
+from bm25 import bm25_tokenize
+from metrics import metrics_count, metrics_span
+from fileuploader import fu_count_tokens
+
+# constants
+RERANK_FETCH_K = 20               # candidates retrieved for the rerank stage
+RERANK_CONTEXT_TOKENS = 1024      # tokens of context put into a prompt
+RERANK_DUPLICATE_THRESHOLD = 0.8  # share of a passage's word shingles found in a better passage that makes it a duplicate
+RERANK_SHINGLE_WORDS = 3
+RERANK_MIN_OVERLAP = 8            # characters of chunk overlap that neighbours are joined by
+RERANK_RRF_K = 60
+RERANK_K1 = 1.2
+
+
+def rerank_documents(
+    query: str,
+    documents: list[Document],
+    k: int = 5,
+    context_tokens: int = RERANK_CONTEXT_TOKENS,
+    duplicate_threshold: float = RERANK_DUPLICATE_THRESHOLD,
+    count_tokens: Callable[[str], int] = fu_count_tokens,
+    stats: dict = None,
+) -> list[Document]:
+    """Turns retrieved chunks into prompt context: overlapping neighbours are joined, passages are reranked by how well
+    they cover the query, near-duplicates are dropped and the best passages are packed into a token budget
+
+    Args:
+        query (str): question
+        documents (list[Document]): retrieved chunks, best first
+        k (int, optional): maximum number of passages. Defaults to 5.
+        context_tokens (int, optional): token budget of all passages, 0 for no limit. Defaults to RERANK_CONTEXT_TOKENS.
+        duplicate_threshold (float, optional): see RERANK_DUPLICATE_THRESHOLD, 1.0 drops exact duplicates only. Defaults to RERANK_DUPLICATE_THRESHOLD.
+        count_tokens (Callable[[str], int], optional): token counter. Defaults to fu_count_tokens.
+        stats (dict, optional): filled with {'candidates', 'passages', 'duplicates', 'tokens'}. Defaults to None.
+
+    Returns:
+        list[Document]: passages, best first; a joined passage has the id of its first chunk and all chunk ids in 'ids'
+    """
+    with metrics_span('rerank'):
+        passages = rerank_join_neighbours(documents)
+        scores = rerank_score(query, [p.page_content for p, _ in passages])
+
+        # the retrieval order is fused with the rerank order, so a passage ranked high by both comes first
+        order = sorted(range(len(passages)), key=lambda i: -scores[i])
+        fused = {i: 1 / (RERANK_RRF_K + passages[i][1] + 1) for i in range(len(passages))}
+        for rank, i in enumerate(order): fused[i] += 1 / (RERANK_RRF_K + rank + 1)
+
+        packed, seen, used, duplicates = [], set(), 0, 0
+        for i in sorted(fused, key=lambda i: (-fused[i], passages[i][1])):
+            if len(packed) >= k or (context_tokens and used >= context_tokens): break
+            passage = passages[i][0]
+            shingles = rerank_shingles(passage.page_content)
+            if shingles and len(shingles & seen) >= duplicate_threshold * len(shingles):
+                duplicates += 1
+                continue
+
+            # a passage over the remaining budget is skipped, shorter ones may still fit; the best one is cut to fit
+            tokens = count_tokens(passage.page_content)
+            if context_tokens and used + tokens > context_tokens:
+                if packed: continue
+                passage = Document.construct(page_content=rerank_truncate(passage.page_content, context_tokens, count_tokens), metadata=passage.metadata)
+                tokens = count_tokens(passage.page_content)
+            packed.append(passage)
+            seen |= shingles
+            used += tokens
+
+    metrics_count('filechat_context_tokens_total', used)
+    if stats is not None: stats.update({'candidates': len(documents), 'passages': len(packed), 'duplicates': duplicates, 'tokens': used})
+    return packed
+
+
+def rerank_join_neighbours(documents: list[Document]) -> list[tuple[Document, int]]:
+    """Joins chunks that follow each other on a page (ids 'source:page:n' and 'source:page:n+1'),
+    the text they share through chunk overlap is kept once
+
+    Args:
+        documents (list[Document]): retrieved chunks, best first
+
+    Returns:
+        list[tuple[Document, int]]: passages and the best retrieval rank of their chunks, in order of first chunk rank
+    """
+    # chunks of a page by their number
+    pages = collections.defaultdict(dict)
+    for rank, document in enumerate(documents):
+        page, _, number = str(document.metadata.get('id', '')).rpartition(':')
+        if page and number.isdigit(): pages[page].setdefault(int(number), rank)
+
+    passages, joined = [], set()
+    for rank, document in enumerate(documents):
+        if rank in joined: continue
+        page, _, number = str(document.metadata.get('id', '')).rpartition(':')
+        if not page or not number.isdigit() or pages[page].get(int(number)) != rank:
+            passages.append((document, rank))
+            continue
+
+        # walk back to the first retrieved chunk of the run, then forward to its last
+        chunks = pages[page]
+        first = int(number)
+        while first - 1 in chunks: first -= 1
+        last = first
+        while last + 1 in chunks: last += 1
+        if first == last:
+            passages.append((document, rank))
+            continue
+
+        ranks = [chunks[n] for n in range(first, last + 1)]
+        text = documents[ranks[0]].page_content
+        for n in ranks[1:]:
+            following = documents[n].page_content
+            overlap = rerank_overlap(text, following)
+            text += following[overlap:] if overlap else '\n' + following
+        joined.update(ranks)
+        metadata = {**documents[ranks[0]].metadata, 'ids': [documents[n].metadata['id'] for n in ranks]}
+        passages.append((Document.construct(page_content=text, metadata=metadata), min(ranks)))
+    return passages
+
+
+def rerank_overlap(text: str, following: str) -> int:
+    """Returns length of the longest suffix of text that starts the following text
+
+    Args:
+        text (str): text
+        following (str): text that may start with the end of text
+
+    Returns:
+        int: overlap in characters, 0 if there is none
+    """
+    # shorter overlaps are not worth joining for and could match by chance
+    probe = following[:RERANK_MIN_OVERLAP]
+    if len(probe) < RERANK_MIN_OVERLAP: return 0
+    position = text.find(probe, max(0, len(text) - len(following)))
+    while position != -1:
+        if following.startswith(text[position:]): return len(text) - position
+        position = text.find(probe, position + 1)
+    return 0
+
+
+def rerank_score(query: str, texts: list[str]) -> list[float]:
+    """Scores texts by how well they cover the query: term weights are taken from the candidates only, so words found in
+    all of them count little, and texts with the query terms close together score higher
+
+    Args:
+        query (str): question
+        texts (list[str]): candidate texts
+
+    Returns:
+        list[float]: scores in [0, 1]
+    """
+    terms = set(bm25_tokenize(query))
+    if not terms or not texts: return [0.0] * len(texts)
+    tokenized = [bm25_tokenize(text) for text in texts]
+    df = collections.Counter(term for tokens in tokenized for term in terms.intersection(tokens))
+    idf = {term: math.log(1 + (len(texts) - df[term] + 0.5) / (df[term] + 0.5)) for term in terms}
+    total = sum(idf.values()) or 1.0
+
+    scores = []
+    for tokens in tokenized:
+        tf = collections.Counter(token for token in tokens if token in terms)
+        coverage = sum(idf[term] * tf[term] * (RERANK_K1 + 1) / (tf[term] + RERANK_K1) for term in tf) / ((RERANK_K1 + 1) * total)
+        scores.append(coverage * (1 + rerank_proximity(tokens, tf.keys())) / 2)
+    return scores
+
+
+def rerank_proximity(tokens: list[str], terms: set[str]) -> float:
+    """Returns how close together the terms are: number of terms over the length of the shortest window holding all of them
+
+    Args:
+        tokens (list[str]): text tokens
+        terms (set[str]): terms found in tokens
+
+    Returns:
+        float: in (0, 1], 0 if no terms are found
+    """
+    if not terms: return 0.0
+    window, counts, covered, start = len(tokens), collections.Counter(), 0, 0
+    for end, token in enumerate(tokens):
+        if token not in terms: continue
+        counts[token] += 1
+        if counts[token] == 1: covered += 1
+        while covered == len(terms):
+            window = min(window, end - start + 1)
+            if tokens[start] in terms:
+                counts[tokens[start]] -= 1
+                if counts[tokens[start]] == 0: covered -= 1
+            start += 1
+    return len(terms) / window
+
+
+def rerank_shingles(text: str) -> set[int]:
+    """Returns hashes of overlapping word triples (RERANK_SHINGLE_WORDS), texts sharing most of them are near-duplicates
+
+    Args:
+        text (str): text
+
+    Returns:
+        set[int]: shingle hashes
+    """
+    words = text.lower().split()
+    return {hash(tuple(words[i:i + RERANK_SHINGLE_WORDS])) for i in range(max(1, len(words) - RERANK_SHINGLE_WORDS + 1))} if words else set()
+
+
+def rerank_truncate(text: str, tokens: int, count_tokens: Callable[[str], int] = fu_count_tokens) -> str:
+    """Cuts text at a word boundary to at most the given number of tokens
+
+    Args:
+        text (str): text
+        tokens (int): token limit
+        count_tokens (Callable[[str], int], optional): token counter. Defaults to fu_count_tokens.
+
+    Returns:
+        str: text prefix
+    """
+    # binary search over word boundaries, counting is the expensive part
+    boundaries = [i for i, c in enumerate(text) if c.isspace() and (i == 0 or not text[i - 1].isspace())] + [len(text)]
+    low, high = 0, len(boundaries)
+    while low < high:
+        middle = (low + high) // 2
+        if count_tokens(text[:boundaries[middle]]) <= tokens: low = middle + 1
+        else: high = middle
+    return text[:boundaries[low - 1]] if low else ''
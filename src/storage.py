@@ -1,16 +1,28 @@
 # module storage
 
+# system
+import hashlib
+import threading
+import contextlib
+from typing import Callable, ContextManager, Iterable, Iterator
+
 # db
 import pymongo
 
 # langchain
 from langchain.schema import Document
 from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import OllamaEmbeddings
 
 # local
 from log import log_print
-from fileuploader import fu_calculate_document_ids
+from metrics import metrics_count, metrics_span
+from llm import LLMBatchEmbeddings
+
+# constants
+STORAGE_BATCH_SIZE = 256        # chunks written and yielded at once
+STORAGE_CHECKPOINT_SIZE = 4096  # chunks between index saves when streaming
+STORAGE_WRITE_BATCH_SIZE = 1000 # documents or ids per bulk write request
+STORAGE_POOL_SIZE = 16          # connections per client, can be overridden with 'maxPoolSize' in the connection url
 
 
 def storage_documents_to_dict(documents: list[Document]) -> list[dict]:
@@ -37,51 +49,337 @@ def storage_dict_to_documents(dicts: list[dict]) -> list[Document]:
     return [ Document(page_content=d['page_content'], metadata=d['metadata']) for d in dicts ]
 
 
-def storage_add_documents(
-    documents: list[Document], 
+def storage_hash_text(text: str) -> str:
+    """Calculates content hash of a text
+
+    Args:
+        text (str): text
+
+    Returns:
+        str: sha256 hex digest
+    """
+    return hashlib.sha256(text.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+
+def storage_make_version(file_hash: str, chunk_size: int, chunk_overlap: int, chunk_unit: str) -> dict:
+    """Returns what the chunks of a source are made from: file contents and split settings
+
+    Args:
+        file_hash (str): hash of the file contents, see fu_hash_file
+        chunk_size (int): chunk size in chunk_unit
+        chunk_overlap (int): chunk overlap in chunk_unit
+        chunk_unit (str): one of FU_SPLIT_UNITS
+
+    Returns:
+        dict: {'file_hash', 'split'}, kept in the manifest of the source
+    """
+    return {'file_hash': file_hash, 'split': {'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap, 'chunk_unit': chunk_unit}}
+
+
+def storage_is_version(manifest: dict | None, version: dict | None) -> bool:
+    """Checks if a manifest was written for a version, see storage_make_version
+
+    Args:
+        manifest (dict | None): manifest
+        version (dict | None): version, None if unknown
+
+    Returns:
+        bool: True if both are known and the same
+    """
+    return bool(manifest and version) and all(manifest.get(key) == value for key, value in version.items())
+
+
+def storage_get_manifest_collection(db: pymongo.MongoClient, mongo_dbname: str = 'filechat', mongo_colname: str = 'documents') -> pymongo.collection.Collection:
+    """Returns manifest collection that keeps file and chunk hashes for every source
+
+    Args:
+        db (pymongo.MongoClient): mongo client
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): documents collection name. Defaults to 'documents'.
+
+    Returns:
+        pymongo.collection.Collection: manifest collection {'source', 'file_hash', 'split', 'chunks': [{'id', 'hash'}]}
+    """
+    dbman = db[mongo_dbname][f'{mongo_colname}_manifest']
+    dbman.create_index('source', unique=True)
+    return dbman
+
+
+# clients are shared within a process, one per connection url
+STORAGE_CLIENTS = {}
+STORAGE_LOCK = threading.Lock()
+
+
+def storage_get_client(mongo_connect: str = 'mongodb://localhost:27017/') -> pymongo.MongoClient:
+    """Returns process-wide mongo client for a connection url, options in the url (maxPoolSize, w, ...) take precedence
+
+    Args:
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+
+    Returns:
+        pymongo.MongoClient: mongo client
+    """
+    with STORAGE_LOCK:
+        if mongo_connect not in STORAGE_CLIENTS:
+            STORAGE_CLIENTS[mongo_connect] = pymongo.MongoClient(mongo_connect, maxPoolSize=STORAGE_POOL_SIZE)
+        return STORAGE_CLIENTS[mongo_connect]
+
+
+class StorageRepository:
+    """Documents and manifests of a collection, all reads and writes of the library go through it
+
+    Writes are split into bounded unordered bulk requests, reads fetch only the fields they use.
+    The client is shared, so a repository is cheap to create.
+    """
+
+    def __init__(self, mongo_connect: str = 'mongodb://localhost:27017/', mongo_dbname: str = 'filechat', mongo_colname: str = 'documents'):
+        """Opens collections
+
+        Args:
+            mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+            mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+            mongo_colname (str, optional): collection name. Defaults to 'documents'.
+        """
+        self.client = storage_get_client(mongo_connect)
+        self.dbname = mongo_dbname
+        self.colname = mongo_colname
+        self.documents = self.client[mongo_dbname][mongo_colname]
+        self.manifests = self.client[mongo_dbname][f'{mongo_colname}_manifest']
+
+    def ensure_indexes(self):
+        """Creates indexes if they do not exist (the database may have been dropped by another process)"""
+        self.documents.create_index('metadata.id')
+        self.documents.create_index('metadata.source')
+        storage_get_manifest_collection(self.client, self.dbname, self.colname)
+
+    def find_manifest(self, source: str) -> dict | None:
+        """Returns manifest of a source
+
+        Args:
+            source (str): source name
+
+        Returns:
+            dict | None: {'file_hash', 'split', 'chunks': [{'id', 'hash'}]} or None
+        """
+        return self.manifests.find_one({'source': source}, {'_id': 0, 'file_hash': 1, 'split': 1, 'chunks': 1})
+
+    def is_unchanged(self, source: str, version: dict) -> bool:
+        """Checks if a source was stored from the same file with the same split settings (one indexed lookup)
+
+        Args:
+            source (str): source name
+            version (dict): {'file_hash', 'split'}, see storage_make_version
+
+        Returns:
+            bool: True if its chunks are stored and up to date
+        """
+        return storage_is_version(self.manifests.find_one({'source': source}, {'_id': 0, 'file_hash': 1, 'split': 1}), version)
+
+    def find_ids(self, source: str = None, ids: list[str] = None) -> list[str]:
+        """Returns ids of stored chunks of a source, or which of the given ids are stored
+
+        Args:
+            source (str, optional): source name. Defaults to None.
+            ids (list[str], optional): document ids to look up. Defaults to None.
+
+        Returns:
+            list[str]: document ids
+        """
+        if ids is None: return self.documents.distinct('metadata.id', {'metadata.source': source})
+        found = []
+        for i in range(0, len(ids), STORAGE_WRITE_BATCH_SIZE):
+            found += self.documents.distinct('metadata.id', {'metadata.id': {'$in': ids[i:i + STORAGE_WRITE_BATCH_SIZE]}})
+        return found
+
+    def replace_documents(self, documents: list[Document], removed_ids: list[str] = None):
+        """Deletes documents by id, then inserts new ones
+
+        Args:
+            documents (list[Document]): documents with ids, ids already stored must be in removed_ids
+            removed_ids (list[str], optional): ids of documents to delete. Defaults to None.
+        """
+        removed_ids = list(removed_ids or [])
+        for i in range(0, len(removed_ids), STORAGE_WRITE_BATCH_SIZE):
+            self.documents.delete_many({'metadata.id': {'$in': removed_ids[i:i + STORAGE_WRITE_BATCH_SIZE]}})
+        for i in range(0, len(documents), STORAGE_WRITE_BATCH_SIZE):
+            self.documents.insert_many(storage_documents_to_dict(documents[i:i + STORAGE_WRITE_BATCH_SIZE]), ordered=False)
+
+    def write_manifests(self, manifests: list[dict]):
+        """Inserts or replaces manifests
+
+        Args:
+            manifests (list[dict]): manifests {'source', 'file_hash', 'split', 'chunks'}
+        """
+        for i in range(0, len(manifests), STORAGE_WRITE_BATCH_SIZE):
+            requests = [pymongo.ReplaceOne({'source': m['source']}, m, upsert=True) for m in manifests[i:i + STORAGE_WRITE_BATCH_SIZE]]
+            self.manifests.bulk_write(requests, ordered=False)
+
+    def delete_sources(self, sources: list[str]) -> list[str]:
+        """Deletes documents and manifests of sources
+
+        Args:
+            sources (list[str]): source names
+
+        Returns:
+            list[str]: ids of deleted documents
+        """
+        ids = self.documents.distinct('metadata.id', {'metadata.source': {'$in': sources}})
+        self.documents.delete_many({'metadata.source': {'$in': sources}})
+        self.manifests.delete_many({'source': {'$in': sources}})
+        return ids
+
+    def iter_documents(self, batch_size: int = STORAGE_WRITE_BATCH_SIZE) -> Iterator[Document]:
+        """Reads all documents
+
+        Args:
+            batch_size (int, optional): documents per round trip. Defaults to STORAGE_WRITE_BATCH_SIZE.
+
+        Yields:
+            Iterator[Document]: documents
+        """
+        for d in self.documents.find({}, {'_id': 0, 'page_content': 1, 'metadata': 1}, batch_size=batch_size):
+            yield Document(page_content=d['page_content'], metadata=d['metadata'])
+
+
+def storage_iter_add_documents(
+    sources: Iterable[tuple[str, Iterable[Document]]], 
     mongo_connect: str = 'mongodb://localhost:27017/', 
     mongo_dbname: str = 'filechat',
     mongo_colname: str = 'documents', 
+    batch_size: int = STORAGE_BATCH_SIZE,
+    checkpoint: Callable[[], None] = None,
+    checkpoint_size: int = STORAGE_CHECKPOINT_SIZE,
+    on_error: Callable[[str, Exception], None] = None,
+    versions: dict[str, dict] = None,
     verbose: bool = True,
-) -> int | list[Document]:
-    """Adds documents to database
+) -> Iterator[tuple[list[Document], list[str]]]:
+    """Adds new and changed documents to database as they arrive, evicts chunks that are no longer present
 
     Args:
-        documents (list[Document]): documents
+        sources (Iterable[tuple[str, Iterable[Document]]]): source name and its chunks with ids
         mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
         mongo_dbname (str, optional): database name. Defaults to 'filechat'.
         mongo_colname (str, optional): collection name. Defaults to 'documents'.
+        batch_size (int, optional): new chunks per batch, one batch for everything if None. Defaults to STORAGE_BATCH_SIZE.
+        checkpoint (Callable[[], None], optional): makes the consumed batches durable (saves the index), called before manifests are written. Defaults to None.
+        checkpoint_size (int, optional): chunks between checkpoints. Defaults to STORAGE_CHECKPOINT_SIZE.
+        on_error (Callable[[str, Exception], None], optional): called with (source, error) when reading a source fails, the source is skipped. Raises if None. Defaults to None.
+        versions (dict[str, dict], optional): source => version (see storage_make_version), a source stored from the same version is skipped 
+            without reading its chunks. Defaults to None (chunks of every source are compared).
         verbose (bool, optional): verbose output. Defaults to True.
         
-    Returns:
-        list[Document]: list of new documents added
+    Yields:
+        Iterator[tuple[list[Document], list[str]]]: batch of new documents added, batch of document ids removed
+    
+    Note:
+        each source has a manifest entry with its version (file hash and split settings) and per-chunk hashes, only changed chunks are re-added.
+        Manifests are written after their chunks were consumed and checkpointed, an interrupted run is resumed by running it again:
+        stored versions of chunks are deleted before they are inserted, so repeating a batch does not duplicate it
     """    
-    # init storage
-    db = pymongo.MongoClient(mongo_connect)
-    dbcol = db[mongo_dbname][mongo_colname]
+    repository = StorageRepository(mongo_connect, mongo_dbname, mongo_colname)
+    repository.ensure_indexes()
     
-    # calculate document ids
-    documents_with_ids = fu_calculate_document_ids(documents)
-
-    # add or update the documents
-    existing_items = storage_dict_to_documents(dbcol.find({}, {'_id':0}))
-    existing_ids = set([item.metadata['id'] for item in existing_items])
-    if verbose: log_print(f'Number of existing documents in DB: {len(existing_ids)}')
-
-    # count new documents that don't exist in the DB to add later
-    new_documents = []
-    for chunk in documents_with_ids:
-        if chunk.metadata['id'] not in existing_ids:
-            new_documents.append(chunk)
-
-    # add new documents
-    if len(new_documents):
-        if verbose: log_print(f'👉 Adding new documents: {len(new_documents)}')
-        dbcol.insert_many(storage_documents_to_dict(new_documents))
+    pending_new = []      # chunks not yet written
+    unverified = set()    # ids of pending chunks that are not in the manifest, but may be stored by an interrupted run
+    pending_removed = []  # (source, id) not yet evicted
+    waiting = []          # manifests of finished sources with chunks in the pending batch
+    unsaved = []          # manifests of finished sources with chunks consumed, but not checkpointed
+    unsaved_chunks = 0
+    totals = [0, 0]
+    
+    def flush() -> tuple[list[Document], list[str]]:
+        new_batch = list(pending_new)
+        removed_batch = list(dict.fromkeys(id for _, id in pending_removed))
+        leftover_ids = repository.find_ids(ids=[d.metadata['id'] for d in new_batch if d.metadata['id'] in unverified]) if unverified else []
+        pending_new.clear()
+        pending_removed.clear()
+        unverified.clear()
+        
+        # stored versions are deleted first, so repeated batches are not duplicated
+        with metrics_span('store'): repository.replace_documents(new_batch, removed_batch + leftover_ids)
+        metrics_count('filechat_stored_chunks_total', len(new_batch), op='added')
+        metrics_count('filechat_stored_chunks_total', len(removed_batch), op='removed')
+        totals[0] += len(new_batch)
+        totals[1] += len(removed_batch)
+        return new_batch, removed_batch
+    
+    def commit():
+        if checkpoint: checkpoint()
+        with metrics_span('store'): repository.write_manifests(unsaved)
+        unsaved.clear()
+    
+    for source, chunks in sources:
+        manifest = repository.find_manifest(source)
+        version = (versions or {}).get(source)
+        if storage_is_version(manifest, version): continue
+        
+        # documents added before manifests were introduced (or by an interrupted first run) have no known hash
+        if manifest: existing_hashes = {item['id']: item['hash'] for item in manifest['chunks']}
+        else: existing_hashes = {id: None for id in repository.find_ids(source)}
+        
+        # compare chunks against the manifest as they arrive
+        hashes = {}
+        changed = 0
+        try:
+            for chunk in chunks:
+                id = chunk.metadata['id']
+                if id in hashes: continue
+                chunk.metadata['hash'] = storage_hash_text(chunk.page_content)
+                hashes[id] = chunk.metadata['hash']
+                if existing_hashes.get(id) == chunk.metadata['hash']: continue
+                
+                # changed chunks are replaced
+                changed += 1
+                pending_new.append(chunk)
+                if id in existing_hashes: pending_removed.append((source, id))
+                elif manifest: unverified.add(id)
+                if batch_size and len(pending_new) >= batch_size:
+                    yield flush()
+                    unsaved_chunks += batch_size
+                    unsaved += waiting
+                    waiting.clear()
+                    if unsaved_chunks >= checkpoint_size: 
+                        commit()
+                        unsaved_chunks = 0
+        except Exception as e:
+            # the unwritten chunks of a source that could not be read are dropped, batches written before the error already 
+            # replaced their previous versions. Its manifest lists them without a version, so the next run reads the file 
+            # again and evicts those that are gone by then.
+            if not on_error: raise
+            on_error(source, e)
+            pending_ids = {chunk.metadata['id'] for chunk in pending_new if chunk.metadata['source'] == source}
+            written = {id: hash for id, hash in hashes.items() if id not in pending_ids and existing_hashes.get(id) != hash}
+            if written: unsaved.append({
+                'source': source, 
+                'file_hash': None, 
+                'split': None, 
+                'chunks': [{'id': id, 'hash': hash} for id, hash in {**existing_hashes, **written}.items()],
+            })
+            pending_new[:] = [chunk for chunk in pending_new if chunk.metadata['source'] != source]
+            pending_removed[:] = [item for item in pending_removed if item[0] != source]
+            unverified.intersection_update(chunk.metadata['id'] for chunk in pending_new)
+            continue
+        
+        # disappeared chunks are evicted
+        stale_ids = [id for id in existing_hashes if id not in hashes]
+        pending_removed.extend((source, id) for id in stale_ids)
+        if verbose and (changed or stale_ids): log_print(f'{source}: {changed} changed, {len(stale_ids)} stale chunks')
+        
+        if not manifest or changed or stale_ids or version:
+            waiting.append({
+                'source': source,
+                **(version or {'file_hash': None, 'split': None}),
+                'chunks': [{'id': id, 'hash': hash} for id, hash in hashes.items()],
+            })
+        
+    if pending_new or pending_removed: yield flush()
+    unsaved += waiting
+    if unsaved or unsaved_chunks: commit()
+
+    if totals[0] or totals[1]:
+        if verbose: log_print(f'👉 Added new documents: {totals[0]}, removed: {totals[1]}')
     else:
         if verbose: log_print('✅ No new documents to add')
-    
-    return new_documents
 
 
 def storage_clear_database(mongo_connect: str = 'mongodb://localhost:27017/', mongo_dbname: str = 'filechat'):
@@ -91,23 +389,75 @@ def storage_clear_database(mongo_connect: str = 'mongodb://localhost:27017/', mo
         mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
         mongo_dbname (str, optional): database name. Defaults to 'filechat'.
     """
-    db = pymongo.MongoClient(mongo_connect)
-    db.drop_database(mongo_dbname)
+    storage_get_client(mongo_connect).drop_database(mongo_dbname)
+
+
+def storage_delete_sources(
+    sources: list[str],
+    mongo_connect: str = 'mongodb://localhost:27017/',
+    mongo_dbname: str = 'filechat',
+    mongo_colname: str = 'documents',
+) -> list[str]:
+    """Deletes documents of sources, they are added again in full if the files are submitted again
+
+    Args:
+        sources (list[str]): source names
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): collection name. Defaults to 'documents'.
+
+    Returns:
+        list[str]: ids of deleted documents
+    """
+    return StorageRepository(mongo_connect, mongo_dbname, mongo_colname).delete_sources(sources)
 
 
 def storage_get_all_documents(mongo_connect: str = 'mongodb://localhost:27017/', mongo_dbname: str = 'filechat', mongo_colname: str = 'documents') -> list[Document]:
-    # init storage
-    db = pymongo.MongoClient(mongo_connect)
-    dbcol = db[mongo_dbname][mongo_colname]
-    
-    # retreive documents
-    dicts = dbcol.find({}, {'_id':0})
-    documents = storage_dict_to_documents(dicts)
-    
-    return documents
+    """Reads all documents
 
+    Args:
+        mongo_connect (str, optional): connection url. Defaults to 'mongodb://localhost:27017/'.
+        mongo_dbname (str, optional): database name. Defaults to 'filechat'.
+        mongo_colname (str, optional): collection name. Defaults to 'documents'.
+
+    Returns:
+        list[Document]: documents
+    """
+    return list(StorageRepository(mongo_connect, mongo_dbname, mongo_colname).iter_documents())
 
-def storage_load_vectorstore(documents: list[Document], embedding: OllamaEmbeddings) -> FAISS:
-    return FAISS.from_documents(documents, embedding)
 
+def storage_load_vectorstore(
+    documents: list[Document], 
+    embedding: LLMBatchEmbeddings, 
+    vectorStore: FAISS = None, 
+    progress: Callable[[int, int], None] = None,
+    write_lock: ContextManager = None,
+) -> FAISS:
+    """Embeds documents in batches and adds them to vectorStore as the batches arrive
 
+    Args:
+        documents (list[Document]): documents with ids
+        embedding (LLMBatchEmbeddings): embedding function
+        vectorStore (FAISS, optional): FAISS object to add to, creates a new one if None. Defaults to None.
+        progress (Callable[[int, int], None], optional): called with (documents embedded, total). Defaults to None.
+        write_lock (ContextManager, optional): held while a batch is added, embedding runs without it. Defaults to None.
+
+    Returns:
+        FAISS: vectorstore object
+    """
+    write_lock = write_lock or contextlib.nullcontext()
+    done = 0
+    for positions, vectors in embedding.embed_batches([d.page_content for d in documents]):
+        batch = [documents[i] for i in positions]
+        text_embeddings = [(d.page_content, vector) for d, vector in zip(batch, vectors)]
+        metadatas = [d.metadata for d in batch]
+        ids = [d.metadata['id'] for d in batch]
+        if vectorStore: 
+            with write_lock, metrics_span('index'): vectorStore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        else: 
+            with metrics_span('index'): vectorStore = FAISS.from_embeddings(text_embeddings, embedding, metadatas=metadatas, ids=ids)
+        
+        done += len(batch)
+        if progress: progress(done, len(documents))
+    
+    return vectorStore
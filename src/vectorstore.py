@@ -2,18 +2,597 @@
 
 # system
 import os
+import json
+import mmap
+import time
+import hashlib
+import itertools
+import fcntl
+import shutil
 import pickle
+import threading
+import contextlib
+import collections
+from typing import Callable, ContextManager, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+# vector
+import faiss
+import numpy as np
 
 # langchain
 from langchain.schema import Document
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.base import Docstore, AddableMixin
 
 # local
 from llm import *
+from bm25 import *
 from storage import *
 
 # constants
-VECTORSTORE_DB = 'vectorstore.pkl'
+VECTORSTORE_DIR = 'vectorstore'
+VECTORSTORE_DB = 'vectorstore.pkl' # legacy pickle, converted on load
+VECTORSTORE_LOCK = 'vectorstore.lock' # held by the process that writes the index
+VECTORSTORE_INDEX_TYPES = ['flat', 'ivf', 'hnsw', 'ivfpq', 'sq8']
+VECTORSTORE_ANN_MIN_VECTORS = 10000 # below that a flat index is used, approximate indexes need enough vectors to train
+VECTORSTORE_NPROBE = 16
+VECTORSTORE_EF_SEARCH = 64
+VECTORSTORE_REFRESH_INTERVAL = 1.0 # seconds between checks for a generation saved by another process
+VECTORSTORE_RETRIEVAL_MODES = ['hybrid', 'vector']
+VECTORSTORE_RRF_K = 60 # reciprocal rank fusion constant
+VECTORSTORE_FETCH_K = 20 # candidates taken from each retriever before fusion
+VECTORSTORE_CODECS = ['float32', 'float16', 'int8'] # how vectors are stored in the index
+VECTORSTORE_REDUCTIONS = ['pca', 'truncate'] # truncate keeps the leading dimensions (Matryoshka embeddings)
+VECTORSTORE_TRAIN_MIN_VECTORS = 1000 # int8 ranges and PCA are trained once a shard has that many vectors, float16 and full dimension until then
+VECTORSTORE_TRAIN_SAMPLE = 10000 # vectors sampled to train int8 ranges and PCA
+VECTORSTORE_SHARDS = 16 # sources are hashed into shards, each one is saved, rebuilt and searched on its own
+VECTORSTORE_SEARCH_WORKERS = 4 # threads searching the shards of a query
+VECTORSTORE_DIRECT_MAP_LOCK = threading.Lock() # IVF direct maps are built once, on the first search restricted to sources
+
+
+class VectorStoreDocstore(Docstore, AddableMixin):
+    """Docstore backed by memory-mapped append-only 'docstore.jsonl', documents are decoded on access
+
+    Documents added since the last vectorstore_save are kept in memory until the next save.
+    The keyword index follows every add and delete.
+    Exact vectors of a compressed index are kept here for re-scoring (see vectorstore_vectors), saved ones are memory-mapped.
+    """
+
+    def __init__(
+        self, 
+        filepath: str = None, 
+        size: int = 0, 
+        offsets: dict[str, tuple[int, int]] = None, 
+        keywords: BM25Index = None,
+        vectors: np.ndarray = None,
+        vector_rows: dict[str, int] = None,
+    ):
+        """Opens docstore
+
+        Args:
+            filepath (str, optional): docstore file. Defaults to None.
+            size (int, optional): committed size of the file. Defaults to 0.
+            offsets (dict[str, tuple[int, int]], optional): docstore id => (offset, length) of its record. Defaults to None.
+            keywords (BM25Index, optional): keyword index of the documents. Defaults to None.
+            vectors (np.ndarray, optional): saved exact vectors. Defaults to None.
+            vector_rows (dict[str, int], optional): docstore id => row of its exact vector. Defaults to None.
+        """
+        self.filepath = filepath
+        self.size = size
+        self.offsets = offsets or {}
+        self.pending = {}
+        self.keywords = keywords
+        self.vectors = vectors
+        self.vector_rows = vector_rows or {}
+        self.pending_vectors = {}
+        self.map = None
+        if filepath and size:
+            with open(filepath, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def add(self, texts: dict[str, Document]):
+        overlapping = [id for id in texts if id in self.offsets or id in self.pending]
+        if overlapping: raise ValueError(f'Tried to add ids that already exist: {overlapping}')
+        self.pending.update(texts)
+        if self.keywords is not None:
+            for id, document in texts.items(): self.keywords.add(id, document.page_content)
+
+    def delete(self, ids: list):
+        missing = [id for id in ids if id not in self.offsets and id not in self.pending]
+        if missing: raise ValueError(f'Tried to delete ids that does not exist: {missing}')
+        for id in ids:
+            self.offsets.pop(id, None)
+            self.pending.pop(id, None)
+            self.pending_vectors.pop(id, None)
+        if self.keywords is not None: self.keywords.remove(ids)
+
+    def add_vectors(self, ids: list[str], vectors: list[list[float]]):
+        """Keeps exact vectors of added documents until the next save
+
+        Args:
+            ids (list[str]): docstore ids
+            vectors (list[list[float]]): their vectors
+        """
+        self.pending_vectors.update(zip(ids, vectors))
+
+    def search(self, search: str) -> Document | str:
+        if search in self.pending: return self.pending[search]
+        if search not in self.offsets: return f'ID {search} not found.'
+        record = json.loads(self.raw(search))
+        return Document(page_content=record['page_content'], metadata=record['metadata'])
+
+    def raw(self, id: str) -> bytes:
+        """Returns encoded record of a document
+
+        Args:
+            id (str): docstore id
+
+        Returns:
+            bytes: JSON line
+        """
+        if id in self.pending: return vectorstore_encode_record(id, self.pending[id])
+        offset, length = self.offsets[id]
+        return self.map[offset:offset + length]
+
+
+def vectorstore_read(path: str = VECTORSTORE_DIR, embedding: LLMBatchEmbeddings = None, memory_map: bool = True) -> FAISS | None:
+    """Reads vectorstore saved by vectorstore_save
+
+    Args:
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+        embedding (LLMBatchEmbeddings, optional): embedding function. Defaults to None.
+        memory_map (bool, optional): memory-map the index if the index type supports it. Defaults to True.
+
+    Returns:
+        FAISS | None: FAISS object or None if nothing was saved
+    
+    Note:
+        layout: 'CURRENT' (committed generation and docstore size), 'docstore.jsonl' (append-only documents),
+        'gen-N/index.faiss' (raw FAISS index), 'gen-N/idmap.json' ([docstore id, record offset, record length] per index position),
+        'gen-N/bm25-*' (keyword index, see BM25Index.save), 'gen-N/vectors.npy' (exact vectors in index order, if kept for re-scoring)
+    """
+    current = vectorstore_read_current(path)
+    if not current: return None
+    
+    genpath = os.path.join(path, f'gen-{current["generation"]:06d}')
+    index = vectorstore_read_index(os.path.join(genpath, 'index.faiss'), memory_map)
+    with open(os.path.join(genpath, 'idmap.json'), 'r') as f: 
+        idmap = json.load(f)
+    
+    vectors = np.load(os.path.join(genpath, 'vectors.npy'), mmap_mode='r') if os.path.exists(os.path.join(genpath, 'vectors.npy')) else None
+    docstore = VectorStoreDocstore(
+        os.path.join(path, 'docstore.jsonl'), 
+        current['docstore_bytes'], 
+        {id: (offset, length) for id, offset, length in idmap},
+        vectors=vectors,
+        vector_rows={id: i for i, (id, _, _) in enumerate(idmap)} if vectors is not None else None,
+    )
+    docstore.keywords = BM25Index.load(genpath, memory_map) or vectorstore_build_keywords(docstore, [id for id, _, _ in idmap])
+    return FAISS(
+        embedding_function=embedding,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id={i: id for i, (id, _, _) in enumerate(idmap)},
+    )
+
+
+def vectorstore_build_keywords(docstore: Docstore, ids: list[str]) -> BM25Index:
+    """Builds keyword index from documents in a docstore
+
+    Args:
+        docstore (Docstore): docstore
+        ids (list[str]): docstore ids
+
+    Returns:
+        BM25Index: keyword index
+    """
+    keywords = BM25Index()
+    for id in ids: keywords.add(id, docstore.search(id).page_content)
+    return keywords
+
+
+def vectorstore_read_current(path: str = VECTORSTORE_DIR) -> dict | None:
+    """Reads committed vectorstore state
+
+    Args:
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+
+    Returns:
+        dict | None: {'generation', 'docstore_bytes', 'docstore_records'} or None if nothing was saved
+    """
+    try:
+        with open(os.path.join(path, 'CURRENT'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def vectorstore_read_index(filepath: str, memory_map: bool = True) -> faiss.Index:
+    """Reads FAISS index
+
+    Args:
+        filepath (str): index file
+        memory_map (bool, optional): memory-map the index (IVF inverted lists are mapped read-only). Defaults to True.
+
+    Returns:
+        faiss.Index: index
+    """
+    if memory_map:
+        try: return faiss.read_index(filepath, faiss.IO_FLAG_MMAP)
+        except RuntimeError: pass
+    return faiss.read_index(filepath)
+
+
+def vectorstore_writable(vectorStore: FAISS, path: str = VECTORSTORE_DIR) -> FAISS:
+    """Makes sure the index can be modified, memory-mapped inverted lists are read-only and are reloaded into memory
+
+    Args:
+        vectorStore (FAISS): FAISS object
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+
+    Returns:
+        FAISS: vectorstore object
+    """
+    ivf = faiss.try_extract_index_ivf(vectorStore.index)
+    if ivf is not None and isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists):
+        current = vectorstore_read_current(path)
+        vectorStore.index = vectorstore_read_index(os.path.join(path, f'gen-{current["generation"]:06d}', 'index.faiss'), memory_map=False)
+    return vectorStore
+
+
+def vectorstore_save(vectorStore: FAISS, path: str = VECTORSTORE_DIR, vectors: np.ndarray = None) -> FAISS:
+    """Saves vectorstore: appends new documents to the docstore, writes index as a new generation and atomically swaps to it
+
+    Args:
+        vectorStore (FAISS): FAISS object
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+        vectors (np.ndarray, optional): exact vectors in index order, saved next to a compressed index for re-scoring. Defaults to None.
+
+    Returns:
+        FAISS: vectorstore object with docstore backed by the saved file
+    """
+    os.makedirs(path, exist_ok=True)
+    current = vectorstore_read_current(path) or {'generation': 0, 'docstore_bytes': 0, 'docstore_records': 0}
+    ids = [vectorStore.index_to_docstore_id[i] for i in range(vectorStore.index.ntotal)]
+    docstore = vectorStore.docstore
+    docstore_path = os.path.join(path, 'docstore.jsonl')
+    
+    # append pending documents, rewrite the whole docstore if it is not ours yet or when most of it is garbage
+    offsets = {}
+    incremental = (
+        isinstance(docstore, VectorStoreDocstore) 
+        and docstore.filepath == docstore_path 
+        and docstore.size == current['docstore_bytes']
+        and current['docstore_records'] <= 2 * len(ids) + 1000
+    )
+    if incremental:
+        offsets.update(docstore.offsets)
+        with open(docstore_path, 'ab') as f:
+            # drop anything written after the last commit
+            f.truncate(current['docstore_bytes'])
+            for id, document in docstore.pending.items():
+                record = vectorstore_encode_record(id, document)
+                offsets[id] = (f.tell(), len(record))
+                f.write(record)
+            docstore_bytes = f.tell()
+        docstore_records = current['docstore_records'] + len(docstore.pending)
+    else:
+        with open(docstore_path + '.tmp', 'wb') as f:
+            for id in ids:
+                record = docstore.raw(id) if isinstance(docstore, VectorStoreDocstore) else vectorstore_encode_record(id, docstore.search(id))
+                offsets[id] = (f.tell(), len(record))
+                f.write(record)
+            docstore_bytes = f.tell()
+        os.replace(docstore_path + '.tmp', docstore_path)
+        docstore_records = len(ids)
+    
+    # write new generation
+    generation = current['generation'] + 1
+    genpath = os.path.join(path, f'gen-{generation:06d}')
+    os.makedirs(genpath, exist_ok=True)
+    faiss.write_index(vectorStore.index, os.path.join(genpath, 'index.faiss'))
+    with open(os.path.join(genpath, 'idmap.json'), 'w') as f:
+        json.dump([[id, *offsets[id]] for id in ids], f)
+    keywords = docstore.keywords if isinstance(docstore, VectorStoreDocstore) and docstore.keywords is not None else vectorstore_build_keywords(docstore, ids)
+    keywords.save(genpath)
+    if vectors is not None:
+        np.save(os.path.join(genpath, 'vectors.npy'), vectors)
+        vectors = np.load(os.path.join(genpath, 'vectors.npy'), mmap_mode='r')
+    
+    # swap
+    with open(os.path.join(path, 'CURRENT.tmp'), 'w') as f:
+        json.dump({'generation': generation, 'docstore_bytes': docstore_bytes, 'docstore_records': docstore_records}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(os.path.join(path, 'CURRENT.tmp'), os.path.join(path, 'CURRENT'))
+    
+    # remove old generations (readers that still map them keep their open file)
+    for name in os.listdir(path):
+        if name.startswith('gen-') and name != f'gen-{generation:06d}':
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    
+    vectorStore.docstore = VectorStoreDocstore(
+        docstore_path, 
+        docstore_bytes, 
+        {id: offsets[id] for id in ids}, 
+        keywords, 
+        vectors, 
+        {id: i for i, id in enumerate(ids)} if vectors is not None else None,
+    )
+    return vectorStore
+
+
+def vectorstore_encode_record(id: str, document: Document) -> bytes:
+    """Encodes docstore record as a JSON line
+
+    Args:
+        id (str): docstore id
+        document (Document): document
+
+    Returns:
+        bytes: JSON line
+    """
+    return json.dumps({'id': id, 'page_content': document.page_content, 'metadata': document.metadata}).encode() + b'\n'
+
+
+def vectorstore_delete(path: str = VECTORSTORE_DIR):
+    """Deletes saved vectorstore
+
+    Args:
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    if os.path.exists(VECTORSTORE_DB): os.remove(VECTORSTORE_DB)
+
+
+@contextlib.contextmanager
+def vectorstore_lock(path: str = VECTORSTORE_LOCK, blocking: bool = True) -> Iterator[bool]:
+    """Holds the inter-process writer lock, only one process modifies the saved vectorstore at a time
+
+    Args:
+        path (str, optional): lock file. Defaults to VECTORSTORE_LOCK.
+        blocking (bool, optional): wait for the lock, otherwise give up if it is taken. Defaults to True.
+
+    Yields:
+        Iterator[bool]: True if the lock is held
+    """
+    with open(path, 'a') as f:
+        try: fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try: yield True
+        finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def vectorstore_make_index(index_type: str, dim: int, n: int, codec: str = 'float32', reduced_dim: int = 0, reduction: str = 'pca') -> faiss.Index:
+    """Creates empty (untrained) FAISS index
+
+    Args:
+        index_type (str): one of VECTORSTORE_INDEX_TYPES
+        dim (int): vector dimension
+        n (int): expected number of vectors, used to size IVF lists
+        codec (str, optional): one of VECTORSTORE_CODECS, 'ivfpq' and 'sq8' have their own. Defaults to 'float32'.
+        reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+        reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+
+    Returns:
+        faiss.Index: index
+    
+    Note:
+        'flat' (exact), 'ivf' (IVF-Flat), 'hnsw' (HNSW graph), 'ivfpq' (IVF + product quantization), 'sq8' (IVF + 8-bit scalar quantization)
+    """
+    stored_dim = reduced_dim if 0 < reduced_dim < dim else dim
+    nlist = int(min(65536, max(16, 4 * np.sqrt(n))))
+    pq_m = max(m for m in range(1, min(64, max(1, stored_dim // 8)) + 1) if stored_dim % m == 0) # ~8+ dimensions per sub-quantizer
+    if codec not in VECTORSTORE_CODECS: raise Exception(f'Unsupported codec: {codec}!')
+    code = {'float32': 'Flat', 'float16': 'SQfp16', 'int8': 'SQ8'}[codec]
+    factory = {
+        'flat': code,
+        'ivf': f'IVF{nlist},{code}',
+        'hnsw': 'HNSW32' if codec == 'float32' else f'HNSW32_{code}',
+        'ivfpq': f'IVF{nlist},PQ{pq_m}',
+        'sq8': f'IVF{nlist},SQ8',
+    }
+    if index_type not in factory: raise Exception(f'Unsupported index type: {index_type}!')
+    if stored_dim == dim: return faiss.index_factory(dim, factory[index_type])
+    if reduction == 'pca': return faiss.index_factory(dim, f'PCA{stored_dim},{factory[index_type]}')
+    if reduction == 'truncate': return faiss.IndexPreTransform(faiss.RemapDimensionsTransform(dim, stored_dim, False), faiss.index_factory(stored_dim, factory[index_type]))
+    raise Exception(f'Unsupported reduction: {reduction}!')
+
+
+def vectorstore_get_index_type(index: faiss.Index) -> str:
+    """Returns type of FAISS index
+
+    Args:
+        index (faiss.Index): index
+
+    Returns:
+        str: one of VECTORSTORE_INDEX_TYPES
+    """
+    if isinstance(index, faiss.IndexPreTransform): index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW): return 'hnsw'
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None: ivf = faiss.downcast_index(ivf)
+    if isinstance(ivf, faiss.IndexIVFPQ): return 'ivfpq'
+    if isinstance(ivf, faiss.IndexIVFScalarQuantizer) and ivf.sq.qtype == faiss.ScalarQuantizer.QT_8bit: return 'sq8'
+    if ivf is not None: return 'ivf'
+    return 'flat'
+
+
+def vectorstore_get_codec(index: faiss.Index) -> tuple[str, int, str | None]:
+    """Returns how vectors are stored in a FAISS index
+
+    Args:
+        index (faiss.Index): index
+
+    Returns:
+        tuple[str, int, str | None]: codec (one of VECTORSTORE_CODECS or 'pq'), stored dimension, reduction (one of VECTORSTORE_REDUCTIONS or None)
+    """
+    reduction = None
+    if isinstance(index, faiss.IndexPreTransform):
+        reduction = 'pca' if isinstance(faiss.downcast_VectorTransform(index.chain.at(0)), faiss.PCAMatrix) else 'truncate'
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW): index = faiss.downcast_index(index.storage)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None: index = faiss.downcast_index(ivf)
+    if isinstance(index, faiss.IndexIVFPQ): return 'pq', index.d, reduction
+    if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return ('float16' if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'int8'), index.d, reduction
+    return 'float32', index.d, reduction
+
+
+def vectorstore_target_codec(index_type: str, codec: str, reduced_dim: int, reduction: str, dim: int, n: int) -> tuple[str, int, str | None]:
+    """Returns how to store n vectors
+
+    Args:
+        index_type (str): index type to use, see vectorstore_target_index_type
+        codec (str): configured codec, one of VECTORSTORE_CODECS
+        reduced_dim (int): configured dimension, 0 to keep all
+        reduction (str): one of VECTORSTORE_REDUCTIONS
+        dim (int): vector dimension
+        n (int): number of vectors
+
+    Returns:
+        tuple[str, int, str | None]: see vectorstore_get_codec, trained codecs and PCA are used from VECTORSTORE_TRAIN_MIN_VECTORS vectors
+    """
+    trained = n >= VECTORSTORE_TRAIN_MIN_VECTORS
+    if index_type == 'ivfpq': codec = 'pq'
+    elif index_type == 'sq8': codec = 'int8'
+    elif codec == 'int8' and not trained: codec = 'float16'
+    if not 0 < reduced_dim < dim or (reduction == 'pca' and not trained): return codec, dim, None
+    return codec, reduced_dim, reduction
+
+
+def vectorstore_is_compressed(index: faiss.Index) -> bool:
+    """Returns True if the index does not hold exact vectors
+
+    Args:
+        index (faiss.Index): index
+
+    Returns:
+        bool: vectors are quantized or reduced
+    """
+    return vectorstore_get_codec(index) != ('float32', index.d, None)
+
+
+def vectorstore_target_index_type(index_type: str, n: int) -> str:
+    """Returns index type to use for n vectors
+
+    Args:
+        index_type (str): configured index type
+        n (int): number of vectors
+
+    Returns:
+        str: index_type or 'flat' if there are fewer than VECTORSTORE_ANN_MIN_VECTORS vectors
+    """
+    return index_type if n >= VECTORSTORE_ANN_MIN_VECTORS else 'flat'
+
+
+def vectorstore_tune_index(index: faiss.Index, nprobe: int = VECTORSTORE_NPROBE, ef_search: int = VECTORSTORE_EF_SEARCH):
+    """Sets search-time parameters, ignored by index types that do not have them
+
+    Args:
+        index (faiss.Index): index
+        nprobe (int, optional): IVF lists visited per query. Defaults to VECTORSTORE_NPROBE.
+        ef_search (int, optional): HNSW search queue size. Defaults to VECTORSTORE_EF_SEARCH.
+    """
+    params = faiss.ParameterSpace()
+    for name, value in (('nprobe', nprobe), ('efSearch', ef_search)):
+        try: params.set_index_parameter(index, name, value)
+        except RuntimeError: pass
+
+
+def vectorstore_reconstruct(index: faiss.Index) -> np.ndarray:
+    """Returns all vectors stored in the index (approximations for quantized indexes)
+
+    Args:
+        index (faiss.Index): index
+
+    Returns:
+        np.ndarray: vectors in index order
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None: ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, index.d), dtype=np.float32)
+
+
+def vectorstore_target_format(
+    index: faiss.Index,
+    index_type: str = 'flat',
+    codec: str = 'float32',
+    reduced_dim: int = 0,
+    reduction: str = 'pca',
+) -> tuple[str, tuple[str, int, str | None]]:
+    """Returns index type and codec to use for the vectors of an index
+
+    Args:
+        index (faiss.Index): index
+        index_type (str, optional): one of VECTORSTORE_INDEX_TYPES. Defaults to 'flat'.
+        codec (str, optional): one of VECTORSTORE_CODECS. Defaults to 'float32'.
+        reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+        reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+
+    Returns:
+        tuple[str, tuple[str, int, str | None]]: index type, codec (see vectorstore_get_codec)
+    """
+    target_type = vectorstore_target_index_type(index_type, index.ntotal)
+    target_codec = vectorstore_target_codec(target_type, codec, reduced_dim, reduction, index.d, index.ntotal)
+    if target_type == 'ivf' and target_codec[0] == 'int8': target_type = 'sq8' # the same index
+    return target_type, target_codec
+
+
+def vectorstore_build_index(
+    vectorStore: FAISS, 
+    index_type: str = 'flat', 
+    nprobe: int = VECTORSTORE_NPROBE, 
+    ef_search: int = VECTORSTORE_EF_SEARCH,
+    codec: str = 'float32',
+    reduced_dim: int = 0,
+    reduction: str = 'pca',
+) -> FAISS:
+    """Rebuilds index as index_type if it is of another type or stores vectors in another way, training on the vectors already stored
+
+    Args:
+        vectorStore (FAISS): FAISS object
+        index_type (str, optional): one of VECTORSTORE_INDEX_TYPES. Defaults to 'flat'.
+        nprobe (int, optional): IVF lists visited per query. Defaults to VECTORSTORE_NPROBE.
+        ef_search (int, optional): HNSW search queue size. Defaults to VECTORSTORE_EF_SEARCH.
+        codec (str, optional): one of VECTORSTORE_CODECS. Defaults to 'float32'.
+        reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+        reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+
+    Returns:
+        FAISS: vectorstore object
+    
+    Note:
+        approximate indexes are built once there are VECTORSTORE_ANN_MIN_VECTORS vectors, a flat index is used until then.
+        Vectors added later are assigned to the trained lists (and encoded with the trained int8 ranges or PCA), call again with another type to retrain.
+        The new index is built from exact vectors if they were kept (see vectorstore_vectors), from the stored ones otherwise.
+    """
+    index = vectorStore.index
+    target_type, target_codec = vectorstore_target_format(index, index_type, codec, reduced_dim, reduction)
+    if (vectorstore_get_index_type(index), vectorstore_get_codec(index)) != (target_type, target_codec):
+        vectors = vectorstore_vectors(vectorStore, np.arange(index.ntotal))
+        new_codec, new_dim, new_reduction = target_codec
+        new_index = vectorstore_make_index(
+            target_type, 
+            index.d, 
+            len(vectors), 
+            new_codec if new_codec in VECTORSTORE_CODECS else 'float32', # 'pq' comes with the index type
+            new_dim if new_reduction else 0, 
+            new_reduction or 'pca',
+        )
+        if not new_index.is_trained:
+            ivf = faiss.try_extract_index_ivf(new_index)
+            sample = vectors[np.random.default_rng(0).permutation(len(vectors))[:max(VECTORSTORE_TRAIN_SAMPLE, 256 * ivf.nlist if ivf else 0)]]
+            new_index.train(sample)
+        new_index.add(vectors)
+        vectorStore.index = new_index
+    
+    vectorstore_tune_index(vectorStore.index, nprobe, ef_search)
+    return vectorStore
 
 
 def vectorstore_load(
@@ -22,8 +601,16 @@ def vectorstore_load(
     mongo_colname: str = 'documents',
     ollama_model: str = 'llama3', 
     ollama_base_url: str = 'http://localhost:11434',
-) -> FAISS | None:
-    """Load FAISS vectorstore object
+    embedding: LLMBatchEmbeddings = None,
+    index_type: str = 'flat',
+    nprobe: int = VECTORSTORE_NPROBE,
+    ef_search: int = VECTORSTORE_EF_SEARCH,
+    codec: str = 'float32',
+    reduced_dim: int = 0,
+    reduction: str = 'pca',
+    rescore: int = 0,
+) -> dict[str, FAISS]:
+    """Load FAISS vectorstore shards
 
     Args:
         mongo_connect (str, optional): mongo connection url. Defaults to 'mongodb://localhost:27017/'.
@@ -31,56 +618,848 @@ def vectorstore_load(
         mongo_colname (str, optional): mongo collection name. Defaults to 'documents'.
         ollama_model (str, optional): ollama model. Defaults to 'llama3'.
         ollama_base_url (_type_, optional): ollama base url. Defaults to 'http://localhost:11434'.
+        embedding (LLMBatchEmbeddings, optional): embedding function, created from ollama_model if None. Defaults to None.
+        index_type (str, optional): one of VECTORSTORE_INDEX_TYPES, shards saved with another type are rebuilt. Defaults to 'flat'.
+        nprobe (int, optional): IVF lists visited per query. Defaults to VECTORSTORE_NPROBE.
+        ef_search (int, optional): HNSW search queue size. Defaults to VECTORSTORE_EF_SEARCH.
+        codec (str, optional): one of VECTORSTORE_CODECS, shards stored with another codec are rebuilt. Defaults to 'float32'.
+        reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+        reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+        rescore (int, optional): keep exact vectors next to a compressed index for re-scoring, see vectorstore_rank. Defaults to 0 (not kept).
 
     Returns:
-        FAISS | None: FAISS object if found or documents in DB else None
+        dict[str, FAISS]: shard name => FAISS object, empty if there is nothing saved and no documents in DB
+    
+    Note:
+        a vectorstore saved whole (before shards), a legacy pickle or documents in DB are partitioned into shards and saved
     """
-    # load vectorstore from pickle
-    if os.path.exists(VECTORSTORE_DB):
+    embedding = embedding or llm_get_embedding_function(ollama_model, ollama_base_url)
+    index_params = {'index_type': index_type, 'nprobe': nprobe, 'ef_search': ef_search, 'codec': codec, 'reduced_dim': reduced_dim, 'reduction': reduction, 'rescore': rescore}
+    
+    # load saved shards
+    manifest = vectorstore_read_shards(VECTORSTORE_DIR)
+    if manifest:
+        shards = {name: vectorstore_read(vectorstore_shard_path(name), embedding) for name in manifest['shards']}
+        rebuilt = [
+            name for name, vectorStore in shards.items() 
+            if (vectorstore_get_index_type(vectorStore.index), vectorstore_get_codec(vectorStore.index)) != vectorstore_target_format(vectorStore.index, index_type, codec, reduced_dim, reduction)
+        ]
+        for name in rebuilt: shards[name] = vectorstore_writable(shards[name], vectorstore_shard_path(name))
+        if rebuilt: vectorstore_commit_shards(shards, rebuilt, **index_params)
+        for vectorStore in shards.values(): vectorstore_tune_index(vectorStore.index, nprobe, ef_search)
+        return shards
+    
+    # vectorstore saved whole
+    vectorStore = vectorstore_read(VECTORSTORE_DIR, embedding)
+    
+    # convert legacy pickle
+    if not vectorStore and os.path.exists(VECTORSTORE_DB):
         with open(VECTORSTORE_DB, 'rb') as f: 
             vectorStore = pickle.load(f)
-        return vectorStore
+        
+        # vectorstores built with OllamaEmbeddings keep unnormalized vectors
+        if not isinstance(vectorStore.embedding_function, LLMBatchEmbeddings):
+            vectors = vectorStore.index.reconstruct_n(0, vectorStore.index.ntotal)
+            faiss.normalize_L2(vectors)
+            vectorStore.index.reset()
+            vectorStore.index.add(vectors)
+        vectorStore.embedding_function = embedding
     
-    # create new vectorstore from all documents in db
-    documents = storage_get_all_documents(mongo_connect, mongo_dbname, mongo_colname)
-    vectorStore = storage_load_vectorstore(
-        documents=documents,
-        embedding=llm_get_embedding_function(ollama_model, ollama_base_url),
-    ) if documents else None
-    
-    # save vectorstore to pickle
-    if vectorStore:
-        with open(VECTORSTORE_DB, 'wb') as f:
-            pickle.dump(vectorStore, f)
+    # partition it, or create shards from the documents in db, read and embedded in bounded batches
+    if vectorStore: shards = vectorstore_split(vectorStore)
+    else:
+        shards = {}
+        documents = StorageRepository(mongo_connect, mongo_dbname, mongo_colname).iter_documents(STORAGE_WRITE_BATCH_SIZE)
+        while batch := list(itertools.islice(documents, STORAGE_CHECKPOINT_SIZE)): vectorstore_add_to_shards(shards, batch, embedding)
+    if not shards: return shards
+    
+    # save shards, the whole vectorstore is not read anymore
+    vectorstore_commit_shards(shards, list(shards), **index_params)
+    for name in os.listdir(VECTORSTORE_DIR):
+        filepath = os.path.join(VECTORSTORE_DIR, name)
+        if name.startswith('gen-'): shutil.rmtree(filepath, ignore_errors=True)
+        elif name in ['CURRENT', 'docstore.jsonl']: os.remove(filepath)
+    if os.path.exists(VECTORSTORE_DB): os.remove(VECTORSTORE_DB)
+    return shards
+
+
+def vectorstore_source_of(id: str) -> str:
+    """Returns source of a chunk
+
+    Args:
+        id (str): document id ('source:page_num:document_id')
+
+    Returns:
+        str: source name
+    """
+    return id.rsplit(':', 2)[0]
+
+
+def vectorstore_shard_of(source: str, shards: int = VECTORSTORE_SHARDS) -> str:
+    """Returns shard holding the chunks of a source
+
+    Args:
+        source (str): source name
+        shards (int, optional): number of shards. Defaults to VECTORSTORE_SHARDS.
+
+    Returns:
+        str: shard name
+    """
+    return f'{int.from_bytes(hashlib.blake2b(source.encode(), digest_size=8).digest(), "little") % shards:02d}'
+
+
+def vectorstore_shard_path(name: str, path: str = VECTORSTORE_DIR) -> str:
+    """Returns directory of a shard
+
+    Args:
+        name (str): shard name
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+
+    Returns:
+        str: shard directory, laid out as a whole vectorstore (see vectorstore_read)
+    """
+    return os.path.join(path, f'shard-{name}')
+
+
+def vectorstore_read_shards(path: str = VECTORSTORE_DIR) -> dict | None:
+    """Reads committed shards
+
+    Args:
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+
+    Returns:
+        dict | None: {'generation', 'shards': {shard name: shard generation}} or None if nothing was saved
+    """
+    try:
+        with open(os.path.join(path, 'SHARDS'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def vectorstore_split(vectorStore: FAISS, shards: int = VECTORSTORE_SHARDS) -> dict[str, FAISS]:
+    """Partitions vectorstore into shards by source, stored vectors are reused (approximations for quantized indexes)
+
+    Args:
+        vectorStore (FAISS): FAISS object
+        shards (int, optional): number of shards. Defaults to VECTORSTORE_SHARDS.
+
+    Returns:
+        dict[str, FAISS]: shard name => FAISS object with a flat index, documents are kept under their chunk id
+    """
+    vectors = vectorstore_reconstruct(vectorStore.index)
+    groups = collections.defaultdict(list)
+    for i in range(vectorStore.index.ntotal):
+        docstore_id = vectorStore.index_to_docstore_id[i]
+        document = vectorStore.docstore.search(docstore_id)
         
+        # vectorstores built before explicit ids store documents under random ids
+        groups[vectorstore_shard_of(document.metadata.get('source', ''), shards)].append((document.metadata.get('id', docstore_id), document, vectors[i]))
+    return {
+        name: FAISS.from_embeddings(
+            [(document.page_content, vector) for _, document, vector in group],
+            vectorStore.embedding_function,
+            metadatas=[document.metadata for _, document, _ in group],
+            ids=[id for id, _, _ in group],
+        )
+        for name, group in groups.items()
+    }
+
+
+def vectorstore_commit_shards(
+    shards: dict[str, FAISS],
+    names: Iterable[str],
+    index_type: str = 'flat',
+    nprobe: int = VECTORSTORE_NPROBE,
+    ef_search: int = VECTORSTORE_EF_SEARCH,
+    path: str = VECTORSTORE_DIR,
+    codec: str = 'float32',
+    reduced_dim: int = 0,
+    reduction: str = 'pca',
+    rescore: int = 0,
+) -> dict:
+    """Saves changed shards, then atomically swaps to the new set of shard generations. Empty shards are deleted.
+
+    Args:
+        shards (dict[str, FAISS]): shard name => FAISS object, modified in place
+        names (Iterable[str]): changed shards
+        index_type (str, optional): one of VECTORSTORE_INDEX_TYPES. Defaults to 'flat'.
+        nprobe (int, optional): IVF lists visited per query. Defaults to VECTORSTORE_NPROBE.
+        ef_search (int, optional): HNSW search queue size. Defaults to VECTORSTORE_EF_SEARCH.
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+        codec (str, optional): one of VECTORSTORE_CODECS. Defaults to 'float32'.
+        reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+        reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+        rescore (int, optional): keep exact vectors next to a compressed index for re-scoring, see vectorstore_rank. Defaults to 0 (not kept).
+
+    Returns:
+        dict: committed shards, see vectorstore_read_shards
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = vectorstore_read_shards(path) or {'generation': 0, 'shards': {}}
+    generations = dict(manifest['shards'])
+    empty = []
+    for name in names:
+        if name in shards and shards[name].index.ntotal:
+            shards[name] = vectorstore_commit(shards[name], index_type, nprobe, ef_search, vectorstore_shard_path(name, path), codec, reduced_dim, reduction, rescore)
+            generations[name] = vectorstore_read_current(vectorstore_shard_path(name, path))['generation']
+        else:
+            shards.pop(name, None)
+            generations.pop(name, None)
+            empty.append(name)
+    
+    # swap
+    manifest = {'generation': manifest['generation'] + 1, 'shards': generations}
+    with open(os.path.join(path, 'SHARDS.tmp'), 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(os.path.join(path, 'SHARDS.tmp'), os.path.join(path, 'SHARDS'))
+    
+    # readers that still map removed shards keep their open files
+    for name in empty: shutil.rmtree(vectorstore_shard_path(name, path), ignore_errors=True)
+    return manifest
+
+
+def vectorstore_update_shards(
+    shards: dict[str, FAISS],
+    documents: list[Document],
+    removed_ids: list[str] = None,
+    embedding: LLMBatchEmbeddings = None,
+    progress: Callable[[int, int], None] = None,
+    write_lock: ContextManager = None,
+    path: str = VECTORSTORE_DIR,
+) -> set[str]:
+    """Adds documents to the shards of their sources and removes documents by id, changes stay in memory until vectorstore_commit_shards
+
+    Args:
+        shards (dict[str, FAISS]): shard name => FAISS object, modified in place
+        documents (list[Document]): documents with ids
+        removed_ids (list[str], optional): ids of documents to remove (stale or changed). Defaults to None.
+        embedding (LLMBatchEmbeddings, optional): embedding function. Defaults to None.
+        progress (Callable[[int, int], None], optional): called with (documents embedded, total). Defaults to None.
+        write_lock (ContextManager, optional): held while shards are modified, so readers can run in between. Defaults to None.
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+
+    Returns:
+        set[str]: names of changed shards
+    """
+    write_lock = write_lock or contextlib.nullcontext()
+    embedding = embedding or llm_get_embedding_function()
+    changed = set()
+    
+    # remove stale documents, and documents that are added again (a repeated batch of an interrupted update)
+    removed = collections.defaultdict(list)
+    for id in removed_ids or []: removed[vectorstore_shard_of(vectorstore_source_of(id))].append(id)
+    for d in documents: removed[vectorstore_shard_of(d.metadata['source'])].append(d.metadata['id'])
+    with write_lock:
+        for name, ids in removed.items():
+            if name not in shards: continue
+            vectorStore = vectorstore_writable(shards[name], vectorstore_shard_path(name, path))
+            size = vectorStore.index.ntotal
+            shards[name] = vectorstore_remove(vectorStore, ids)
+            if shards[name].index.ntotal != size: changed.add(name)
+    
+    return changed | vectorstore_add_to_shards(shards, documents, embedding, progress, write_lock)
+
+
+def vectorstore_add_to_shards(
+    shards: dict[str, FAISS],
+    documents: list[Document],
+    embedding: LLMBatchEmbeddings,
+    progress: Callable[[int, int], None] = None,
+    write_lock: ContextManager = None,
+) -> set[str]:
+    """Embeds documents and adds them to the shards of their sources as embedding batches arrive, creates missing shards
+
+    Args:
+        shards (dict[str, FAISS]): shard name => FAISS object, modified in place
+        documents (list[Document]): documents with ids, not in the shards
+        embedding (LLMBatchEmbeddings): embedding function
+        progress (Callable[[int, int], None], optional): called with (documents embedded, total). Defaults to None.
+        write_lock (ContextManager, optional): held while shards are modified. Defaults to None.
+
+    Returns:
+        set[str]: names of changed shards
+    """
+    write_lock = write_lock or contextlib.nullcontext()
+    changed = set()
+    done = 0
+    for positions, vectors in embedding.embed_batches([d.page_content for d in documents]) if documents else []:
+        batches = collections.defaultdict(list)
+        for i, vector in zip(positions, vectors): batches[vectorstore_shard_of(documents[i].metadata['source'])].append((documents[i], vector))
+        with write_lock, metrics_span('index'):
+            for name, batch in batches.items():
+                text_embeddings = [(d.page_content, vector) for d, vector in batch]
+                metadatas = [d.metadata for d, _ in batch]
+                ids = [d.metadata['id'] for d, _ in batch]
+                if name in shards: shards[name].add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+                else: shards[name] = FAISS.from_embeddings(text_embeddings, embedding, metadatas=metadatas, ids=ids)
+                
+                # a compressed index loses the exact vectors, they are kept until the save in case they are saved for re-scoring
+                if isinstance(shards[name].docstore, VectorStoreDocstore) and vectorstore_is_compressed(shards[name].index): 
+                    shards[name].docstore.add_vectors(ids, [vector for _, vector in batch])
+                changed.add(name)
+        
+        done += len(positions)
+        if progress: progress(done, len(documents))
+    return changed
+
+
+def vectorstore_remove(vectorStore: FAISS, ids: list[str]) -> FAISS:
+    """Removes documents from vectorStore by document id, unknown ids are ignored
+
+    Args:
+        vectorStore (FAISS): FAISS object
+        ids (list[str]): document ids ('source:page_num:document_id')
+
+    Returns:
+        FAISS: vectorstore object
+    """
+    ids = set(ids)
+    known_ids = set(vectorStore.index_to_docstore_id.values())
+    docstore_ids = list(ids & known_ids)
+    
+    # vectorstores built before explicit ids store documents under random ids (uuids, chunk ids always contain ':')
+    missing_ids = ids - known_ids
+    if missing_ids and any(':' not in id for id in known_ids):
+        docstore_ids += [
+            docstore_id for docstore_id in known_ids 
+            if vectorStore.docstore.search(docstore_id).metadata.get('id') in missing_ids
+        ]
+    
+    if not docstore_ids: return vectorStore
+    if vectorstore_get_index_type(vectorStore.index) == 'flat':
+        vectorStore.delete(docstore_ids)
+        return vectorStore
+    
+    # approximate indexes cannot renumber positions on removal, re-add the kept vectors to the emptied (still trained) index
+    removed = set(docstore_ids)
+    keep = [i for i in range(vectorStore.index.ntotal) if vectorStore.index_to_docstore_id[i] not in removed]
+    vectors = vectorstore_vectors(vectorStore, np.array(keep, dtype=np.int64))
+    index = faiss.clone_index(vectorStore.index)
+    index.reset()
+    index.add(vectors)
+    vectorStore.index = index
+    vectorStore.docstore.delete(docstore_ids)
+    vectorStore.index_to_docstore_id = {i: vectorStore.index_to_docstore_id[position] for i, position in enumerate(keep)}
     return vectorStore
 
 
-def vectorstore_update(
+def vectorstore_commit(
     vectorStore: FAISS, 
-    documents: dict[Document], 
-    ollama_model: str = 'llama3', 
-    ollama_base_url: str = 'http://localhost:11434'
+    index_type: str = 'flat',
+    nprobe: int = VECTORSTORE_NPROBE,
+    ef_search: int = VECTORSTORE_EF_SEARCH,
+    path: str = VECTORSTORE_DIR,
+    codec: str = 'float32',
+    reduced_dim: int = 0,
+    reduction: str = 'pca',
+    rescore: int = 0,
 ) -> FAISS:
-    """Updates vectorStore from documents (if none creates anew)
+    """Switches to the configured index type and codec once there are enough vectors, then saves changes
 
     Args:
-        vectorStore (FAISS): FAISS object if update else None to create a new
-        documents (dict[Document]): list of documents
-        ollama_model (str, optional): ollama model. Defaults to 'llama3'.
-        ollama_base_url (str, optional): ollama base url. Defaults to 'http://localhost:11434'.
+        vectorStore (FAISS): FAISS object
+        index_type (str, optional): one of VECTORSTORE_INDEX_TYPES. Defaults to 'flat'.
+        nprobe (int, optional): IVF lists visited per query. Defaults to VECTORSTORE_NPROBE.
+        ef_search (int, optional): HNSW search queue size. Defaults to VECTORSTORE_EF_SEARCH.
+        path (str, optional): vectorstore directory. Defaults to VECTORSTORE_DIR.
+        codec (str, optional): one of VECTORSTORE_CODECS. Defaults to 'float32'.
+        reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+        reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+        rescore (int, optional): keep exact vectors next to a compressed index for re-scoring, see vectorstore_rank. Defaults to 0 (not kept).
+
+    Returns:
+        FAISS: saved vectorstore object
+    """
+    with metrics_span('save'):
+        # exact vectors are taken before the index is compressed
+        vectors = vectorstore_vectors(vectorStore, np.arange(vectorStore.index.ntotal)) if rescore > 0 else None
+        vectorStore = vectorstore_build_index(vectorStore, index_type, nprobe, ef_search, codec, reduced_dim, reduction)
+        return vectorstore_save(vectorStore, path, vectors if vectorstore_is_compressed(vectorStore.index) else None)
+
+
+def vectorstore_search(
+    vectorStore: FAISS, 
+    query: str, 
+    vector: list[float], 
+    k: int = 5, 
+    retrieval: str = 'hybrid', 
+    fetch_k: int = VECTORSTORE_FETCH_K,
+    rescore: int = 0,
+) -> list[tuple[Document, float]]:
+    """Finds documents for a query: nearest vectors, fused with best keyword matches in hybrid mode
+
+    Args:
+        vectorStore (FAISS): FAISS object
+        query (str): query text
+        vector (list[float]): query embedding
+        k (int, optional): number of documents. Defaults to 5.
+        retrieval (str, optional): one of VECTORSTORE_RETRIEVAL_MODES. Defaults to 'hybrid'.
+        fetch_k (int, optional): candidates taken from each retriever. Defaults to VECTORSTORE_FETCH_K.
+        rescore (int, optional): candidates per result re-ranked by exact vectors, see vectorstore_rank. Defaults to 0.
+
+    Returns:
+        list[tuple[Document, float]]: documents and their L2 distance ('vector') or reciprocal rank fusion score ('hybrid')
+    """
+    fetch_k = k if retrieval == 'vector' else max(k, fetch_k)
+    best = vectorstore_fuse([vectorstore_rank(vectorStore, query, vector, fetch_k, retrieval, rescore=rescore)], k, fetch_k)
+    return [(vectorStore.docstore.search(id), score) for _, id, score in best]
+
+
+def vectorstore_rank(
+    vectorStore: FAISS, 
+    query: str, 
+    vector: list[float], 
+    fetch_k: int = VECTORSTORE_FETCH_K, 
+    retrieval: str = 'hybrid', 
+    positions: np.ndarray = None,
+    keyword_stats: dict = None,
+    rescore: int = 0,
+) -> tuple[list[tuple[str, float]], list[tuple[str, float]] | None]:
+    """Ranks candidates of each retriever
+
+    Args:
+        vectorStore (FAISS): FAISS object
+        query (str): query text
+        vector (list[float]): query embedding
+        fetch_k (int, optional): candidates taken from each retriever. Defaults to VECTORSTORE_FETCH_K.
+        retrieval (str, optional): one of VECTORSTORE_RETRIEVAL_MODES. Defaults to 'hybrid'.
+        positions (np.ndarray, optional): index positions to search, their vectors are compared exactly (see vectorstore_vectors). Defaults to None (all).
+        keyword_stats (dict, optional): BM25 statistics of all shards, see bm25_merge_stats. Defaults to None (of this vectorstore).
+        rescore (int, optional): nearest candidates per result taken from a compressed index and re-ranked by their exact vectors, 
+            if they were kept (see vectorstore_save). Defaults to 0 (ranked by the index).
+
+    Returns:
+        tuple[list[tuple[str, float]], list[tuple[str, float]] | None]: (docstore id, L2 distance) nearest first, 
+            (docstore id, BM25 score) best first or None in 'vector' mode and without a keyword index
+    """
+    query_vector = np.array([vector], dtype=np.float32)
+    exact = rescore > 0 and getattr(vectorStore.docstore, 'vectors', None) is not None
+    if positions is None and not exact:
+        distances, found = vectorStore.index.search(query_vector, fetch_k)
+        nearest = [(vectorStore.index_to_docstore_id[i], float(d)) for i, d in zip(found[0], distances[0]) if i >= 0]
+    elif positions is None or len(positions):
+        # candidates of the compressed index (or all positions of selected sources) are compared with their exact vectors
+        candidates = positions
+        if candidates is None:
+            _, found = vectorStore.index.search(query_vector, fetch_k * rescore)
+            candidates = found[0][found[0] >= 0]
+        distances = ((vectorstore_vectors(vectorStore, candidates) - query_vector) ** 2).sum(axis=1)
+        top = np.argsort(distances, kind='stable')[:fetch_k]
+        nearest = [(vectorStore.index_to_docstore_id[int(candidates[i])], float(distances[i])) for i in top]
+    else: nearest = []
+    
+    keywords = getattr(vectorStore.docstore, 'keywords', None)
+    if retrieval == 'vector' or keywords is None: return nearest, None
+    ids = None if positions is None else [vectorStore.index_to_docstore_id[int(i)] for i in positions]
+    return nearest, keywords.search(query, fetch_k, ids, keyword_stats)
+
+
+def vectorstore_fuse(
+    rankings: list[tuple[list[tuple[str, float]], list[tuple[str, float]] | None]], 
+    k: int = 5, 
+    fetch_k: int = VECTORSTORE_FETCH_K,
+) -> list[tuple[int, str, float]]:
+    """Merges rankings of shards: nearest vectors by distance, keyword matches by score, then fuses them with reciprocal rank fusion
+
+    Args:
+        rankings (list[tuple[list[tuple[str, float]], list[tuple[str, float]] | None]]): rankings per shard, see vectorstore_rank
+        k (int, optional): number of documents. Defaults to 5.
+        fetch_k (int, optional): candidates taken from each retriever. Defaults to VECTORSTORE_FETCH_K.
 
     Returns:
-        FAISS: valid vectorstore object
+        list[tuple[int, str, float]]: (shard number in rankings, docstore id, score) best first, 
+            the score is the L2 distance if no shard has keyword rankings and the reciprocal rank fusion score otherwise
     """
-    # add documents
-    if vectorStore: vectorStore.add_documents(documents)
-    else: vectorStore = FAISS.from_documents(documents, embedding=llm_get_embedding_function(ollama_model, ollama_base_url))
+    nearest = sorted(((distance, shard, id) for shard, (found, _) in enumerate(rankings) for id, distance in found), key=lambda item: item[0])
+    if all(keywords is None for _, keywords in rankings): return [(shard, id, distance) for distance, shard, id in nearest[:k]]
+    matches = sorted(((-score, shard, id) for shard, (_, keywords) in enumerate(rankings) for id, score in keywords or []), key=lambda item: item[0])
     
-    # save vectorstore to pickle
-    with open(VECTORSTORE_DB, 'wb') as f:
-        pickle.dump(vectorStore, f)
+    # reciprocal rank fusion: every retriever adds 1 / (VECTORSTORE_RRF_K + rank) to the documents it found
+    scores = collections.defaultdict(float)
+    for ranking in [nearest[:fetch_k], matches[:fetch_k]]:
+        for rank, (_, shard, id) in enumerate(ranking):
+            scores[(shard, id)] += 1.0 / (VECTORSTORE_RRF_K + rank + 1)
+    best = sorted(scores.items(), key=lambda item: -item[1])[:k]
+    return [(shard, id, score) for (shard, id), score in best]
+
+
+def vectorstore_reconstruct_positions(index: faiss.Index, positions: np.ndarray) -> np.ndarray:
+    """Returns vectors stored at index positions (approximations for quantized indexes)
+
+    Args:
+        index (faiss.Index): index
+        positions (np.ndarray): index positions
+
+    Returns:
+        np.ndarray: vectors
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        with VECTORSTORE_DIRECT_MAP_LOCK:
+            if ivf.direct_map.type == faiss.DirectMap.NoMap: ivf.make_direct_map()
+    return index.reconstruct_batch(positions)
+
+
+def vectorstore_vectors(vectorStore: FAISS, positions: np.ndarray) -> np.ndarray:
+    """Returns vectors at index positions: exact ones if they are kept next to a compressed index, reconstructed from the index otherwise
+
+    Args:
+        vectorStore (FAISS): FAISS object
+        positions (np.ndarray): index positions
+
+    Returns:
+        np.ndarray: vectors
+    """
+    docstore = vectorStore.docstore
+    rows = getattr(docstore, 'vector_rows', {})
+    pending = getattr(docstore, 'pending_vectors', {})
+    if not rows and not pending: return vectorstore_reconstruct_positions(vectorStore.index, positions)
+    
+    ids = [vectorStore.index_to_docstore_id[int(i)] for i in positions]
+    vectors = np.empty((len(ids), vectorStore.index.d), dtype=np.float32)
+    saved = [(i, rows[id]) for i, id in enumerate(ids) if id not in pending and id in rows]
+    missing = [i for i, id in enumerate(ids) if id not in pending and id not in rows]
+    if saved: vectors[[i for i, _ in saved]] = docstore.vectors[[row for _, row in saved]]
+    if missing: vectors[missing] = vectorstore_reconstruct_positions(vectorStore.index, positions[missing])
+    for i, id in enumerate(ids):
+        if id in pending: vectors[i] = pending[id]
+    return vectors
+
+
+class VectorStoreRWLock:
+    """Readers-writer lock: any number of readers or a single writer, waiting writers block new readers"""
+    
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+        self.read = VectorStoreLockGuard(self.acquire_read, self.release_read)
+        self.write = VectorStoreLockGuard(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.writer and not self.writers_waiting)
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers: self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            self.cond.wait_for(lambda: not self.writer and not self.readers)
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+
+class VectorStoreLockGuard:
+    """Reusable context manager calling acquire/release"""
+    
+    def __init__(self, acquire: Callable, release: Callable):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class VectorStoreService:
+    """Vectorstore shared by all sessions of a server process
+
+    The index is partitioned by source into shards (see vectorstore_shard_of), each one is saved and rebuilt on its own,
+    so a change to a few files writes only their shards. Queries fan out to the shards in a thread pool and their results are merged.
+    Searches run concurrently, updates are serialized and hold the exclusive lock only while the index is modified.
+    Every update bumps the version, sessions see new documents without reloading the index.
+    A read-only service leaves writing to another process (ingest worker) and reloads the shards that changed when it saves a new generation.
+    """
+
+    def __init__(
+        self,
+        mongo_connect: str = 'mongodb://localhost:27017/', 
+        mongo_dbname: str = 'filechat', 
+        mongo_colname: str = 'documents',
+        embedding: LLMBatchEmbeddings = None,
+        index_type: str = 'flat',
+        nprobe: int = VECTORSTORE_NPROBE,
+        ef_search: int = VECTORSTORE_EF_SEARCH,
+        writable: bool = True,
+        retrieval: str = 'hybrid',
+        background: bool = False,
+        codec: str = 'float32',
+        reduced_dim: int = 0,
+        reduction: str = 'pca',
+        rescore: int = 0,
+    ):
+        """Loads vectorstore
+
+        Args:
+            mongo_connect (str, optional): mongo connection url. Defaults to 'mongodb://localhost:27017/'.
+            mongo_dbname (str, optional): mongo database name. Defaults to 'filechat'.
+            mongo_colname (str, optional): mongo collection name. Defaults to 'documents'.
+            embedding (LLMBatchEmbeddings, optional): embedding function. Defaults to None.
+            index_type (str, optional): one of VECTORSTORE_INDEX_TYPES. Defaults to 'flat'.
+            nprobe (int, optional): IVF lists visited per query. Defaults to VECTORSTORE_NPROBE.
+            ef_search (int, optional): HNSW search queue size. Defaults to VECTORSTORE_EF_SEARCH.
+            writable (bool, optional): load (building or converting the index if needed) under the writer lock, otherwise only read what is saved. Defaults to True.
+            retrieval (str, optional): one of VECTORSTORE_RETRIEVAL_MODES. Defaults to 'hybrid'.
+            background (bool, optional): read-only service loads the index in a background thread, see 'ready'. Defaults to False.
+            codec (str, optional): one of VECTORSTORE_CODECS. Defaults to 'float32'.
+            reduced_dim (int, optional): dimension stored in the index, 0 to keep all. Defaults to 0.
+            reduction (str, optional): one of VECTORSTORE_REDUCTIONS. Defaults to 'pca'.
+            rescore (int, optional): candidates per result re-ranked by exact vectors kept next to a compressed index, see vectorstore_rank. Defaults to 0.
+        """
+        self.mongo_connect = mongo_connect
+        self.mongo_dbname = mongo_dbname
+        self.mongo_colname = mongo_colname
+        self.embedding = embedding or llm_get_embedding_function()
+        self.index_params = {
+            'index_type': index_type, 
+            'nprobe': nprobe, 
+            'ef_search': ef_search, 
+            'codec': codec, 
+            'reduced_dim': reduced_dim, 
+            'reduction': reduction, 
+            'rescore': rescore,
+        }
+        self.retrieval = retrieval
+        self.lock = VectorStoreRWLock()
+        self.writer = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=VECTORSTORE_SEARCH_WORKERS, thread_name_prefix='vectorstore-search')
+        self.version = 0
+        self.generation = None
+        self.shard_generations = {}
+        self.checked = 0.0
+        self.loading = threading.Lock()
+        self.ready = threading.Event() # set once the index is loaded
+        self.shards = {}               # shard name => FAISS object
+        self.dirty = set()             # shards changed since the last save
+        self.positions = {}            # shard name => {source: index positions}, rebuilt after changes
+        if writable:
+            with vectorstore_lock():
+                self.shards = vectorstore_load(mongo_connect, mongo_dbname, mongo_colname, embedding=self.embedding, **self.index_params)
+                self.committed(vectorstore_read_shards())
+            self.ready.set()
+        elif background:
+            threading.Thread(target=self.warm_up, daemon=True, name='vectorstore-load').start()
+        else: self.warm_up()
+
+    def warm_up(self):
+        """Loads the saved index, 'ready' is set afterwards even if loading failed (searches find nothing then)"""
+        try:
+            with metrics_span('load'): self.refresh(force=True)
+        except Exception as e: log_print(f'Failed to load vectorstore: {e}')
+        finally: self.ready.set()
+
+    def committed(self, manifest: dict | None):
+        """Records the saved generation of the shards held in memory
+
+        Args:
+            manifest (dict | None): committed shards, see vectorstore_read_shards
+        """
+        self.generation = manifest['generation'] if manifest else None
+        self.shard_generations = dict(manifest['shards']) if manifest else {}
+
+    def saved_generation(self) -> int | None:
+        """Returns generation of the saved vectorstore
+
+        Returns:
+            int | None: generation or None if nothing is saved
+        """
+        manifest = vectorstore_read_shards()
+        return manifest['generation'] if manifest else None
+
+    def refresh(self, force: bool = False) -> bool:
+        """Reloads changed shards if another process saved a new generation (checked at most every VECTORSTORE_REFRESH_INTERVAL)
+
+        Args:
+            force (bool, optional): check now. Defaults to False.
+
+        Returns:
+            bool: True if the index was reloaded
+        """
+        if not force and time.monotonic() - self.checked < VECTORSTORE_REFRESH_INTERVAL: return False
         
-    return vectorStore
+        # one load at a time, a refresh while the index is being loaded has nothing to do
+        if not self.loading.acquire(blocking=force): return False
+        try:
+            self.checked = time.monotonic()
+            manifest = vectorstore_read_shards()
+            if (manifest['generation'] if manifest else None) == self.generation: return False
+            
+            # shards that did not change are kept
+            shards = {}
+            for name, generation in (manifest['shards'] if manifest else {}).items():
+                if name in self.shards and self.shard_generations.get(name) == generation:
+                    shards[name] = self.shards[name]
+                    continue
+                
+                # the writer removes old generations right after the swap, read again if ours disappeared
+                for _ in range(3):
+                    try:
+                        vectorStore = vectorstore_read(vectorstore_shard_path(name), self.embedding)
+                        break
+                    except FileNotFoundError:
+                        time.sleep(0.1)
+                else: return False
+                if not vectorStore: continue
+                vectorstore_tune_index(vectorStore.index, self.index_params['nprobe'], self.index_params['ef_search'])
+                shards[name] = vectorStore
+            
+            with self.lock.write:
+                self.shards = shards
+                self.committed(manifest)
+                self.positions = {}
+                self.version += 1
+            return True
+        finally: self.loading.release()
+
+    def source_positions(self, name: str) -> dict[str, np.ndarray]:
+        """Returns index positions of the chunks of each source in a shard, called with the read lock held
+
+        Args:
+            name (str): shard name
+
+        Returns:
+            dict[str, np.ndarray]: source => index positions
+        """
+        positions = self.positions.get(name)
+        if positions is None:
+            groups = collections.defaultdict(list)
+            for i, id in self.shards[name].index_to_docstore_id.items(): groups[vectorstore_source_of(id)].append(i)
+            positions = self.positions[name] = {source: np.array(group, dtype=np.int64) for source, group in groups.items()}
+        return positions
+
+    def sources(self) -> list[str]:
+        """Returns sources in the index
+
+        Returns:
+            list[str]: source names, sorted
+        """
+        with self.lock.read:
+            return sorted(source for name in self.shards for source in self.source_positions(name))
+
+    def search(self, query: str, k: int = 5, vector: list[float] = None, sources: list[str] = None) -> list[tuple[Document, float]]:
+        """Finds documents most similar to query
+
+        Args:
+            query (str): query text
+            k (int, optional): number of documents. Defaults to 5.
+            vector (list[float], optional): query embedding, computed if None. Defaults to None.
+            sources (list[str], optional): search only chunks of these sources, only their shards are searched. Defaults to None (all).
+
+        Returns:
+            list[tuple[Document, float]]: documents and their score (see vectorstore_search)
+        """
+        self.refresh()
+        if not self.shards: return []
+        vector = vector or self.embedding.embed_query(query)
+        fetch_k = k if self.retrieval == 'vector' else max(k, VECTORSTORE_FETCH_K)
+        
+        def rank(name: str) -> tuple:
+            if sources is None: return vectorstore_rank(self.shards[name], query, vector, fetch_k, self.retrieval, keyword_stats=keyword_stats, rescore=self.index_params['rescore'])
+            positions = [self.source_positions(name).get(source) for source in sources]
+            positions = np.concatenate([p for p in positions if p is not None] or [np.zeros(0, dtype=np.int64)])
+            return vectorstore_rank(self.shards[name], query, vector, fetch_k, self.retrieval, positions, keyword_stats, self.index_params['rescore'])
+        
+        with self.lock.read, metrics_span('search'):
+            names = sorted(self.shards if sources is None else {vectorstore_shard_of(source) for source in sources} & self.shards.keys())
+            
+            # BM25 scores of all shards are computed with the statistics of the whole library, so they can be merged
+            indexes = [index for shard in self.shards.values() if (index := getattr(shard.docstore, 'keywords', None)) is not None]
+            keyword_stats = bm25_merge_stats([index.stats(query) for index in indexes]) if self.retrieval != 'vector' and len(indexes) > 1 else None
+            rankings = list(self.executor.map(rank, names)) if len(names) > 1 else [rank(name) for name in names]
+            return [(self.shards[names[shard]].docstore.search(id), score) for shard, id, score in vectorstore_fuse(rankings, k, fetch_k)]
+
+    def update(self, documents: list[Document], removed_ids: list[str] = None, progress: Callable[[int, int], None] = None, save: bool = True):
+        """Adds new and removes stale documents
+
+        Args:
+            documents (list[Document]): new documents
+            removed_ids (list[str], optional): ids of documents to remove. Defaults to None.
+            progress (Callable[[int, int], None], optional): called with (documents embedded, total). Defaults to None.
+            save (bool, optional): save changes, otherwise they are saved by the next save() call. Defaults to True.
+        """
+        with self.writer:
+            changed = vectorstore_update_shards(self.shards, documents, removed_ids, self.embedding, progress, self.lock.write)
+            with self.lock.write:
+                self.dirty |= changed
+                self.positions = {}
+                self.version += 1
+        if save: self.save()
+
+    def save(self):
+        """Saves shards changed by updates made with save=False"""
+        with self.writer:
+            if not self.dirty: return
+            with self.lock.write:
+                self.committed(vectorstore_commit_shards(self.shards, self.dirty, **self.index_params))
+                self.dirty.clear()
+                self.positions = {}
+
+    def delete(self, sources: list[str]) -> bool:
+        """Deletes documents of sources from database and index, only their shards are saved again
+
+        Args:
+            sources (list[str]): source names
+
+        Returns:
+            bool: False if another process is writing the vectorstore, nothing is deleted then
+        """
+        with vectorstore_lock(blocking=False) as locked:
+            if not locked: return False
+            self.refresh(force=True)
+            removed_ids = storage_delete_sources(sources, self.mongo_connect, self.mongo_dbname, self.mongo_colname)
+            
+            # chunks found in the index are removed even if the database lost them
+            with self.lock.read:
+                for name in {vectorstore_shard_of(source) for source in sources} & self.shards.keys():
+                    index_to_docstore_id = self.shards[name].index_to_docstore_id
+                    removed_ids += [index_to_docstore_id[int(i)] for source in sources for i in self.source_positions(name).get(source, [])]
+            with self.writer:
+                self.dirty |= vectorstore_update_shards(self.shards, [], removed_ids, self.embedding, write_lock=self.lock.write)
+                with self.lock.write:
+                    self.positions = {}
+                    self.version += 1
+            self.save()
+            return True
+
+    def clear(self) -> bool:
+        """Deletes database and vectorstore
+
+        Returns:
+            bool: False if another process is writing the vectorstore, nothing is deleted then
+        """
+        with self.writer, vectorstore_lock(blocking=False) as locked:
+            if not locked: return False
+            with self.lock.write:
+                storage_clear_database(self.mongo_connect, self.mongo_dbname)
+                vectorstore_delete()
+                self.shards = {}
+                self.dirty.clear()
+                self.positions = {}
+                self.committed(None)
+                self.version += 1
+            return True
 
+    def size(self) -> int:
+        """Returns number of vectors in the index
 
+        Returns:
+            int: number of vectors
+        """
+        return sum(vectorStore.index.ntotal for vectorStore in list(self.shards.values()))
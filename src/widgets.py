@@ -13,3 +13,62 @@ def widget_info_notification(body: str, icon: str = '✅', dur: float = 3):
     widget.empty()
 
 
+def widget_warmup(body: str):
+    """Shows that the app is not ready yet
+
+    Args:
+        body (str): what is being loaded
+    """
+    st.info(body, icon='⏳')
+
+
+def widget_chat_stats(stats: dict):
+    """Shows generation stats and where the answer time went under a chat message
+
+    Args:
+        stats (dict): {'ttft', 'tokens', 'tokens_per_s', 'prompt_tokens', 'context_tokens', 'coalesced', 'total', 'stages'} or 
+            {'cached', 'total', 'stages'} for answers from cache, 'stages' are seconds per stage; prompt and context tokens and coalesced are optional
+    """
+    if stats.get('cached'): text = f'cached answer · {stats["total"] * 1000:.0f}ms'
+    else: 
+        text = f'first token {stats["ttft"]:.2f}s · {stats["tokens"]} tokens · {stats["tokens_per_s"]:.1f} tokens/s · {stats["total"]:.1f}s total'
+        if stats.get('prompt_tokens'): text += f' · prompt {stats["prompt_tokens"]} tokens'
+        if stats.get('context_tokens'): text += f' ({stats["context_tokens"]} of context)' if stats.get('prompt_tokens') else f' · context {stats["context_tokens"]} tokens'
+        if stats.get('coalesced'): text += ' · shared with an identical question'
+    st.caption(text)
+    if stats.get('stages'): st.caption(' · '.join(f'{stage} {seconds * 1000:.0f}ms' for stage, seconds in stats['stages'].items()))
+
+
+def widget_metrics(summaries: dict[str, dict]):
+    """Shows latency percentiles per process and stage
+
+    Args:
+        summaries (dict[str, dict]): process => stage => {'count', 'p50', 'p95'} in seconds, see metrics_summary
+    """
+    rows = [
+        {'process': process, 'stage': stage, 'count': s['count'], 'p50 ms': round(s['p50'] * 1000, 1), 'p95 ms': round(s['p95'] * 1000, 1)} 
+        for process, summary in summaries.items() for stage, s in summary.items()
+    ]
+    if not rows:
+        st.caption('No requests yet')
+        return
+    st.dataframe(rows, hide_index=True, use_container_width=True)
+
+
+def widget_job_status(job: dict):
+    """Shows ingestion job progress, throughput and ETA
+
+    Args:
+        job (dict): job status from jobs_status
+    """
+    progress = job['progress']
+    done, total = progress['files_done'], progress['files_total']
+    text = f'{job["status"]}: {done}/{total} files · {progress["chunks_added"]} chunks added · {progress["chunks_removed"]} removed'
+    if job['status'] == 'running': 
+        text += f' · {job["chunks_per_s"]:.1f} chunks/s'
+        if job['eta'] is not None: text += f' · ETA {job["eta"]:.0f}s'
+    elif job['status'] in ['done', 'failed']: 
+        text += f' · {job["elapsed"]:.0f}s'
+    st.progress(done / total if total else 1.0, text=text)
+    if job['error']: st.error(f'Job failed: {job["error"]}', icon='⚠️')
+    for error in progress['errors']: st.caption(f'⚠️ failed to read {error["file"]}: {error["error"]}')